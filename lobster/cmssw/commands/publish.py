@@ -289,7 +289,7 @@ class Publish(Command):
 
         return file_
 
-    def insert_block(self, dbs, primary_dataset, dataset, user, config, basedir, datasetdir, stageoutdir, chunk):
+    def insert_block(self, dbs, primary_dataset, dataset, user, config, basedir, datasetdir, stageoutdir, chunk, moved=True):
         block = self.prepare_block(dataset, user)
 
         files = []
@@ -300,7 +300,7 @@ class Publish(Command):
         logger.info('preparing DBS entry for {} task block: {}'.format(len(chunk), block['block_name']))
 
         for task, _ in chunk:
-            taskdir = os.path.join(basedir, util.id2dir(task))
+            taskdir = util.taskpath(basedir, task, 'successful', moved)
             try:
                 files.append(self.prepare_file(dataset, block, user, taskdir, datasetdir, stageoutdir))
                 cfg = config.copy()
@@ -402,14 +402,15 @@ class Publish(Command):
 
                 first_task = 0
                 inserted = []
-                basedir = os.path.join(args.config.workdir, label, 'successful')
+                basedir = os.path.join(args.config.workdir, label)
                 datasetdir = os.path.join('/store/user', user, dset, publish_label + '_' + publish_hash)
 
                 config = self.__get_config(args, label, pset_hash)
 
                 while first_task < len(tasks):
                     chunk = tasks[first_task:first_task + args.block_size]
-                    processed, block = self.insert_block(dbs, primary_dataset, dataset, user, config, basedir, datasetdir, stageoutdir, chunk)
+                    processed, block = self.insert_block(dbs, primary_dataset, dataset, user, config, basedir, datasetdir, stageoutdir, chunk,
+                                                         args.config.advanced.move_taskdirs)
                     inserted += processed
                     first_task += args.block_size
 
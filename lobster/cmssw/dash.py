@@ -1,9 +1,12 @@
+import atexit
 import datetime
 import logging
 import os
 import socket
 import subprocess
+import threading
 
+from collections import OrderedDict
 from hashlib import sha1
 
 from WMCore.Services.Dashboard.DashboardAPI import apmonSend, apmonFree
@@ -66,8 +69,87 @@ class Monitor(object):
     def update_tasks(self, queue, exclude):
         pass
 
-    def free(self):
-        pass
+    @property
+    def counters(self):
+        """Messages sent, dropped, and replaced by newer ones."""
+        return {'sent': 0, 'dropped': 0, 'coalesced': 0}
+
+
+class Sender(threading.Thread):
+
+    """Send dashboard messages in the background.
+
+    Messages are queued per task and kind, and a newer message replaces a
+    pending one of the same task and kind, keeping its place in the queue.
+    Queued messages are sent in batches, at most `rate` per second.  When
+    `size` messages are pending, new ones are dropped instead of blocking
+    the caller.  Pending messages are sent without rate limit when
+    stopping.
+
+    Parameters
+    ----------
+    rate : int
+        The maximum number of messages to send per second.
+    size : int
+        The maximum number of pending messages.
+    """
+
+    def __init__(self, rate, size):
+        super(Sender, self).__init__(name='dashboard')
+        self.daemon = True
+        self.rate = rate
+        self.size = size
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.__pending = OrderedDict()
+        self.__condition = threading.Condition()
+        self.__stopped = False
+
+    def submit(self, key, workflowid, taskid, params):
+        """Queue a message, replacing any pending one with the same `key`.
+        """
+        with self.__condition:
+            if key in self.__pending:
+                self.coalesced += 1
+            elif len(self.__pending) >= self.size or self.__stopped:
+                self.dropped += 1
+                return
+            self.__pending[key] = (workflowid, taskid, params)
+            self.__condition.notify()
+
+    def stop(self):
+        """Send all pending messages and stop the thread.
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        self.join()
+
+    def run(self):
+        monalisa = logging.getLogger("MonaLisa")
+        while True:
+            with self.__condition:
+                while len(self.__pending) == 0 and not self.__stopped:
+                    self.__condition.wait()
+                if len(self.__pending) == 0:
+                    break
+                size = len(self.__pending) if self.__stopped else min(self.rate, len(self.__pending))
+                batch = [self.__pending.popitem(last=False)[1] for _ in range(size)]
+                stopped = self.__stopped
+
+            start = time.time()
+            for workflowid, taskid, params in batch:
+                try:
+                    apmonSend(workflowid, taskid, params, monalisa, conf)
+                    self.sent += 1
+                except Exception as e:
+                    logger.error("failed to send dashboard message: {0}".format(e))
+                    self.dropped += 1
+            apmonFree()
+
+            if not stopped:
+                time.sleep(max(0, 1 - (time.time() - start)))
 
 
 class Dashboard(Monitor, util.Configurable):
@@ -87,12 +169,22 @@ class Dashboard(Monitor, util.Configurable):
     commonname : str or None
         The common/full name of the user, or `None` (the default) to obtain
         it from the proxy information.
+    rate : int
+        The maximum number of messages sent to the dashboard per second.
+        Messages are sent in the background, and status changes of a task
+        still waiting to be sent are combined into one message.
+    backlog : int
+        The maximum number of messages waiting to be sent.  Further
+        messages are dropped rather than delaying Lobster.
     """
 
     _mutable = {}
 
-    def __init__(self, interval=300, username=None, commonname=None):
+    def __init__(self, interval=300, username=None, commonname=None, rate=100, backlog=50000):
         self.interval = interval
+        self.rate = rate
+        self.backlog = backlog
+        self.__sender = Sender(rate, backlog)
         self.__previous = 0
         self.__states = {}
         self.username = username if username else self.__get_user()
@@ -107,11 +199,17 @@ class Dashboard(Monitor, util.Configurable):
             logger.error("can't load siteconfig, defaulting to hostname")
             self._ce = socket.getfqdn()
 
-    def __del__(self):
-        try:
-            self.free()
-        except Exception:
-            pass
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_Dashboard__sender']
+        return state
+
+    def __setstate__(self, state):
+        # Configurations pickled by earlier versions lack the rate limit
+        state.setdefault('rate', 100)
+        state.setdefault('backlog', 50000)
+        self.__dict__.update(state)
+        self.__dict__['_Dashboard__sender'] = Sender(self.rate, self.backlog)
 
     def __get_distinguished_name(self):
         p = subprocess.Popen(["voms-proxy-info", "-identity"],
@@ -124,11 +222,24 @@ class Dashboard(Monitor, util.Configurable):
         db = SiteDBJSON({'cacheduration': 24, 'logger': logging.getLogger("WMCore")})
         return db.dnUserName(dn=self.__get_distinguished_name())
 
-    def free(self):
-        apmonFree()
+    @property
+    def counters(self):
+        return {
+            'sent': self.__sender.sent,
+            'dropped': self.__sender.dropped,
+            'coalesced': self.__sender.coalesced
+        }
 
     def send(self, taskid, params):
-        apmonSend(self._workflowid, taskid, params, logging.getLogger("MonaLisa"), conf)
+        """Queue a message for the dashboard.
+
+        Started when first used, the sender is stopped when exiting the
+        interpreter, after sending all pending messages.
+        """
+        if self.__sender.ident is None:
+            self.__sender.start()
+            atexit.register(self.__sender.stop)
+        self.__sender.submit((taskid, 'StatusValue' in params), self._workflowid, taskid, params)
 
     def setup(self, config):
         super(Dashboard, self).setup(config)
@@ -165,7 +276,6 @@ class Dashboard(Monitor, util.Configurable):
             'resubmitter': 'user',
             'exe': self.__executable
         })
-        self.free()
 
     def register_task(self, id):
         monitorid, syncid = self.generate_ids(id)
@@ -1,3 +1,4 @@
+from collections import defaultdict
 import hashlib
 import logging
 import math
@@ -8,7 +9,7 @@ import requests
 from retrying import retry
 import xdg.BaseDirectory
 
-from lobster.core.dataset import DatasetInfo
+from lobster.core.dataset import DatasetInfo, FileInfo
 from lobster.util import Configurable
 
 from dbs.apis.dbsClient import DbsApi
@@ -50,21 +51,42 @@ class Cache(object):
         return os.path.join(self.cachedir,
                             "{}-{}.pkl".format(name.strip('/').split('/')[0], m.hexdigest()))
 
-    def cache(self, name, mask, baseinfo, dataset):
-        logger.debug("writing dataset '{}' to cache".format(name))
-        with open(self.__cachename(name, mask), 'wb') as fd:
-            pickle.dump((baseinfo, dataset), fd)
+    def cache(self, name, mask, baseinfo, files):
+        """Write the files of a dataset to the cache while yielding them.
+
+        The cache is only put in place once all files have been read.
+        """
+        cachename = self.__cachename(name, mask)
+        with open(cachename + '.tmp', 'wb') as fd:
+            pickle.dump(baseinfo, fd, pickle.HIGHEST_PROTOCOL)
+            for item in files:
+                pickle.dump(item, fd, pickle.HIGHEST_PROTOCOL)
+                yield item
+        os.rename(cachename + '.tmp', cachename)
+        logger.debug("wrote dataset '{}' to cache".format(name))
 
     def cached(self, name, mask, baseinfo):
+        """Return a generator over the cached files of a dataset, or
+        `None` if the dataset is not cached or has changed since.
+        """
         try:
-            with open(self.__cachename(name, mask), 'rb') as fd:
-                info, dset = pickle.load(fd)
-                if baseinfo == info:
-                    logger.debug("retrieved dataset '{}' from cache".format(name))
-                    return dset
-                return None
+            fd = open(self.__cachename(name, mask), 'rb')
+            info = pickle.load(fd)
         except Exception:
             return None
+        if baseinfo != info:
+            fd.close()
+            return None
+        logger.debug("retrieved dataset '{}' from cache".format(name))
+
+        def files():
+            with fd:
+                while True:
+                    try:
+                        yield pickle.load(fd)
+                    except EOFError:
+                        break
+        return files()
 
 
 class Dataset(Configurable):
@@ -136,23 +158,35 @@ class Dataset(Configurable):
         return True
 
     def get_info(self):
+        """Return the information about the dataset.
+
+        The files of the dataset are read block by block while the
+        returned `DatasetInfo` is consumed, with the unit counts and
+        whether tasks need to stop at file boundaries updated once all
+        files have been read.
+        """
         if self.dataset not in Dataset.__dsets:
             if self.lumi_mask:
                 self.lumi_mask = self.__get_mask(self.lumi_mask)
-            res = self.query_database()
-
-            if self.events_per_task:
-                if res.total_events > 0:
-                    res.tasksize = int(math.ceil(self.events_per_task / float(res.total_events) * res.total_units))
-                else:
-                    res.tasksize = 1
+            Dataset.__dsets[self.dataset] = self.query_database()
+        baseinfo, total_lumis, total_events = Dataset.__dsets[self.dataset]
+
+        res = DatasetInfo()
+        res.total_events = total_events
+        # preliminary, until all files have been read
+        res.total_units = total_lumis
+        res.files = self.__files(res, baseinfo, total_lumis)
+
+        if self.events_per_task:
+            if res.total_events > 0:
+                res.tasksize = int(math.ceil(self.events_per_task / float(res.total_events) * res.total_units))
             else:
-                res.tasksize = self.lumis_per_task
-
-            Dataset.__dsets[self.dataset] = res
+                res.tasksize = 1
+        else:
+            res.tasksize = self.lumis_per_task
 
-        self.total_units = Dataset.__dsets[self.dataset].total_units
-        return Dataset.__dsets[self.dataset]
+        self.total_units = res.total_units
+        return res
 
     def query_database(self):
         cred = Proxy({'logger': logging.getLogger("WMCore")})
@@ -162,43 +196,25 @@ class Dataset(Configurable):
         if baseinfo is None or (len(baseinfo) == 1 and baseinfo[0] is None):
             raise ValueError('unable to retrive information for dataset {}'.format(self.dataset))
 
-        if not self.file_based:
-            result = self.__cache.cached(self.dataset, self.lumi_mask, baseinfo)
-            if result:
-                return result
         total_lumis = sum([info['num_lumi'] for info in baseinfo])
+        total_events = sum([info['num_event'] for info in baseinfo])
+        return baseinfo, total_lumis, total_events
 
-        result = DatasetInfo()
-        result.total_events = sum([info['num_event'] for info in baseinfo])
-
-        for info in dbs.listFiles(dataset=self.dataset, detail=True):
-            fn = info['logical_file_name']
-            result.files[fn].events = info['event_count']
-            result.files[fn].size = info['file_size']
-
+    def __files(self, result, baseinfo, total_lumis):
         if self.file_based:
-            for info in dbs.listFiles(dataset=self.dataset):
-                fn = info['logical_file_name']
-                result.files[fn].lumis = [(-2, -2)]
+            files = self.query_files()
         else:
-            blocks = dbs.listBlocks(dataset=self.dataset)
-            if self.lumi_mask:
-                unmasked_lumis = LumiList(filename=self.lumi_mask)
-            for block in blocks:
-                runs = dbs.listFileLumis(block_name=block['block_name'])
-                for run in runs:
-                    fn = run['logical_file_name']
-                    for lumi in run['lumi_section_num']:
-                        if not self.lumi_mask or ((run['run_num'], lumi) in unmasked_lumis):
-                            result.files[fn].lumis.append((run['run_num'], lumi))
-                        elif self.lumi_mask and ((run['run_num'], lumi) not in unmasked_lumis):
-                            result.masked_units += 1
+            files = self.__cache.cached(self.dataset, self.lumi_mask, baseinfo)
+            if files is None:
+                files = self.__cache.cache(self.dataset, self.lumi_mask, baseinfo, self.query_files())
 
-        result.unmasked_units = sum([len(f.lumis) for f in result.files.values()])
-        result.total_units = result.unmasked_units + result.masked_units
+        for fn, info, masked in files:
+            result.unmasked_units += len(info.lumis)
+            result.masked_units += masked
+            yield fn, info
 
-        if not self.file_based:
-            self.__cache.cache(self.dataset, self.lumi_mask, baseinfo, result)
+        result.total_units = result.unmasked_units + result.masked_units
+        self.total_units = result.total_units
 
         result.stop_on_file_boundary = (result.total_units != total_lumis)
         if result.stop_on_file_boundary:
@@ -207,4 +223,49 @@ class Dataset(Configurable):
                          "{} unique (run, lumi, file) - "
                          "enforcing a limit of one file per task".format(self.dataset, total_lumis, result.total_units))
 
-        return result
+    def query_files(self):
+        """Query the files of the dataset block by block.
+
+        Yields
+        ------
+            filename : str
+                The logical filename.
+            info : FileInfo
+                The information about the file.
+            masked : int
+                The number of luminosity sections of the file excluded by
+                the lumi mask.
+        """
+        cred = Proxy({'logger': logging.getLogger("WMCore")})
+        dbs = DASWrapper(self.dbs_instance, ca_info=cred.getProxyFilename())
+
+        if self.lumi_mask:
+            unmasked_lumis = LumiList(filename=self.lumi_mask)
+
+        for block in dbs.listBlocks(dataset=self.dataset, detail=True):
+            files = defaultdict(FileInfo)
+            masked = defaultdict(int)
+
+            for info in dbs.listFiles(block_name=block['block_name'], detail=True):
+                fn = info['logical_file_name']
+                files[fn].events = info['event_count']
+                files[fn].size = info['file_size']
+                # Files of a block are stored together, at the site the
+                # block originates from
+                files[fn].location = block['origin_site_name']
+
+            if self.file_based:
+                for fn in files:
+                    files[fn].lumis = [(-2, -2)]
+            else:
+                runs = dbs.listFileLumis(block_name=block['block_name'])
+                for run in runs:
+                    fn = run['logical_file_name']
+                    for lumi in run['lumi_section_num']:
+                        if not self.lumi_mask or ((run['run_num'], lumi) in unmasked_lumis):
+                            files[fn].lumis.append((run['run_num'], lumi))
+                        elif self.lumi_mask and ((run['run_num'], lumi) not in unmasked_lumis):
+                            masked[fn] += 1
+
+            for fn in sorted(files):
+                yield fn, files[fn], masked[fn]
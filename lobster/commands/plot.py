@@ -3,7 +3,6 @@
 from collections import defaultdict, Counter
 from cycler import cycler
 from datetime import datetime
-import glob
 import gzip
 import itertools
 import jinja2
@@ -12,12 +11,10 @@ import multiprocessing
 import os
 import pickle
 import shutil
-import sqlite3
 import signal
 import time
 import re
 import string
-import json
 
 import matplotlib
 matplotlib.use('Agg')
@@ -30,6 +27,7 @@ from scipy.interpolate import UnivariateSpline
 from lobster import util
 from lobster.core import unit
 from lobster.core.command import Command
+from lobster.monitor import statslog
 
 from WMCore.DataStructs.LumiList import LumiList
 
@@ -382,7 +380,7 @@ class Plotter(object):
     def __init__(self, config, outdir=None, paper=False):
         self.config = config
         self.__paper = paper
-        self.__store = unit.UnitStore(config)
+        self.__store = None
 
         util.verify(self.config.workdir)
 
@@ -419,8 +417,8 @@ class Plotter(object):
 
     def readdb(self):
         logger.debug('reading database')
-        db = sqlite3.connect(os.path.join(
-            self.config.workdir, 'lobster.db'), timeout=90)
+        self.__store = unit.UnitStore(self.config, snapshot=True)
+        db = self.__store.db
 
         self.wflow_ids = {}
         self.wflow_labels = {}
@@ -455,34 +453,38 @@ class Plotter(object):
         start_units = 0
         completed_units = []
         units_processed = {}
-        transfers = {}
         for (label,) in db.execute("select label from workflows"):
+            width = self.__store.width(label)
             total_units += db.execute(
-                "select count(*) from units_{0}".format(label)).fetchone()[0]
+                "select ifnull(sum({1}), 0) from units_{0}".format(label, width)).fetchone()[0]
             start_units += db.execute("""
-                select count(*)
+                select ifnull(sum({1}), 0)
                 from units_{0}, tasks
                 where units_{0}.task == tasks.id
                     and (units_{0}.status=2 or units_{0}.status=6)
-                    and time_retrieved<=?""".format(label), (self.__xmin,)).fetchone()[0]
-            completed_units.append(np.array(db.execute("""
-                select units_{0}.id, tasks.time_retrieved
+                    and time_retrieved<=?""".format(label, width), (self.__xmin,)).fetchone()[0]
+            completed = db.execute("""
+                select units_{0}.id, tasks.time_retrieved, {1}
                 from units_{0}, tasks
                 where units_{0}.task == tasks.id
                     and (units_{0}.status=2 or units_{0}.status=6)
-                    and time_retrieved>=? and time_retrieved<=?""".format(label),
-                                                       (self.__xmin, self.__xmax)).fetchall(),
-                                            dtype=[('id', 'i4'), ('time_retrieved', 'i4')]))
-            units_processed[label] = db.execute("""
+                    and time_retrieved>=? and time_retrieved<=?""".format(label, width),
+                                   (self.__xmin, self.__xmax)).fetchall()
+            # units stored as lumi ranges count once for every lumi
+            completed_units.append(np.repeat(
+                np.array([(id, time) for (id, time, _) in completed], dtype=[('id', 'i4'), ('time_retrieved', 'i4')]),
+                np.array([n for (_, _, n) in completed], dtype=int)))
+            processed = db.execute("""
                 select units_{0}.run,
-                units_{0}.lumi
+                units_{0}.lumi,
+                {1}
                 from units_{0}, tasks
                 where units_{0}.task == tasks.id
-                    and (units_{0}.status in (2, 6))""".format(label)).fetchall()
-            transfers[label] = json.loads(db.execute("""
-                select transfers
-                from workflows
-                where label=?""", (label,)).fetchone()[0])
+                    and (units_{0}.status in (2, 6))""".format(label, self.__store.last_lumi(label)))
+            units_processed[label] = [(run, lumi) for (run, first, last) in processed for lumi in range(first, last + 1)]
+
+        transfers = self.__store.transfer_totals()
+        self.__transfer_history = self.__store.transfer_history(self.__xmin, self.__xmax)
 
         logger.debug('finished reading database')
 
@@ -493,30 +495,32 @@ class Plotter(object):
             fn = filename
         else:
             fn = os.path.join(self.config.workdir,
-                              'lobster_stats_{}.log'.format(category))
-
-        with open(fn) as f:
-            headers = dict(map(lambda (a, b): (b, a),
-                               enumerate(f.readline()[1:].split())))
-        stats = np.loadtxt(fn)
+                              'lobster_stats_{}.dat'.format(category))
+            if not os.path.exists(fn):
+                fn = os.path.join(self.config.workdir,
+                                  'lobster_stats_{}.log'.format(category))
+
+        if statslog.is_binary(fn):
+            columns, offset, count = statslog.layout(fn)
+            headers = dict((c, i) for (i, c) in enumerate(columns))
+            if count == 0:
+                stats = np.zeros((0, len(columns)))
+            else:
+                # copy-on-write, to adjust the values below in memory only
+                stats = np.memmap(fn, dtype=statslog.DTYPE, mode='c', offset=offset, shape=(count, len(columns)))
+        else:
+            with open(fn) as f:
+                headers = dict(map(lambda (a, b): (b, a),
+                                   enumerate(f.readline()[1:].split())))
+            stats = np.loadtxt(fn)
 
         # fix units of time
         stats[:, 0] /= 1e6
 
-        stats[:, headers['workers_joined']] = np.maximum(stats[:, headers[
-                                                         'workers_joined']] - np.roll(stats[:, headers['workers_joined']], 1, 0), 0)
-        stats[:, headers['workers_removed']] = np.maximum(stats[:, headers[
-                                                          'workers_removed']] - np.roll(stats[:, headers['workers_removed']], 1, 0), 0)
-        stats[:, headers['workers_lost']] = np.maximum(
-            stats[:, headers['workers_lost']] - np.roll(stats[:, headers['workers_lost']], 1, 0), 0)
-        stats[:, headers['workers_idled_out']] = np.maximum(stats[:, headers[
-                                                            'workers_idled_out']] - np.roll(stats[:, headers['workers_idled_out']], 1, 0), 0)
-        stats[:, headers['workers_fast_aborted']] = np.maximum(stats[:, headers[
-                                                               'workers_fast_aborted']] - np.roll(stats[:, headers['workers_fast_aborted']], 1, 0), 0)
-        stats[:, headers['workers_blacklisted']] = np.maximum(stats[:, headers[
-                                                              'workers_blacklisted']] - np.roll(stats[:, headers['workers_blacklisted']], 1, 0), 0)
-        stats[:, headers['workers_released']] = np.maximum(stats[:, headers[
-                                                           'workers_released']] - np.roll(stats[:, headers['workers_released']], 1, 0), 0)
+        # turn cumulative counts into counts per entry
+        workers = [headers[k] for k in ['workers_joined', 'workers_removed', 'workers_lost', 'workers_idled_out',
+                                        'workers_fast_aborted', 'workers_blacklisted', 'workers_released']]
+        stats[:, workers] = np.maximum(stats[:, workers] - np.roll(stats[:, workers], 1, 0), 0)
 
         if not filename and category == 'all':
             self.__total_xmin = stats[0, 0]
@@ -556,8 +560,10 @@ class Plotter(object):
 
     def savelogs(self, failed_tasks, samples=10):
         logdir = os.path.join(self.__plotdir, 'logs')
+        moved = self.config.advanced.move_taskdirs
         work = []
         codes = {}
+        workflows = dict(zip(failed_tasks['id'], failed_tasks['workflow']))
 
         for exit_code, tasks in zip(*split_by_column(failed_tasks[['id', 'exit_code']], 'exit_code')):
             if exit_code == 0:
@@ -568,12 +574,7 @@ class Plotter(object):
             logger.info(
                 "Copying sample logs for exit code {0}".format(exit_code))
             for id, e in list(tasks[-samples:]):
-                try:
-                    source = glob.glob(os.path.join(
-                        self.config.workdir, '*', 'failed', util.id2dir(id)))[0]
-                except IndexError:
-                    continue
-
+                source = util.taskpath(os.path.join(self.config.workdir, self.wflow_labels[workflows[id]]), id, 'failed', moved)
                 s = os.path.join(source, 'task.log.gz')
                 t = os.path.join(logdir, str(id) + '.log')
                 if os.path.exists(s):
@@ -588,8 +589,7 @@ class Plotter(object):
             skipped = self.__store.skipped_files(label)
 
             for id in failed:
-                source = os.path.join(
-                    self.config.workdir, label, 'failed', util.id2dir(id))
+                source = util.taskpath(os.path.join(self.config.workdir, label), id, 'failed', moved)
                 target = os.path.join(logdir, 'failed_' + label)
                 if not os.path.exists(target):
                     os.makedirs(target)
@@ -787,6 +787,39 @@ class Plotter(object):
 
         return res
 
+    def make_transfer_plots(self, subdir, labels):
+        rates = defaultdict(lambda: defaultdict(Counter))
+        for label, protocol, outcome, time_bin, count in self.__transfer_history:
+            direction, _, result = outcome.rpartition(' ')
+            if label in labels and direction in ('stage-in', 'stageout'):
+                rates[(direction, protocol)][time_bin + unit.TRANSFER_BIN / 2][result] += count
+
+        if len(rates) == 0:
+            return False
+
+        for direction in ('stage-in', 'stageout'):
+            data = []
+            protocols = []
+            for (d, protocol), counts in sorted(rates.items()):
+                if d != direction:
+                    continue
+                times = sorted(counts.keys())
+                data.append((np.array(times), np.array([
+                    counts[t]['success'] / float(counts[t]['success'] + counts[t]['failure']) for t in times])))
+                protocols.append(protocol)
+
+            if len(data) == 0:
+                continue
+
+            self.plot(
+                data,
+                '{} success rate'.format(direction.capitalize()), os.path.join(subdir, '{}-success'.format(direction)),
+                modes=[Plotter.PLOT | Plotter.TIME],
+                label=protocols
+            )
+
+        return True
+
     def make_time_fraction_plot(self, category):
         headers, stats = self.__category_stats[category]
 
@@ -795,7 +828,8 @@ class Plotter(object):
             'time_internal', 'time_polling', 'time_application'
         ]
         lobster_labels = ['status', 'create', 'action', 'update', 'fetch', 'return']
-        return_labels = ['dash', 'handler', 'updates', 'elk', 'transfers', 'cleanup', 'propagate', 'sqlite']
+        return_labels = [l for l in ['dash', 'handler', 'updates', 'elk', 'cleanup', 'propagate', 'sqlite', 'wait']
+                         if 'total_source_{}_time'.format(l) in headers]
 
         times = stats[:, headers['timestamp']]
         centers = ((times + np.roll(times, 1, 0)) * 0.5)[1:]
@@ -1393,7 +1427,8 @@ class Plotter(object):
                 bad_hosts=self.find_failure_hosts(failed_tasks),
                 foremen=foremen_names,
                 categories=categories,
-                transfers=self.merge_transfers(transfers, labels)
+                transfers=self.merge_transfers(transfers, labels),
+                transfer_plots=self.make_transfer_plots('all', labels)
             ).encode('utf-8'))
 
         def add_total(summaries):
@@ -1454,7 +1489,8 @@ class Plotter(object):
                     bad_hosts=self.find_failure_hosts(wf_failed_tasks),
                     foremen=foremen_names,
                     categories=categories,
-                    transfers=self.merge_transfers(transfers, labels)
+                    transfers=self.merge_transfers(transfers, labels),
+                    transfer_plots=self.make_transfer_plots(label, labels)
                 ).encode('utf-8'))
 
         # Add the total from the unit store query
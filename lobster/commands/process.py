@@ -15,6 +15,7 @@ from lobster import actions, util
 from lobster.commands.status import Status
 from lobster.core.command import Command
 from lobster.core.source import TaskProvider
+from lobster.monitor import statslog
 
 import work_queue as wq
 
@@ -45,8 +46,26 @@ class Terminate(Command):
 
 class Process(Command, util.Timing):
 
+    # Time in seconds between runs of the stages of the main loop
+    intervals = {
+        'action': 60,
+        'create': 60,
+        'return': 15,
+        'status': 60,
+        'update': 60
+    }
+    # Time in seconds between task creation when the queue runs low
+    interval_create_minimum = 10
+    # Time in seconds to wait for WQ to return tasks before running the
+    # other stages again
+    interval_fetch = 5
+    # Number of returned tasks to release without waiting for the
+    # `return` interval
+    release_batch = 500
+
     def __init__(self):
         util.Timing.__init__(self, 'action', 'create', 'fetch', 'return', 'status', 'update')
+        self.__logs = {}
 
     @property
     def help(self):
@@ -60,42 +79,86 @@ class Process(Command, util.Timing):
         return ['configure']
 
     def setup_logging(self, category):
-        filename = os.path.join(self.config.workdir, "lobster_stats_{}.log".format(category))
+        filename = os.path.join(self.config.workdir, "lobster_stats_{}.dat".format(category))
         if not hasattr(self, 'log_attributes'):
             self.log_attributes = [m for (m, o) in inspect.getmembers(wq.work_queue_stats)
                                    if not inspect.isroutine(o) and not m.startswith('__')]
 
-        with open(filename, "a") as statsfile:
-            statsfile.write(
-                " ".join(
-                    ["#timestamp", "units_left"] +
-                    ["total_{}_time".format(k) for k in sorted(self.times.keys())] +
-                    ["total_source_{}_time".format(k) for k in sorted(self.source.times.keys())] +
-                    self.log_attributes
-                ) + "\n"
-            )
+        columns = (
+            ["timestamp", "units_left", "tasks_releasing"] +
+            ["total_{}_time".format(k) for k in sorted(self.times.keys())] +
+            ["total_source_{}_time".format(k) for k in sorted(self.source.times.keys())] +
+            ["total_sql_{}_time".format(k) for k in sorted(self.source.sql_times.keys())] +
+            ["dashboard_{}".format(k) for k in sorted(self.config.advanced.dashboard.counters.keys())] +
+            self.log_attributes
+        )
+
+        # convert the text logs of older versions
+        textfile = os.path.join(self.config.workdir, "lobster_stats_{}.log".format(category))
+        if os.path.exists(textfile) and not os.path.exists(filename):
+            logger.info("converting {0} to {1}".format(textfile, filename))
+            statslog.convert(textfile, filename, columns)
+
+        self.__logs[category] = statslog.StatsLog(filename, columns)
 
     def log(self, category, left):
-        filename = os.path.join(self.config.workdir, "lobster_stats_{}.log".format(category))
         if category == 'all':
             stats = self.queue.stats_hierarchy
         else:
             stats = self.queue.stats_category(category)
 
-        with open(filename, "a") as statsfile:
-            now = datetime.datetime.now()
-            statsfile.write(" ".join(map(str,
-                                         [int(int(now.strftime('%s')) * 1e6 + now.microsecond), left] +
-                                         [self.times[k] for k in sorted(self.times.keys())] +
-                                         [self.source.times[k] for k in sorted(self.source.times.keys())] +
-                                         [getattr(stats, a) for a in self.log_attributes]
-                                         )) + "\n"
-                            )
+        now = datetime.datetime.now()
+        self.__logs[category].write(
+            [int(int(now.strftime('%s')) * 1e6 + now.microsecond), left, self.source.releasing] +
+            [self.times[k] for k in sorted(self.times.keys())] +
+            [self.source.times[k] for k in sorted(self.source.times.keys())] +
+            [v for (k, v) in sorted(self.source.sql_times.items())] +
+            [v for (k, v) in sorted(self.config.advanced.dashboard.counters.items())] +
+            [getattr(stats, a) for a in self.log_attributes]
+        )
 
         if self.config.elk:
             stats = self.queue.stats_hierarchy
             self.config.elk.index_stats(now, left, self.times, self.log_attributes, stats, category)
 
+    def submit(self, tasks, retries, expiry=None):
+        """Submit tasks to WQ.
+
+        Parameters
+        ----------
+            tasks : list
+                The tasks to submit, as returned by
+                :meth:`~lobster.core.source.TaskProvider.obtain`.
+            retries : int
+                How often WQ should retry a task.
+            expiry : int
+                When the proxy expires, to end tasks at.
+        """
+        for category, cmd, id, inputs, outputs, env, dir in tasks:
+            task = wq.Task(cmd)
+            task.specify_category(category)
+            task.specify_tag(id)
+            task.specify_max_retries(retries)
+            task.specify_monitor_output(os.path.join(dir, 'resource_monitor'))
+
+            for k, v in env.items():
+                task.specify_environment_variable(k, v)
+
+            for (local, remote, cache) in inputs:
+                cache_opt = wq.WORK_QUEUE_CACHE if cache else wq.WORK_QUEUE_NOCACHE
+                if os.path.isfile(local) or os.path.isdir(local):
+                    task.specify_input_file(str(local), str(remote), cache_opt)
+                else:
+                    logger.critical("cannot send file to worker: {0}".format(local))
+                    raise NotImplementedError
+
+            for (local, remote) in outputs:
+                task.specify_output_file(str(local), str(remote))
+
+            if expiry:
+                task.specify_end_time(expiry * 10 ** 6)
+            self.queue.submit(task)
+
     def setup(self, argparser):
         argparser.add_argument('--finalize', action='store_true', default=False,
                                help='do not process any additional data; wrap project up by merging everything')
@@ -214,12 +277,6 @@ class Process(Command, util.Timing):
         if util.checkpoint(self.config.workdir, 'KILLED') == 'PENDING':
             util.register_checkpoint(self.config.workdir, 'KILLED', 'RESTART')
 
-        # time in seconds to wait for WQ to return tasks, with minimum wait
-        # time in case no more tasks are waiting
-        interval = 120
-        interval_minimum = 30
-
-        tasks_left = 0
         units_left = 0
         successful_tasks = 0
 
@@ -243,95 +300,94 @@ class Process(Command, util.Timing):
             if 'wall_time' not in constraints:
                 self.queue.activate_fast_abort_category(category.name, abort_multiplier)
 
+        # The stages of the main loop run on their own cadence, in between
+        # waiting for WQ to return tasks.  All stages run in this thread,
+        # since the WQ object may not be used from several ones.
+        last = dict((stage, 0) for stage in self.intervals)
+        returned = []
+
         proxy_email_sent = False
         while not self.source.done():
             with self.measure('status'):
-                tasks_left = self.source.tasks_left()
-                units_left = self.source.work_left()
-
-                logger.debug("expecting {0} tasks, still".format(tasks_left))
-                self.queue.specify_num_tasks_left(tasks_left)
-
-                for c in categories + ['all']:
-                    self.log(c, units_left)
-
                 if util.checkpoint(self.config.workdir, 'KILLED') == 'PENDING':
                     util.register_checkpoint(
                         self.config.workdir, 'KILLED', str(datetime.datetime.utcnow()))
 
                     # let the task source shut down gracefully
                     logger.info("terminating task source")
+                    self.source.release(returned)
                     self.source.terminate()
                     logger.info("terminating gracefully")
                     break
 
-            with self.measure('create'):
-                have = {}
-                for c in categories:
-                    cstats = self.queue.stats_category(c)
-                    have[c] = {'running': cstats.tasks_running, 'queued': cstats.tasks_waiting}
-
-                stats = self.queue.stats_hierarchy
-                tasks = self.source.obtain(stats.total_cores, have)
-
-                expiry = None
-                if self.config.advanced.proxy:
-                    expiry = self.config.advanced.proxy.expires()
-                    proxy_time_left = self.config.advanced.proxy.time_left()
-                    if proxy_time_left >= 24 * 3600:
-                        proxy_email_sent = False
-                    if proxy_time_left < 24 * 3600 and not proxy_email_sent:
-                        util.sendemail("Your proxy is about to expire.\n" + "Timeleft: " + str(datetime.timedelta(seconds=proxy_time_left)), self.config)
-                        proxy_email_sent = True
-
-                for category, cmd, id, inputs, outputs, env, dir in tasks:
-                    task = wq.Task(cmd)
-                    task.specify_category(category)
-                    task.specify_tag(id)
-                    task.specify_max_retries(wq_max_retries)
-                    task.specify_monitor_output(os.path.join(dir, 'resource_monitor'))
-
-                    for k, v in env.items():
-                        task.specify_environment_variable(k, v)
-
-                    for (local, remote, cache) in inputs:
-                        cache_opt = wq.WORK_QUEUE_CACHE if cache else wq.WORK_QUEUE_NOCACHE
-                        if os.path.isfile(local) or os.path.isdir(local):
-                            task.specify_input_file(str(local), str(remote), cache_opt)
-                        else:
-                            logger.critical("cannot send file to worker: {0}".format(local))
-                            raise NotImplementedError
-
-                    for (local, remote) in outputs:
-                        task.specify_output_file(str(local), str(remote))
-
-                    if expiry:
-                        task.specify_end_time(expiry * 10 ** 6)
-                    self.queue.submit(task)
-
-            with self.measure('status'):
-                stats = self.queue.stats_hierarchy
-                logger.info("{0} out of {1} workers busy; {2} tasks running, {3} waiting; {4} units left".format(
-                    stats.workers_busy,
-                    stats.workers_busy + stats.workers_ready,
-                    stats.tasks_running,
-                    stats.tasks_waiting,
-                    units_left))
+            now = time.time()
+            stats = self.queue.stats_hierarchy
 
-            with self.measure('update'):
-                self.source.update(self.queue)
+            if now - last['status'] >= self.intervals['status']:
+                last['status'] = now
+                with self.measure('status'):
+                    tasks_left = self.source.tasks_left()
+                    units_left = self.source.work_left()
+
+                    logger.debug("expecting {0} tasks, still".format(tasks_left))
+                    self.queue.specify_num_tasks_left(tasks_left)
+
+                    for c in categories + ['all']:
+                        self.log(c, units_left)
+                    for log in self.__logs.values():
+                        log.flush()
+                    self.source.dump_sql_profile()
+                    self.source.update_snapshot()
+
+                    logger.info("{0} out of {1} workers busy; {2} tasks running, {3} waiting; {4} units left".format(
+                        stats.workers_busy,
+                        stats.workers_busy + stats.workers_ready,
+                        stats.tasks_running,
+                        stats.tasks_waiting,
+                        units_left))
+
+            # create tasks regularly, and as soon as the queue runs low,
+            # with the same minimum of queued tasks as task creation
+            low = stats.tasks_waiting < max(int(0.1 * stats.total_cores), self.config.advanced.payload)
+            if now - last['create'] >= (self.interval_create_minimum if low else self.intervals['create']):
+                last['create'] = now
+                with self.measure('create'):
+                    have = {}
+                    for c in categories:
+                        cstats = self.queue.stats_category(c)
+                        have[c] = {'running': cstats.tasks_running, 'queued': cstats.tasks_waiting}
+
+                    tasks = self.source.obtain(stats.total_cores, have)
+
+                    expiry = None
+                    if self.config.advanced.proxy:
+                        expiry = self.config.advanced.proxy.expires()
+                        proxy_time_left = self.config.advanced.proxy.time_left()
+                        if proxy_time_left >= 24 * 3600:
+                            proxy_email_sent = False
+                        if proxy_time_left < 24 * 3600 and not proxy_email_sent:
+                            util.sendemail("Your proxy is about to expire.\n" + "Timeleft: " + str(datetime.timedelta(seconds=proxy_time_left)), self.config)
+                            proxy_email_sent = True
+
+                    self.submit(tasks, wq_max_retries, expiry)
+
+            if now - last['update'] >= self.intervals['update']:
+                last['update'] = now
+                with self.measure('update'):
+                    self.source.update(self.queue)
 
             # recurring actions are triggered here; plotting etc should run
             # while we have WQ hand us back tasks w/o any database
             # interaction
-            with self.measure('action'):
-                if action:
-                    action.take()
+            if now - last['action'] >= self.intervals['action']:
+                last['action'] = now
+                with self.measure('action'):
+                    if action:
+                        action.take()
 
             with self.measure('fetch'):
                 starttime = time.time()
-                task = self.queue.wait(interval)
-                tasks = []
+                task = self.queue.wait(self.interval_fetch)
                 while task:
                     if task.return_status == 0:
                         successful_tasks += 1
@@ -339,10 +395,10 @@ class Process(Command, util.Timing):
                         logger.warning(
                             "blacklisting host {0} due to bad exit code from task {1}".format(task.hostname, task.tag))
                         self.queue.blacklist(task.hostname)
-                    tasks.append(task)
+                    returned.append(task)
 
-                    remaining = int(starttime + interval - time.time())
-                    if (interval - remaining < interval_minimum or self.queue.stats.tasks_waiting > 0) and remaining > 0:
+                    remaining = int(starttime + self.interval_fetch - time.time())
+                    if remaining > 0:
                         task = self.queue.wait(remaining)
                     else:
                         task = None
@@ -353,18 +409,30 @@ class Process(Command, util.Timing):
                         "activating fast abort with multiplier: {0}".format(abort_multiplier))
                     abort_active = True
                     self.queue.activate_fast_abort(abort_multiplier)
-            if len(tasks) > 0:
+
+            # hand returned tasks to the release pipeline in batches; also
+            # commits tasks released in the background meanwhile
+            now = time.time()
+            if len(returned) >= self.release_batch or \
+                    (now - last['return'] >= self.intervals['return'] and (returned or self.source.releasing > 0)):
+                last['return'] = now
                 try:
                     with self.measure('return'):
-                        self.source.release(tasks)
+                        self.source.release(returned)
                 except Exception:
                     tb = traceback.format_exc()
                     logger.critical("cannot recover from the following exception:\n" + tb)
                     util.sendemail("Your Lobster project has crashed from the following exception:\n" + tb, self.config)
-                    for task in tasks:
+                    for task in returned:
                         logger.critical(
                             "tried to return task {0} from {1}".format(task.tag, task.hostname))
                     raise
+                returned = []
+
+        for log in self.__logs.values():
+            log.close()
+
+        units_left = self.source.work_left()
         if units_left == 0:
             logger.info("no more work left to do")
             util.sendemail("Your Lobster project is done!", self.config)
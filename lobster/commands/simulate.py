@@ -0,0 +1,441 @@
+from collections import defaultdict, deque
+import ast
+import bisect
+import heapq
+import logging
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from lobster import util
+from lobster.core import Algo
+from lobster.core.command import Command
+from lobster.core.dataset import DatasetInfo, FileInfo
+from lobster.core.unit import TaskUpdate, UnitStore
+from lobster.monitor import statslog
+
+logger = logging.getLogger('lobster.simulate')
+
+
+def percentile(values, fraction):
+    """Return the value below which `fraction` of the sorted `values` lie.
+    """
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Pool(object):
+
+    """Cores available over time, as recorded in the statistics log.
+
+    Parameters
+    ----------
+        workdir : str
+            The working directory of the project to read the statistics
+            log `lobster_stats_all` from.
+        cores : int or None
+            A fixed number of cores to use instead of the recorded ones.
+    """
+
+    def __init__(self, workdir, cores=None):
+        self.__times = []
+        self.__cores = []
+
+        if cores is not None:
+            self.__times.append(0)
+            self.__cores.append(cores)
+            return
+
+        filename = os.path.join(workdir, 'lobster_stats_all.dat')
+        if not os.path.exists(filename):
+            filename = os.path.join(workdir, 'lobster_stats_all.log')
+
+        start = None
+        columns, records = statslog.read(filename)
+        if 'total_cores' in columns:
+            timestamp = columns.index('timestamp')
+            total = columns.index('total_cores')
+            for record in records:
+                # Not recorded by older versions
+                if math.isnan(record[total]):
+                    continue
+                now = record[timestamp] / 1e6
+                if start is None:
+                    start = now
+                self.__times.append(now - start)
+                self.__cores.append(int(record[total]))
+
+        if len(self.__times) == 0:
+            raise ValueError("no cores recorded in the statistics log")
+
+    def cores(self, t):
+        """The number of cores available at time `t` since the start.
+        """
+        return self.__cores[max(0, bisect.bisect_right(self.__times, t) - 1)]
+
+
+class Model(object):
+
+    """Task outcomes sampled from the tasks of a finished project.
+
+    Processing task runtimes and output sizes are sampled per unit, and
+    scaled to the number of units of a simulated task.  Merge task
+    runtimes are sampled as recorded.
+
+    Parameters
+    ----------
+        db : sqlite3.Connection
+            The database of the finished project.
+        seed : int
+            The seed of the random number generator.
+    """
+
+    def __init__(self, db, seed=1):
+        self.__random = random.Random(seed)
+        self.__runtimes = defaultdict(list)
+        self.__sizes = defaultdict(list)
+        self.__merges = defaultdict(list)
+        self.__failures = defaultdict(float)
+
+        rows = db.execute("""
+            select workflows.label, tasks.type, tasks.status, tasks.units, tasks.time_on_worker, tasks.bytes_bare_output
+            from tasks, workflows
+            where tasks.workflow=workflows.id and tasks.status in (2, 3, 6, 7, 8)""")
+        failed = defaultdict(int)
+        total = defaultdict(int)
+        for label, type, status, units, runtime, size in rows:
+            if type == 1:
+                if status != 3:
+                    self.__merges[label].append(runtime)
+                continue
+            total[label] += 1
+            if status == 3:
+                failed[label] += 1
+            elif units > 0:
+                self.__runtimes[label].append(runtime / float(units))
+                self.__sizes[label].append(size / float(units))
+        for label in total:
+            self.__failures[label] = failed[label] / float(total[label])
+
+    def labels(self):
+        return self.__runtimes.keys()
+
+    def sample(self, label, units, merge=False):
+        """Sample the outcome of a task.
+
+        Parameters
+        ----------
+            label : str
+                The workflow of the task.
+            units : int
+                The number of units processed by the task.
+            merge : bool
+                If the task is a merge task.
+
+        Returns
+        -------
+            failed : bool
+                If the task failed.
+            runtime : float
+                The time the task spends on the worker.
+            size : int
+                The size of the output of the task.
+        """
+        if merge:
+            return False, self.__random.choice(self.__merges[label] or [60]), 0
+        failed = self.__random.random() < self.__failures[label]
+        index = self.__random.randrange(len(self.__runtimes[label]))
+        return failed, units * self.__runtimes[label][index], int(units * self.__sizes[label][index])
+
+
+class Simulation(object):
+
+    """Replay a project against the task creation and unit store.
+
+    New tasks are created with :class:`~lobster.core.create.Algo` and the
+    :class:`~lobster.core.unit.UnitStore` every `interval`, as `lobster
+    process` does.  A stand-in queue starts waiting tasks whenever enough
+    cores are free, in order of creation.  Workers leaving evict the
+    tasks started last, which start over later.  Returned tasks are
+    released at the next round of task creation.
+
+    Parameters
+    ----------
+        config : Configuration
+            The configuration of the project, with the working directory
+            pointing to an empty scratch directory.
+        model : Model
+            The model of task outcomes.
+        pool : Pool
+            The cores available over time.
+        interval : int
+            The time between rounds of task creation, in seconds.
+    """
+
+    def __init__(self, config, model, pool, interval):
+        self.config = config
+        self.store = UnitStore(config)
+        self.model = model
+        self.pool = pool
+        self.interval = interval
+        self.algo = Algo(config)
+        self.epoch = int(time.time())
+        self.workflows = []
+
+        self.waiting = deque()
+        self.running = []
+        self.returned = []
+        self.busy = 0
+        self.cores = 0
+
+        self.created = 0
+        self.evicted = 0
+        self.finished = []
+        self.latencies = []
+        self.core_time = 0
+        self.busy_time = 0
+
+    def register(self, label, db):
+        """Register the units of a workflow as found in the database of
+        the finished project.
+        """
+        wflow = getattr(self.config.workflows, label)
+        # Projects of older versions of Lobster never store units as ranges
+        ranges = 'unit_ranges' in [row[1] for row in db.execute("pragma table_info(workflows)")]
+        file_based, tasksize, taskruntime, stop, ranged = db.execute("""
+            select file_based, tasksize, taskruntime, stop_on_file_boundary, {0}
+            from workflows where label=?""".format('unit_ranges' if ranges else '0'), (label,)).fetchone()
+
+        info = DatasetInfo()
+        info.file_based = file_based
+        info.tasksize = tasksize
+        info.stop_on_file_boundary = stop
+
+        files = {}
+        for id, filename, events, size in db.execute("select id, filename, events, bytes from files_{0}".format(label)):
+            files[id] = FileInfo()
+            files[id].events = events
+            files[id].size = size
+            info.files[filename] = files[id]
+        # Every unit exists once per unique argument, possibly as
+        # differently split ranges
+        lumis = defaultdict(set)
+        columns = "run, lumi, last_lumi" if ranged else "run, lumi, lumi"
+        for id, run, first, last in db.execute("select file, {1} from units_{0}".format(label, columns)):
+            lumis[id].update((run, lumi) for lumi in range(first, last + 1))
+        for id, ls in lumis.items():
+            files[id].lumis = sorted(ls)
+        info.total_units = sum(len(f.lumis) for f in files.values())
+        info.total_events = sum(f.events for f in files.values())
+
+        self.store.register_dataset(wflow, info, taskruntime)
+        self.workflows.append(wflow)
+
+    def cycle(self, now):
+        """Release returned tasks and create new ones.
+        """
+        self.release(now)
+
+        queued = defaultdict(lambda: {'running': 0, 'queued': 0})
+        for (_, _, task) in self.running:
+            queued[task['category']]['running'] += 1
+        for task in self.waiting:
+            queued[task['category']]['queued'] += 1
+
+        taskinfos = []
+        for wflow in self.workflows:
+            taskinfos += self.store.pop_unmerged_tasks(wflow.label, wflow.merge_size, 10)
+
+        remaining = dict((wflow, self.store.work_left(wflow.label)) for wflow in self.workflows)
+        throughput = None
+        if self.config.advanced.forecast:
+            throughput = self.store.throughput(self.epoch + now - self.algo.window)
+        for label, ntasks, taper in self.algo.run(self.cores, queued, remaining, throughput, self.epoch + now):
+            taskinfos += self.store.pop_units(label, ntasks, taper)
+
+        for (id, label, files, lumis, arg, merge) in taskinfos:
+            wflow = getattr(self.config.workflows, label)
+            category = 'merge' if merge else wflow.category.name
+            cores = 1 if merge else (wflow.category.cores or 1)
+            failed, runtime, size = self.model.sample(label, len(lumis), merge)
+            self.waiting.append({
+                'id': id,
+                'category': category,
+                'cores': cores,
+                'created': now,
+                'failed': failed,
+                'runtime': runtime,
+                'size': size,
+                'handler': wflow.handler(id, files, lumis, None, merge),
+                'files': files,
+                'lumis': lumis
+            })
+        self.created += len(taskinfos)
+
+    def release(self, now):
+        updates = defaultdict(list)
+        for (end, task) in self.returned:
+            handler = task['handler']
+            task_update = TaskUpdate(host='simulation', id=task['id'])
+            task_update.time_retrieved = self.epoch + int(end)
+            task_update.time_on_worker = int(task['runtime'])
+            task_update.bytes_bare_output = task['size']
+            files_info = {}
+            if not task['failed']:
+                for (fid, fn) in task['files']:
+                    files_info[fn] = (0, [(r, l) for (_, f, r, l) in task['lumis'] if f == fid])
+            file_update, unit_update = handler.get_unit_info(task['failed'], task_update, files_info, [], 0)
+            updates[(handler.dataset, handler.unit_source)].append((task_update, file_update, unit_update))
+            self.latencies.append(end - task['created'])
+            if task['category'] != 'merge':
+                self.finished.append(end)
+        if len(updates) > 0:
+            self.store.update_units(updates)
+        self.returned = []
+
+    def schedule(self, now):
+        """Evict tasks exceeding the available cores, and start waiting
+        tasks on free cores.
+        """
+        while self.busy > self.cores and len(self.running) > 0:
+            latest = max(self.running, key=lambda (end, start, task): start)
+            self.running.remove(latest)
+            heapq.heapify(self.running)
+            self.busy -= latest[2]['cores']
+            self.waiting.appendleft(latest[2])
+            self.evicted += 1
+        while len(self.waiting) > 0 and self.busy + self.waiting[0]['cores'] <= self.cores:
+            task = self.waiting.popleft()
+            heapq.heappush(self.running, (now + task['runtime'], now, task))
+            self.busy += task['cores']
+
+    def advance(self, now, until):
+        """Run tasks from `now` until `until`.
+        """
+        while now < until:
+            end = min(until, self.running[0][0]) if len(self.running) > 0 else until
+            self.core_time += self.cores * (end - now)
+            self.busy_time += self.busy * (end - now)
+            now = end
+            while len(self.running) > 0 and self.running[0][0] <= now:
+                (end, _, task) = heapq.heappop(self.running)
+                self.busy -= task['cores']
+                self.returned.append((end, task))
+            self.schedule(now)
+
+    def run(self, limit):
+        """Simulate until all work is done or stalled, or `limit` seconds
+        have passed.
+
+        Returns
+        -------
+            makespan : float
+                The time at which the last task was released.
+            complete : bool
+                If all work was done.
+        """
+        now = 0
+        while now < limit:
+            self.cores = self.pool.cores(now)
+            self.cycle(now)
+            self.schedule(now)
+            if self.store.unfinished_units() == 0 and self.store.merged() and \
+                    len(self.running) == len(self.waiting) == len(self.returned) == 0:
+                return now, True
+            if len(self.running) == len(self.waiting) == len(self.returned) == 0 and self.cores > 0:
+                logger.warning("no more tasks can be created, stopping")
+                return now, False
+            self.advance(now, now + self.interval)
+            now += self.interval
+        return now, False
+
+
+class Simulate(Command):
+
+    @property
+    def help(self):
+        return 'replay a finished project to evaluate task creation settings'
+
+    def setup(self, argparser):
+        argparser.add_argument('--interval', type=int, default=60,
+                               help='seconds between rounds of task creation')
+        argparser.add_argument('--cores', type=int, default=None,
+                               help='use a fixed number of cores instead of the recorded ones')
+        argparser.add_argument('--seed', type=int, default=1,
+                               help='seed for sampling task outcomes')
+        argparser.add_argument('--limit', type=float, default=30,
+                               help='maximum time to simulate, in days')
+        argparser.add_argument('--set', action='append', default=[], metavar='SETTING=VALUE', dest='settings',
+                               help='override a setting for the simulation, e.g., advanced.payload=100, '
+                               'category.<name>.tasks_max=50, or workflow.<label>.merge_size=-1')
+
+    def override(self, config, setting):
+        """Apply a setting of the form `advanced.payload=10` to the
+        configuration.
+        """
+        path, value = setting.split('=', 1)
+        path = path.split('.')
+        if path[0] == 'advanced' and len(path) == 2:
+            obj = config.advanced
+        elif path[0] == 'category' and len(path) == 3:
+            obj = dict((c.name, c) for c in config.categories)[path[1]]
+        elif path[0] == 'workflow' and len(path) == 3:
+            obj = getattr(config.workflows, path[1])
+        else:
+            raise ValueError("can't apply setting {0}".format(setting))
+        if not hasattr(obj, path[-1]):
+            raise ValueError("unknown setting {0}".format(setting))
+        with util.PartiallyMutable.unlock():
+            setattr(obj, path[-1], ast.literal_eval(value))
+
+    def run(self, args):
+        config = args.config
+        workdir = config.workdir
+        for setting in args.settings:
+            self.override(config, setting)
+        db = sqlite3.connect(os.path.join(workdir, 'lobster.db'))
+        model = Model(db, args.seed)
+        pool = Pool(workdir, args.cores)
+
+        scratch = tempfile.mkdtemp()
+        with util.PartiallyMutable.unlock():
+            config.workdir = scratch
+        try:
+            simulation = Simulation(config, model, pool, args.interval)
+            for wflow in config.workflows:
+                if wflow.parent:
+                    logger.warning("dependent workflow {0} is not simulated".format(wflow.label))
+                elif wflow.label not in model.labels():
+                    logger.warning("no finished tasks to sample for {0}, skipping".format(wflow.label))
+                else:
+                    simulation.register(wflow.label, db)
+
+            start = time.time()
+            makespan, complete = simulation.run(args.limit * 24 * 3600)
+            simulation.store.disconnect()
+            self.report(simulation, makespan, complete, time.time() - start)
+        finally:
+            with util.PartiallyMutable.unlock():
+                config.workdir = workdir
+            shutil.rmtree(scratch)
+
+    def report(self, simulation, makespan, complete, duration):
+        latencies = sorted(simulation.latencies)
+        finished = sorted(simulation.finished)
+        tail = makespan - percentile(finished, .95) if finished else 0
+        utilization = simulation.busy_time / float(simulation.core_time) if simulation.core_time else 0
+
+        logger.info("simulated {0:.1f} h in {1:.1f} s{2}".format(
+            makespan / 3600., duration, "" if complete else ", work left unfinished"))
+        logger.info("{0} tasks created, {1} evicted".format(simulation.created, simulation.evicted))
+        logger.info("makespan: {0:.1f} h".format(makespan / 3600.))
+        logger.info("core utilization: {0:.1%}".format(utilization))
+        logger.info("task latency: median {0:.0f} s, 95% {1:.0f} s, 99% {2:.0f} s, max {3:.0f} s".format(
+            percentile(latencies, .5), percentile(latencies, .95), percentile(latencies, .99),
+            latencies[-1] if latencies else 0))
+        logger.info("tail: last 5% of processing tasks took {0:.1f} h".format(tail / 3600.))
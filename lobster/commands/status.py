@@ -12,12 +12,24 @@ class Status(Command):
         return 'show a workflow status summary'
 
     def setup(self, argparser):
-        pass
+        argparser.add_argument('--verify-counters', action='store_true', dest='verify_counters', default=False,
+                               help='recount all units to verify (and correct) the workflow accounting')
 
     def run(self, args):
         config = args.config
         logger = logging.getLogger('lobster.status')
-        store = unit.UnitStore(config)
+        verify = getattr(args, 'verify_counters', False)
+        store = unit.UnitStore(config, snapshot=not verify)
+        if store.readonly:
+            logger.info("reading database snapshot taken {0:.0f} s ago".format(store.age()))
+
+        if verify:
+            mismatches = store.verify_counters()
+            if len(mismatches) == 0:
+                logger.info("unit counters are consistent")
+            for label, counter, stored, actual in mismatches:
+                logger.warning("corrected {0} of {1}: stored {2}, counted {3}".format(counter, label, stored, actual))
+
         data = list(store.workflow_status())
 
         widths = \
@@ -42,8 +54,7 @@ class Status(Command):
             if len(tasks) > 0:
                 msg = "tasks with failed units for {0}:".format(wflow.label)
                 for task in tasks:
-                    tdir = os.path.normpath(os.path.join(
-                        wdir, wflow.label, 'failed', util.id2dir(task)))
+                    tdir = util.taskpath(os.path.join(wdir, wflow.label), task, 'failed', config.advanced.move_taskdirs)
                     msg += "\n" + tdir
                 logger.info(msg)
 
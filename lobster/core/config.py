@@ -1,5 +1,6 @@
 import datetime
 import getpass
+import inspect
 import os
 import pickle
 
@@ -152,6 +153,8 @@ class AdvancedOptions(Configurable):
 
     Attributes modifiable at runtime:
 
+    * `eta_target`
+    * `forecast`
     * `payload`
     * `threshold_for_failure`
     * `threshold_for_skipping`
@@ -176,27 +179,73 @@ class AdvancedOptions(Configurable):
             Produce core dumps.  Useful to debug `WorkQueue`.
         email : str
             The email address you want to receive emails from Lobster.
+        eta_target : int
+            When forecasting, the time in seconds tasks of workflows
+            running out of work should finish in.  Tasks are shrunk to
+            meet this target, but not smaller than needed to occupy the
+            available cores.
+        forecast : bool
+            Create only as many tasks as needed to fill the cores
+            predicted to become available before the next round of task
+            creation, based on how fast tasks finished and workers joined
+            recently.  Otherwise, keep at least `payload` tasks, and at
+            least 10% of the available cores, waiting in the queue in
+            addition to the running ones.
         full_monitoring : bool
             Produce full monitoring output.  Useful to debug `WorkQueue`.
+        locality : bool
+            Group units into tasks by the location of their files, i.e.,
+            the origin site of their block for datasets in DBS, or the
+            server in the file URL otherwise.  Tasks are spread over the
+            locations, and units of files not read by running tasks are
+            handed out first.  Reduces concurrent remote reads of the same
+            files and from the same sites.
         log_level : int
             How much logging output to show.  Goes from 1 to 5, where 1 is
             the most verbose (including a lot of debug output), and 5 is
             practically quiet.
+        move_taskdirs : bool
+            Move the directory of a returned task into `successful` or
+            `failed`.  When disabled, task directories stay in `tasks`
+            and the status of a task is only kept in the database, which
+            avoids renaming and removing directories on slow shared
+            filesystems.  Only applies to projects created with this
+            option set.
         osg_version : str
             The version of OSG you want lobster to run on.
         payload : int
             How many tasks to keep in the queue (minimum).  Note that the
             payload will increase with the number of cores available to
             Lobster.  This is just the minimum with no workers connected.
+        profile_sql : bool
+            Record statistics of every SQL statement executed.  These are
+            written to `sql_profile.json` in the working directory, and
+            the time spent in each part of the database interface is added
+            to the `lobster_stats` logs.
         proxy : :class:`~lobster.cmssw.Proxy`
             An authentication mechanism to access data.  Set to `False` to
             disable.
+        release_depth : int
+            How many returned tasks may wait to be processed by the
+            threads of `task_threads` before Lobster waits for them to
+            finish, instead of fetching more tasks.
+        task_threads : int
+            How many threads to use to create the directories and parameter
+            files of new tasks, and to process the reports of returned
+            tasks.  Set to 1 to create tasks in the main thread.
         threshold_for_failure : int
             How often a single unit may fail to be processed before Lobster
             will not attempt to process it any longer.
         threshold_for_skipping : int
             How often a single file may fail to be accessed before Lobster
             will not attempt to process it any longer.
+        unit_ranges : bool
+            Store consecutive lumis of a file as a single range in the
+            database, instead of one entry per lumi.  Ranges are split
+            when only some of their lumis are processed or fail, and
+            greatly reduce the size of the database for lumi-based
+            workflows.  Only applies to workflows created with this
+            option set.
         wq_max_retries : int
             How often `WorkQueue` will attempt to process a task before
             handing it back to Lobster.  `WorkQueue` will only reprocess
@@ -208,6 +257,8 @@ class AdvancedOptions(Configurable):
 
     _mutable = {
         'bad_exit_codes': (None, [], False),
+        'eta_target': (None, [], False),
+        'forecast': (None, [], False),
         'payload': (None, [], False),
         'threshold_for_failure': ('source.update_paused', [], False),
         'threshold_for_skipping': ('source.update_paused', [], False),
@@ -221,13 +272,21 @@ class AdvancedOptions(Configurable):
                  dashboard=None,
                  dump_core=False,
                  email=None,
+                 eta_target=1800,
+                 forecast=False,
                  full_monitoring=False,
+                 locality=False,
                  log_level=2,
+                 move_taskdirs=True,
                  osg_version=None,
                  payload=10,
+                 profile_sql=False,
                  proxy=None,
+                 release_depth=2000,
+                 task_threads=4,
                  threshold_for_failure=30,
                  threshold_for_skipping=30,
+                 unit_ranges=False,
                  wq_max_retries=10,
                  xrootd_servers=None):
         from lobster import cmssw
@@ -250,11 +309,27 @@ class AdvancedOptions(Configurable):
             self.dashboard = cmssw.Monitor()
         self.dump_core = dump_core
         self.email = email
+        self.eta_target = eta_target
+        self.forecast = forecast
         self.full_monitoring = full_monitoring
+        self.locality = locality
         self.log_level = log_level
+        self.move_taskdirs = move_taskdirs
         self.payload = payload
+        self.profile_sql = profile_sql
         self.proxy = proxy if proxy is not None else cmssw.Proxy()
+        self.release_depth = release_depth
+        self.task_threads = task_threads
         self.threshold_for_failure = threshold_for_failure
         self.threshold_for_skipping = threshold_for_skipping
+        self.unit_ranges = unit_ranges
         self.wq_max_retries = wq_max_retries
         self.xrootd_servers = xrootd_servers if xrootd_servers else ['cmsxrootd.fnal.gov']
+
+    def __setstate__(self, state):
+        # Configurations pickled by earlier versions lack the options added
+        # since, which take their default values
+        argspec = inspect.getargspec(self.__init__)
+        for arg, default in zip(reversed(argspec.args), reversed(argspec.defaults)):
+            state.setdefault(arg, default)
+        self.__dict__.update(state)
@@ -1,7 +1,8 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 
 import logging
 import math
+import time
 
 logger = logging.getLogger('lobster.algo')
 
@@ -14,16 +15,111 @@ class Algo(object):
     created evenly for every category and every workflow in each category
     based on the remaining work per workflow and cores used.
 
+    When forecasting, the number of cores to fill is predicted from the
+    recent throughput of tasks, as described in `forecast`.
+
     Parameters
     ----------
         config : Configuration
             The Lobster configuration to use.
     """
 
+    # Time span in seconds to consider for the throughput of tasks and
+    # the change in available cores
+    window = 900
+
     def __init__(self, config):
         self.__config = config
+        self.__cores = deque()
+        self.__last = None
+
+    def forecast(self, total_cores, queued, throughput, now=None):
+        """Predict how many cores will become available in the next cycle.
+
+        The length of the next cycle is assumed to be the same as the time
+        since the last call.  Cores become available as they are idle, as
+        running tasks finish at the rate they did within the last
+        `window`, and as workers join at the rate they did within the
+        same span.  Cores are shared between categories, so only the total
+        is predicted.
+
+        Parameters
+        ----------
+            total_cores : int
+                The number of cores that `WorkQueue` currently is in
+                control of.
+            queued : dict
+                The tasks in the queue per category, see `run`.
+            throughput : dict
+                The recent task throughput per workflow, as returned by
+                :meth:`~lobster.core.unit.UnitStore.throughput`.
+            now : float
+                The current time, defaults to the time of the call.
 
-    def run(self, total_cores, queued, remaining):
+        Returns
+        -------
+            cores : int
+                The number of cores to fill with new tasks, including the
+                ones already filled with queued tasks.
+        """
+        now = now or time.time()
+        horizon = now - self.__last if self.__last else 60.
+        self.__last = now
+
+        self.__cores.append((now, total_cores))
+        while self.__cores[0][0] < now - self.window:
+            self.__cores.popleft()
+        (then, before) = self.__cores[0]
+        growth = 0
+        if now > then:
+            growth = max(0, (total_cores - before) * horizon / (now - then))
+
+        retrieved = defaultdict(int)
+        for wflow in self.__config.workflows:
+            retrieved[wflow.category.name] += throughput.get(wflow.label, (0, None))[0]
+
+        busy = 0
+        freed = 0
+        for category in self.__config.categories:
+            running = queued.get(category.name, {}).get('running', 0)
+            rate = retrieved[category.name] / float(self.window)
+            busy += running * (category.cores or 1)
+            freed += min(running, rate * horizon) * (category.cores or 1)
+        idle = max(0, total_cores - busy)
+
+        logger.debug("forecast for the next {0:.0f} s: {1} cores idle, {2:.0f} freed, {3:.0f} joining".format(
+            horizon, idle, freed, growth))
+
+        return int(math.ceil(idle + freed + growth))
+
+    def taper(self, tasks, needed, runtime):
+        """Calculate the task size taper from a completion time target.
+
+        Tasks are only shrunk when they would take longer than
+        `AdvancedOptions.eta_target` to finish, and no further than
+        needed to spread the available work over all `needed` tasks.
+
+        Parameters
+        ----------
+            tasks : float
+                How many tasks of default size can be created.
+            needed : int
+                How many tasks are needed to fill the available cores.
+            runtime : float or None
+                The recent mean runtime of a task of default size, `None`
+                if unknown.
+
+        Returns
+        -------
+            taper : float
+                The factor to scale the task size with.
+        """
+        spread = min(1., tasks / float(needed))
+        if runtime is None or runtime <= 0:
+            return spread
+        return max(spread, min(1., self.__config.advanced.eta_target / float(runtime)))
+
+    def run(self, total_cores, queued, remaining, throughput=None, now=None):
         """Run the task creation algorithm.
 
         If not enough tasks can be created for a workflow, the available
@@ -48,6 +144,9 @@ class Algo(object):
            7. Adjust task size taper based on available tasks and needed
               tasks
 
+        With `throughput` given, step 2 uses `forecast`, and the taper in
+        step 3.7 respects the completion time target, see `taper`.
+
         Parameters
         ----------
             total_cores : int
@@ -65,6 +164,12 @@ class Algo(object):
                 * if all units for the workflow are available
                 * how many units are left to process
                 * how many tasks can still be created with the default size
+            throughput : dict
+                The recent task throughput per workflow, as returned by
+                :meth:`~lobster.core.unit.UnitStore.throughput`, or `None`
+                to fill the cores without forecasting.
+            now : float
+                The current time, passed on to `forecast`.
 
         Returns
         -------
@@ -84,8 +189,12 @@ class Algo(object):
             workloads[wflow.category.name] += task_cores * tasks
 
         # How many cores we need to occupy: have at least 10% of the
-        # available cores provisioned with waiting work
-        fill_cores = total_cores + max(int(0.1 * total_cores), self.__config.advanced.payload)
+        # available cores provisioned with waiting work, or cover the cores
+        # predicted to become available
+        if throughput is None:
+            fill_cores = total_cores + max(int(0.1 * total_cores), self.__config.advanced.payload)
+        else:
+            fill_cores = max(self.forecast(total_cores, queued, throughput, now), self.__config.advanced.payload)
         total_workload = sum(workloads.values())
 
         if total_workload == 0:
@@ -117,7 +226,10 @@ class Algo(object):
 
             taper = 1.
             if tasks < needed_workflow_tasks and complete:
-                taper = min(1., tasks / float(needed_workflow_tasks))
+                if throughput is None:
+                    taper = min(1., tasks / float(needed_workflow_tasks))
+                else:
+                    taper = self.taper(tasks, needed_workflow_tasks, throughput.get(wflow.label, (0, None))[1])
 
             logger.debug(("creating tasks for {w.label} (category: {w.category.name}):\n" +
                           "\tcategory task limit: ({w.category.tasks_min}, {w.category.tasks_max})\n" +
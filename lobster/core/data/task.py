@@ -1057,6 +1057,13 @@ configfile = sys.argv[1]
 with open(configfile) as f:
     config = json.load(f)
 
+# Parameters shared between the tasks of a workflow are sent separately
+if 'template' in config:
+    with open(config.pop('template')) as f:
+        template = json.load(f)
+    template.update(config)
+    config = template
+
 atexit.register(send_final_dashboard_update, data, config, monalisa)
 atexit.register(write_report, data)
 atexit.register(write_zipfiles, data)
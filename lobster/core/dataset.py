@@ -28,6 +28,7 @@ class FileInfo(object):
         self.lumis = []
         self.events = 0
         self.size = 0
+        self.location = None
 
     def __repr__(self):
         descriptions = ['{a}={v}'.format(a=attribute, v=getattr(self, attribute)) for attribute in self.__dict__]
@@ -1,5 +1,4 @@
 import datetime
-import glob
 import json
 import logging
 import os
@@ -8,10 +7,13 @@ import shutil
 import socket
 import subprocess
 import sys
+import threading
+import time
 import work_queue as wq
 
-from collections import defaultdict, Counter
+from collections import defaultdict, deque, Counter
 from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 
 from lobster import fs, util
 from lobster.cmssw import dash
@@ -23,6 +25,21 @@ from WMCore.Storage.SiteLocalConfig import loadSiteLocalConfig, SiteConfigError
 
 logger = logging.getLogger('lobster.source')
 
+# Parameters that differ between the tasks of a workflow, which are not
+# part of the shared parameter template
+TASK_PARAMETERS = ['mask', 'monitoring', 'output files', 'epilogue']
+
+
+def checksum(paths):
+    """Calculate the SHA1 hash of the contents of several files.
+    """
+    digest = sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                digest.update(block)
+    return digest.hexdigest()
+
 
 class ReleaseSummary(object):
 
@@ -70,6 +87,16 @@ class ReleaseSummary(object):
     def monitor(self, taskid):
         self.__monitors.append(taskid)
 
+    def update(self, other):
+        """Add the tasks of another summary to this one.
+        """
+        for status, ids in other.__exe.items():
+            self.__exe.setdefault(status, []).extend(ids)
+        for flag, ids in other.__wq.items():
+            self.__wq.setdefault(flag, []).extend(ids)
+        self.__taskdirs.update(other.__taskdirs)
+        self.__monitors.extend(other.__monitors)
+
     def __str__(self):
         s = "received the following task(s):\n"
         for status in sorted(self.__exe.keys()):
@@ -91,7 +118,8 @@ class ReleaseSummary(object):
 class TaskProvider(util.Timing):
 
     def __init__(self, config):
-        util.Timing.__init__(self, 'dash', 'handler', 'updates', 'elk', 'transfers', 'cleanup', 'propagate', 'sqlite')
+        util.Timing.__init__(self, 'dash', 'handler', 'updates', 'elk', 'cleanup', 'propagate', 'sqlite', 'wait')
+        startup = [('start', time.time())]
 
         self.config = config
         self.basedirs = [config.base_directory, config.startup_directory]
@@ -101,8 +129,16 @@ class TaskProvider(util.Timing):
         self.siteconf = os.path.join(self.workdir, 'siteconf')
 
         self.parrot_path = os.path.dirname(util.which('parrot_run'))
-        self.parrot_bin = os.path.join(self.workdir, 'bin')
-        self.parrot_lib = os.path.join(self.workdir, 'lib')
+        self.parrot_exes = [util.which(exe) for exe in ('parrot_run', 'chirp', 'chirp_put', 'chirp_get')]
+        self.parrot_helper = os.path.join(os.path.dirname(self.parrot_path), 'lib', 'lib64', 'libparrot_helper.so')
+
+        # Stripped copies of the binaries are kept by the hash of the
+        # originals, so that they stay the same across restarts, and
+        # workers can keep them cached
+        self.parrot_helpers = os.path.join(self.workdir, 'helpers')
+        digest = checksum(self.parrot_exes + [self.parrot_helper])
+        self.parrot_bin = os.path.join(self.parrot_helpers, digest, 'bin')
+        self.parrot_lib = os.path.join(self.parrot_helpers, digest, 'lib')
 
         self.__algo = Algo(config)
         self.__host = socket.getfqdn()
@@ -145,9 +181,17 @@ class TaskProvider(util.Timing):
 
         self.__taskhandlers = {}
         self.__store = unit.UnitStore(self.config)
+        self.__pool = None
+        if self.config.advanced.task_threads > 1:
+            self.__pool = ThreadPool(self.config.advanced.task_threads)
+        self.__release_pool = ThreadPool(max(self.config.advanced.task_threads, 1))
+        self.__templates = set()
+        self.__templates_lock = threading.Lock()
+        self.__releasing = deque()
 
         self.__setup_inputs()
         self.copy_siteconf()
+        startup.append(('setup', time.time()))
 
         create = not util.checkpoint(self.workdir, 'id')
         if create:
@@ -187,9 +231,6 @@ class TaskProvider(util.Timing):
                 logger.info("registering {0} in database".format(wflow.label))
                 self.__store.register_dataset(wflow, dataset_info, wflow.category.runtime)
                 util.register_checkpoint(self.workdir, wflow.label, 'REGISTERED')
-            elif os.path.exists(os.path.join(wflow.workdir, 'running')):
-                for id in self.get_taskids(wflow.label):
-                    util.move(wflow.workdir, id, 'failed')
 
         for wflow in self.config.workflows:
             if wflow.parent:
@@ -213,25 +254,55 @@ class TaskProvider(util.Timing):
                 self.config.elk.create(categories)
             else:
                 self.config.elk.resume()
+        startup.append(('workflows', time.time()))
 
         self.config.advanced.dashboard.setup(self.config)
         if create:
             self.config.save()
             self.config.advanced.dashboard.register_run()
         else:
-            for id in self.__store.reset_units():
+            # Only tasks in flight when stopping have to be reset
+            for id, label in self.__store.reset_units():
+                workdir = os.path.join(self.workdir, label)
+                if self.config.advanced.move_taskdirs and os.path.isdir(util.taskpath(workdir, id)):
+                    util.move(workdir, id, 'failed')
                 self.config.advanced.dashboard.update_task(id, dash.ABORTED)
+        startup.append(('reset', time.time()))
+
+        self.__setup_binaries()
+        startup.append(('binaries', time.time()))
 
-        for p in (self.parrot_bin, self.parrot_lib):
-            if not os.path.exists(p):
-                os.makedirs(p)
+        logger.info("startup took {0:.1f} s ({1})".format(
+            startup[-1][1] - startup[0][1],
+            ", ".join("{0}: {1:.1f} s".format(phase, t - t0) for ((_, t0), (phase, t)) in zip(startup[:-1], startup[1:]))))
 
-        for exe in ('parrot_run', 'chirp', 'chirp_put', 'chirp_get'):
-            shutil.copy(util.which(exe), self.parrot_bin)
-            subprocess.check_call(["strip", os.path.join(self.parrot_bin, exe)])
+    def __setup_binaries(self):
+        """Prepare stripped copies of the parrot and chirp binaries.
 
-        p_helper = os.path.join(os.path.dirname(self.parrot_path), 'lib', 'lib64', 'libparrot_helper.so')
-        shutil.copy(p_helper, self.parrot_lib)
+        Copies made for the same binaries by a previous run are reused,
+        and copies of other binaries removed.
+        """
+        helpers = os.path.dirname(self.parrot_bin)
+        if os.path.isdir(helpers):
+            logger.debug("reusing binaries in {0}".format(helpers))
+        else:
+            tmp = helpers + '.tmp'
+            if os.path.exists(tmp):
+                shutil.rmtree(tmp)
+            os.makedirs(os.path.join(tmp, 'bin'))
+            os.makedirs(os.path.join(tmp, 'lib'))
+
+            for exe in self.parrot_exes:
+                shutil.copy(exe, os.path.join(tmp, 'bin'))
+                subprocess.check_call(["strip", os.path.join(tmp, 'bin', os.path.basename(exe))])
+            shutil.copy(self.parrot_helper, os.path.join(tmp, 'lib'))
+
+            os.rename(tmp, helpers)
+            logger.debug("prepared binaries in {0}".format(helpers))
+
+        for other in os.listdir(self.parrot_helpers):
+            if other != os.path.basename(helpers):
+                shutil.rmtree(os.path.join(self.parrot_helpers, other))
 
     def copy_siteconf(self):
         storage_in = os.path.join(os.path.dirname(__file__), 'data', 'siteconf', 'PhEDEx', 'storage.xml')
@@ -294,15 +365,9 @@ class TaskProvider(util.Timing):
         if 'X509_USER_PROXY' in os.environ:
             self._inputs.append((os.environ['X509_USER_PROXY'], 'proxy', False))
 
-    def get_taskids(self, label, status='running'):
-        # Iterates over the task directories and returns all taskids found
-        # therein.
-        parent = os.path.join(self.workdir, label, status)
-        for d in glob.glob(os.path.join(parent, '*', '*')):
-            yield int(os.path.relpath(d, parent).replace(os.path.sep, ''))
-
     def get_report(self, label, task):
-        return os.path.join(self.workdir, label, 'successful', util.id2dir(task), 'report.json')
+        workdir = os.path.join(self.workdir, label)
+        return os.path.join(util.taskpath(workdir, task, 'successful', self.config.advanced.move_taskdirs), 'report.json')
 
     def obtain(self, total, tasks):
         """
@@ -327,7 +392,10 @@ class TaskProvider(util.Timing):
         taskinfos = []
         for wflow in self.config.workflows:
             taskinfos += self.__store.pop_unmerged_tasks(wflow.label, wflow.merge_size, 10)
-        for label, ntasks, taper in self.__algo.run(total, tasks, remaining):
+        throughput = None
+        if self.config.advanced.forecast:
+            throughput = self.__store.throughput(time.time() - self.__algo.window)
+        for label, ntasks, taper in self.__algo.run(total, tasks, remaining, throughput):
             infos = self.__store.pop_units(label, ntasks, taper)
             logger.debug("created {} tasks for workflow {}".format(len(infos), label))
             taskinfos += infos
@@ -337,16 +405,14 @@ class TaskProvider(util.Timing):
 
         tasks = []
         ids = []
+        prepared = []
 
+        # Assign monitoring ids and storage parameters in order, leaving
+        # the remaining per-task work to the pool
         for (id, label, files, lumis, unique_arg, merge) in taskinfos:
             wflow = getattr(self.config.workflows, label)
             ids.append(id)
 
-            jdir = util.taskdir(wflow.workdir, id)
-            inputs = list(self._inputs)
-            inputs.append((os.path.join(jdir, 'parameters.json'), 'parameters.json', False))
-            outputs = [(os.path.join(jdir, f), f) for f in ['report.json']]
-
             monitorid, syncid = self.config.advanced.dashboard.register_task(id)
 
             config = {
@@ -373,70 +439,215 @@ class TaskProvider(util.Timing):
                 'gridpack': False
             }
 
-            cmd = 'sh wrapper.sh python task.py parameters.json'
-            env = {
-                'LOBSTER_CVMFS_PROXY': self.__cvmfs_proxy,
-                'LOBSTER_FRONTIER_PROXY': self.__frontier_proxy,
-                'LOBSTER_OSG_VERSION': self.config.advanced.osg_version
-            }
+            # set input/output transfer parameters
+            self._storage.preprocess(config, merge or wflow.parent)
+
+            prepared.append((id, wflow, files, lumis, unique_arg, merge, config))
 
-            if merge:
-                missing = []
-                infiles = []
-                inreports = []
+        if self.__pool is None:
+            results = [self.__prepare(*args) for args in prepared]
+        else:
+            results = self.__pool.map(lambda args: self.__prepare(*args), prepared)
 
-                for task, _, _, _ in lumis:
-                    report = self.get_report(label, task)
-                    _, infile = list(wflow.get_outputs(task))[0]
+        missing = []
+        for task, handler, task_missing in results:
+            tasks.append(task)
+            missing += task_missing
+            self.__taskhandlers[handler.id] = handler
 
-                    if os.path.isfile(report):
-                        inreports.append(report)
-                        infiles.append((task, infile))
-                    else:
-                        missing.append(task)
+        if len(missing) > 0:
+            self.__store.update_missing(missing, wait=False)
 
-                if len(missing) > 0:
-                    template = "the following have been marked as failed because their output could not be found: {0}"
-                    logger.warning(template.format(", ".join(map(str, missing))))
-                    self.__store.update_missing(missing)
+        logger.info("creating task(s) {0}".format(", ".join(map(str, ids))))
 
-                if len(infiles) <= 1:
-                    # FIXME report these back to the database and then skip
-                    # them.  Without failing these task ids, accounting of
-                    # running tasks is going to be messed up.
-                    logger.debug("skipping task {0} with only one input file!".format(id))
+        return tasks
 
-                # takes care of the fields set to None in config
-                wflow.adjust(config, env, jdir, inputs, outputs, merge, reports=inreports)
+    def __prepare(self, id, wflow, files, lumis, unique_arg, merge, config):
+        """Create the directory and parameters of a task.
 
-                files = infiles
-            else:
-                # takes care of the fields set to None in config
-                wflow.adjust(config, env, jdir, inputs, outputs, merge, unique=unique_arg)
+        Called concurrently for several tasks, see
+        `AdvancedOptions.task_threads`.
 
-            handler = wflow.handler(id, files, lumis, jdir, merge=merge)
+        Returns
+        -------
+            task : tuple
+                The task description to be submitted to `WorkQueue`.
+            handler : TaskHandler
+                The handler of the task.
+            missing : list
+                The ids of tasks to be merged with missing output.
+        """
+        jdir = util.taskdir(wflow.workdir, id, moved=self.config.advanced.move_taskdirs)
+        inputs = list(self._inputs)
+        inputs.append((os.path.join(jdir, 'parameters.json'), 'parameters.json', False))
+        outputs = [(os.path.join(jdir, f), f) for f in ['report.json']]
+        missing = []
+
+        cmd = 'sh wrapper.sh python task.py parameters.json'
+        env = {
+            'LOBSTER_CVMFS_PROXY': self.__cvmfs_proxy,
+            'LOBSTER_FRONTIER_PROXY': self.__frontier_proxy,
+            'LOBSTER_OSG_VERSION': self.config.advanced.osg_version
+        }
+
+        if merge:
+            infiles = []
+            inreports = []
+
+            for task, _, _, _ in lumis:
+                report = self.get_report(wflow.label, task)
+                _, infile = list(wflow.get_outputs(task))[0]
+
+                if os.path.isfile(report):
+                    inreports.append(report)
+                    infiles.append((task, infile))
+                else:
+                    missing.append(task)
 
-            # set input/output transfer parameters
-            self._storage.preprocess(config, merge or wflow.parent)
-            # adjust file and lumi information in config, add task specific
-            # input/output files
-            handler.adjust(config, inputs, outputs, self._storage)
+            if len(missing) > 0:
+                template = "the following have been marked as failed because their output could not be found: {0}"
+                logger.warning(template.format(", ".join(map(str, missing))))
 
-            with open(os.path.join(jdir, 'parameters.json'), 'w') as f:
-                json.dump(config, f, indent=2)
-                f.write('\n')
+            if len(infiles) <= 1:
+                # FIXME report these back to the database and then skip
+                # them.  Without failing these task ids, accounting of
+                # running tasks is going to be messed up.
+                logger.debug("skipping task {0} with only one input file!".format(id))
 
-            tasks.append(('merge' if merge else wflow.category.name, cmd, id, inputs, outputs, env, jdir))
+            # takes care of the fields set to None in config
+            wflow.adjust(config, env, jdir, inputs, outputs, merge, reports=inreports)
 
-            self.__taskhandlers[id] = handler
+            files = infiles
+        else:
+            # takes care of the fields set to None in config
+            wflow.adjust(config, env, jdir, inputs, outputs, merge, unique=unique_arg)
 
-        logger.info("creating task(s) {0}".format(", ".join(map(str, ids))))
+        handler = wflow.handler(id, files, lumis, jdir, merge=merge)
 
-        self.config.advanced.dashboard.free()
+        # adjust file and lumi information in config, add task specific
+        # input/output files
+        handler.adjust(config, inputs, outputs, self._storage)
 
-        return tasks
+        template, config = self.__split_parameters(wflow, config)
+        inputs.append((template, 'template.json', True))
+
+        with open(os.path.join(jdir, 'parameters.json'), 'w') as f:
+            json.dump(config, f, indent=2)
+            f.write('\n')
+
+        task = ('merge' if merge else wflow.category.name, cmd, id, inputs, outputs, env, jdir)
+        return task, handler, missing
+
+    def __split_parameters(self, wflow, config):
+        """Split task parameters into a shared template and the task
+        specific parameters.
+
+        The template is stored in the working directory of the workflow,
+        named after the hash of its contents, so that `WorkQueue` can cache
+        it on the workers.  `task.py` merges both again.
+
+        Returns
+        -------
+            template : str
+                The path of the template.
+            parameters : dict
+                The task specific parameters, referencing the template.
+        """
+        keys = list(TASK_PARAMETERS)
+        if self._storage.shuffle_inputs or self._storage.shuffle_outputs:
+            keys += ['input', 'output']
+
+        template = dict((k, v) for (k, v) in config.items() if k not in keys)
+        content = json.dumps(template, sort_keys=True, indent=2) + '\n'
+        path = os.path.join(wflow.workdir, 'templates', sha1(content).hexdigest() + '.json')
+
+        with self.__templates_lock:
+            if path not in self.__templates:
+                if not os.path.exists(path):
+                    if not os.path.isdir(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    with open(path + '.tmp', 'w') as f:
+                        f.write(content)
+                    os.rename(path + '.tmp', path)
+                self.__templates.add(path)
+
+        parameters = dict((k, v) for (k, v) in config.items() if k in keys)
+        parameters['template'] = 'template.json'
+        return path, parameters
+
+    def __process(self, task, handler):
+        """Process the report and move the directory of a returned task.
+
+        Called concurrently for several tasks by the release pipeline.
+        """
+        summary = ReleaseSummary()
+        transfers = defaultdict(lambda: defaultdict(Counter))
+
+        with self.measure('updates'):
+            failed, task_update, file_update, unit_update = handler.process(task, summary, transfers)
+
+        with self.measure('handler'):
+            wflow = getattr(self.config.workflows, handler.dataset)
+            status = 'failed' if failed else 'successful'
+            if self.config.advanced.move_taskdirs:
+                tdir = util.move(wflow.workdir, handler.id, status)
+            else:
+                tdir = util.taskpath(wflow.workdir, handler.id, moved=False)
+            if failed:
+                summary.dir(str(handler.id), tdir)
+
+        return task, handler, failed, task_update, file_update, unit_update, summary, transfers
+
+    @property
+    def releasing(self):
+        """The number of returned tasks not yet released.
+        """
+        return len(self.__releasing)
 
     def release(self, tasks):
+        """Release returned tasks.
+
+        The reports of returned tasks are processed and their directories
+        moved by a pool of threads, see `AdvancedOptions.task_threads`.
+        Tasks that are fully processed are committed to the database in
+        one batch, without waiting for the remaining ones.  If more than
+        `AdvancedOptions.release_depth` tasks are waiting, blocks until
+        enough are done.
+
+        Parameters
+        ----------
+            tasks : list
+                The tasks returned by `WorkQueue`, may be empty to only
+                commit the tasks processed in the meantime.
+        """
+        for task in tasks:
+            with self.measure('dash'):
+                self.config.advanced.dashboard.update_task(task.tag, dash.DONE)
+
+            handler = self.__taskhandlers.pop(task.tag)
+            self.__releasing.append(self.__release_pool.apply_async(self.__process, (task, handler)))
+
+        self.__commit()
+
+    def __commit(self, wait=False):
+        """Commit the tasks processed by the release pipeline.
+
+        Parameters
+        ----------
+            wait : bool
+                Wait for all tasks in the pipeline to be processed.
+        """
+        results = []
+        with self.measure('wait'):
+            while len(self.__releasing) > 0:
+                if wait or len(self.__releasing) > self.config.advanced.release_depth or self.__releasing[0].ready():
+                    results.append(self.__releasing.popleft().get())
+                else:
+                    break
+
+        if len(results) == 0:
+            return
+
         cleanup = []
         update = defaultdict(list)
         propagate = defaultdict(dict)
@@ -444,15 +655,13 @@ class TaskProvider(util.Timing):
         summary = ReleaseSummary()
         transfers = defaultdict(lambda: defaultdict(Counter))
 
-        for task in tasks:
-            with self.measure('dash'):
-                self.config.advanced.dashboard.update_task(task.tag, dash.DONE)
-
-            with self.measure('updates'):
-                handler = self.__taskhandlers[task.tag]
-                failed, task_update, file_update, unit_update = handler.process(task, summary, transfers)
+        for (task, handler, failed, task_update, file_update, unit_update, task_summary, task_transfers) in results:
+            summary.update(task_summary)
+            for label, protocols in task_transfers.items():
+                for protocol, counts in protocols.items():
+                    transfers[label][protocol].update(counts)
 
-                wflow = getattr(self.config.workflows, handler.dataset)
+            wflow = getattr(self.config.workflows, handler.dataset)
 
             with self.measure('elk'):
                 if self.config.elk:
@@ -461,12 +670,8 @@ class TaskProvider(util.Timing):
 
             with self.measure('handler'):
                 if failed:
-                    faildir = util.move(wflow.workdir, handler.id, 'failed')
-                    summary.dir(str(handler.id), faildir)
                     cleanup += [lf for rf, lf in handler.outputs]
                 else:
-                    util.move(wflow.workdir, handler.id, 'successful')
-
                     merge = isinstance(handler, MergeTaskHandler)
 
                     if (wflow.merge_size <= 0 or merge) and len(handler.outputs) > 0:
@@ -487,15 +692,10 @@ class TaskProvider(util.Timing):
 
             update[(handler.dataset, handler.unit_source)].append((task_update, file_update, unit_update))
 
-            del self.__taskhandlers[task.tag]
-
-        with self.measure('dash'):
-            self.config.advanced.dashboard.free()
-
         if len(update) > 0:
             with self.measure('sqlite'):
                 logger.info(summary)
-                self.__store.update_units(update)
+                self.__store.update_units(update, transfers, wait=False)
 
         with self.measure('cleanup'):
             if wflow.cleanup_input and len(input_files) > 0:
@@ -511,11 +711,7 @@ class TaskProvider(util.Timing):
 
         with self.measure('propagate'):
             for label, infos in propagate.items():
-                self.__store.register_files(infos, label)
-
-        if len(transfers) > 0:
-            with self.measure('transfers'):
-                self.__store.update_transfers(transfers)
+                self.__store.register_files(infos, label, wait=False)
 
         if self.config.elk:
             with self.measure('elk'):
@@ -525,12 +721,19 @@ class TaskProvider(util.Timing):
                     logger.error('ELK failed to index summary:\n{}'.format(e))
 
     def terminate(self):
+        self.__commit(wait=True)
         for id in self.__store.running_tasks():
             self.config.advanced.dashboard.update_task(str(id), dash.CANCELLED)
 
     def done(self):
+        if len(self.__releasing) > 0:
+            return False
         left = self.__store.unfinished_units()
-        return self.__store.merged() and left == 0
+        if self.__store.merged() and left == 0:
+            # Commit outstanding changes before wrapping up
+            self.__store.flush()
+            return True
+        return False
 
     def max_taskid(self):
         return self.__store.max_taskid()
@@ -564,5 +767,23 @@ class TaskProvider(util.Timing):
     def tasks_left(self):
         return self.__store.estimate_tasks_left()
 
+    @property
+    def sql_times(self):
+        """Time spent executing SQL statements in each part of the unit
+        store, in microseconds.  Zero unless profiling SQL statements.
+        """
+        if self.__store.profile is None:
+            return dict((k, 0) for k in unit.SECTIONS)
+        return self.__store.profile.times
+
+    def dump_sql_profile(self):
+        self.__store.dump_profile()
+
+    def update_snapshot(self, force=False):
+        """Publish a read-only copy of the database for plotting and the
+        status summary.  See `UnitStore.snapshot`.
+        """
+        self.__store.snapshot(force)
+
     def work_left(self):
         return self.__store.unfinished_units()
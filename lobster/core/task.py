@@ -1,5 +1,6 @@
 import collections
 import gzip
+import itertools
 import json
 import logging
 import os
@@ -27,7 +28,15 @@ class TaskHandler(object):
         self._dataset = dataset
         self._files = [(i, file) for i, file in files]
         self._file_based = any([file_ is None or run < 0 or lumi < 0 for (_, file_, run, lumi) in lumis])
-        self._units = lumis
+        # Group units by file, and remember where the units of each file
+        # start and stop
+        self._units = sorted(lumis, key=lambda u: u[1])
+        self._file_ranges = {}
+        start = 0
+        for file_, units in itertools.groupby(self._units, key=lambda u: u[1]):
+            stop = start + sum(1 for _ in units)
+            self._file_ranges[file_] = (start, stop)
+            start = stop
         self.outputs = outputs
         self._local = local
 
@@ -66,7 +75,8 @@ class TaskHandler(object):
         units_processed = len(self._units)
 
         for (id, file) in self._files:
-            file_units = [tpl for tpl in self._units if tpl[1] == id]
+            start, stop = self._file_ranges.get(id, (0, 0))
+            file_units = self._units[start:stop]
 
             skipped = file in files_skipped or file not in files_info
             read = 0 if failed or skipped else files_info[file][0]
@@ -78,13 +88,13 @@ class TaskHandler(object):
             else:
                 if skipped:
                     for (lumi_id, lumi_file, r, l) in file_units:
-                        unit_update.append((unit.FAILED, lumi_id))
+                        unit_update.append((unit.FAILED, lumi_id, l))
                         units_processed -= 1
                 elif not self._file_based:
                     file_lumis = set(map(tuple, files_info[file][1]))
                     for (lumi_id, lumi_file, r, l) in file_units:
                         if (r, l) not in file_lumis:
-                            unit_update.append((unit.FAILED, lumi_id))
+                            unit_update.append((unit.FAILED, lumi_id, l))
                             units_processed -= 1
 
             file_update.append((read, 1 if skipped else 0, id))
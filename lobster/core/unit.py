@@ -1,10 +1,21 @@
+import atexit
+from bisect import bisect_left, insort
 from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from heapq import heappop, heappush
 import json
 import logging
 import math
 import os
+import Queue
+import re
 from retrying import retry
 import sqlite3
+import sys
+import threading
+import time
+import urlparse
 import uuid
 
 from lobster import util
@@ -28,6 +39,9 @@ MERGED = 8
 PROCESS = 0
 MERGE = 1
 
+# Width of the time bins of the transfer history, in seconds
+TRANSFER_BIN = 600
+
 TaskUpdate = util.record('TaskUpdate',
                          'bytes_bare_output',
                          'bytes_output',
@@ -77,15 +91,562 @@ TaskUpdate = util.record('TaskUpdate',
                          default=0)
 
 
+def ranges(lumis):
+    """Group lumis into ranges of consecutive lumis.
+
+    Parameters
+    ----------
+        lumis : list
+            A list of run and lumi tuples.
+
+    Returns
+    -------
+        ranges : list
+            A list of tuples of run, first and last lumi of each range.
+    """
+    res = []
+    for run, lumi in sorted(lumis):
+        if len(res) > 0 and res[-1][0] == run and res[-1][2] + 1 == lumi:
+            res[-1][2] = lumi
+        else:
+            res.append([run, lumi, lumi])
+    return [tuple(r) for r in res]
+
+
+class PendingUnits(object):
+
+    """Index of the units of a workflow that are available for processing.
+
+    Units are grouped by file, and handed out file by file, in increasing
+    order of how often a file has been skipped and the file id.  Within a
+    file, units are handed out in order of their id.  Files that have been
+    skipped too often and units that failed too often should not be added.
+
+    With `locality` set, files with fewer units being processed by running
+    tasks are handed out first.  Files are handed out from the location
+    with the fewest units being processed, and from the same location as
+    long as that does not change, so that tasks are spread over locations
+    and read files of one location each.  The number of units being
+    processed has to be kept up to date with `running`.
+
+    Parameters
+    ----------
+        locality : bool
+            Order files by the units running and their location.
+    """
+
+    def __init__(self, locality=False):
+        self.__locality = locality
+        # file id -> [times skipped, filename, units running, location rank]
+        self.__files = {}
+        # location -> rank, in order of appearance
+        self.__locations = {}
+        # location rank -> units running
+        self.__load = defaultdict(int)
+        # file id -> heap of (unit id, run, lumi, last lumi, argument, failures)
+        self.__units = defaultdict(list)
+        # location rank -> files with units, sorted in reverse processing
+        # order to allow removal of exhausted files from the end
+        self.__order = defaultdict(list)
+
+    def __len__(self):
+        return sum(len(heap) for heap in self.__units.values())
+
+    def __key(self, file):
+        skipped, _, running, location = self.__files[file]
+        if self.__locality:
+            return (-skipped, -running, -file)
+        return (-skipped, -file)
+
+    def __next(self):
+        """Return the location to hand out the next file from, or `None`.
+        """
+        candidates = [(order[-1][:-1], -self.__load[location], -location)
+                      for location, order in self.__order.items() if len(order) > 0]
+        if len(candidates) == 0:
+            return None
+        return -max(candidates)[-1]
+
+    def __update(self, file, index, value):
+        """Change a property of a file, keeping the processing order.
+        """
+        heap = self.__units[file]
+        order = self.__order[self.__files[file][3]]
+        if len(heap) > 0:
+            order.remove(self.__key(file))
+        self.__files[file][index] = value
+        if len(heap) > 0:
+            insort(order, self.__key(file))
+
+    def add_file(self, id, filename, skipped=0, location=None, running=0):
+        if not self.__locality:
+            location = None
+        rank = self.__locations.setdefault(location, len(self.__locations))
+        self.__files[id] = [skipped, filename, running, rank]
+        self.__load[rank] += running
+
+    def filename(self, id):
+        return self.__files[id][1]
+
+    def skipped(self, id):
+        return self.__files[id][0]
+
+    def add(self, id, file, run, lumi, last, arg, failed):
+        heap = self.__units[file]
+        if len(heap) == 0:
+            insort(self.__order[self.__files[file][3]], self.__key(file))
+        heappush(heap, (id, run, lumi, last, arg, failed))
+
+    def skip(self, file, skipped):
+        """Update how often a file has been skipped.
+        """
+        self.__update(file, 0, skipped)
+
+    def running(self, file, change):
+        """Update the number of units of a file being processed.
+        """
+        if self.__locality and change != 0:
+            self.__load[self.__files[file][3]] += change
+            self.__update(file, 2, self.__files[file][2] + change)
+
+    def discard(self, file):
+        """Remove all units of a file.
+        """
+        if len(self.__units[file]) > 0:
+            self.__order[self.__files[file][3]].remove(self.__key(file))
+        del self.__units[file]
+
+    def take(self):
+        """Remove and yield units in processing order.
+
+        Yields tuples of unit id, file id, run, first and last lumi,
+        argument, and failure count.  Units not used have to be returned
+        with `add`.  Units may be added while iterating.
+        """
+        location = self.__next()
+        while location is not None:
+            order = self.__order[location]
+            file = -order[-1][-1]
+            heap = self.__units[file]
+            id, run, lumi, last, arg, failed = heappop(heap)
+            if len(heap) == 0:
+                order.pop()
+            yield id, file, run, lumi, last, arg, failed
+            location = self.__next()
+
+
+# Sections of `UnitStore` to account SQL statements to, see `profiled`
+SECTIONS = ['other']
+
+
+class Profile(object):
+
+    """Statistics of the SQL statements executed, by statement template.
+
+    Statements are reduced to templates by collapsing whitespace, lists of
+    parameters, and the workflow labels in table and index names.  For
+    every template, the number of calls, the total and maximum time spent
+    executing and fetching results, and the number of rows returned or
+    changed are recorded.  The time spent is also accounted to the
+    section of `UnitStore` that executed the statements.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__labels = set()
+        self.__label_re = None
+        self.__cache = {}
+        # template -> [calls, total time, maximum time, rows]
+        self.__templates = defaultdict(lambda: [0, 0., 0., 0])
+        self.__sections = Counter()
+
+    def add_labels(self, labels):
+        with self.__lock:
+            self.__labels.update(labels)
+            self.__label_re = re.compile(r'_(?:{0})\b'.format(
+                '|'.join(re.escape(l) for l in sorted(self.__labels, key=len, reverse=True))))
+            self.__cache.clear()
+
+    def template(self, sql):
+        try:
+            return self.__cache[sql]
+        except KeyError:
+            pass
+        template = ' '.join(sql.split())
+        template = re.sub(r'\?(\s*,\s*\?)+', '?, ...', template)
+        if self.__label_re:
+            template = self.__label_re.sub('_{label}', template)
+        self.__cache[sql] = template
+        return template
+
+    @contextmanager
+    def section(self, name):
+        """Account the statements executed by the current thread to `name`.
+        """
+        stack = self.__local.__dict__.setdefault('stack', [])
+        stack.append(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def record(self, sql, duration, rows, call=True):
+        template = self.template(sql)
+        stack = self.__local.__dict__.get('stack')
+        section = stack[-1] if stack else 'other'
+        with self.__lock:
+            stats = self.__templates[template]
+            if call:
+                stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3] += rows
+            self.__sections[section] += duration
+
+    @property
+    def times(self):
+        """The time spent in each section, in microseconds.
+        """
+        with self.__lock:
+            return dict((k, int(self.__sections[k] * 1e6)) for k in SECTIONS)
+
+    def dump(self, filename):
+        """Write the statistics of all templates, slowest first.
+        """
+        with self.__lock:
+            stats = sorted(self.__templates.items(), key=lambda (_, (c, t, m, r)): t, reverse=True)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump([{'statement': template, 'calls': calls, 'total': total, 'max': max_, 'rows': rows}
+                       for (template, (calls, total, max_, rows)) in stats], f, indent=2)
+        os.rename(filename + '.tmp', filename)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+
+    """Cursor recording its statements with the profile of its connection.
+    """
+
+    def __run(self, method, sql, args):
+        start = time.time()
+        self.__sql = sql
+        try:
+            return method(self, sql, *args)
+        finally:
+            self.connection.profile.record(sql, time.time() - start, max(self.rowcount, 0))
+
+    def __fetch(self, method, *args):
+        start = time.time()
+        res = method(self, *args)
+        rows = len(res) if isinstance(res, list) else int(res is not None)
+        self.connection.profile.record(self.__sql, time.time() - start, rows, call=False)
+        return res
+
+    def execute(self, sql, *args):
+        return self.__run(sqlite3.Cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self.__run(sqlite3.Cursor.executemany, sql, args)
+
+    def fetchone(self):
+        return self.__fetch(sqlite3.Cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self.__fetch(sqlite3.Cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self.__fetch(sqlite3.Cursor.fetchall)
+
+    def next(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class ProfilingConnection(sqlite3.Connection):
+
+    """Connection creating cursors that record their statements.
+    """
+
+    profile = None
+
+    def cursor(self, factory=ProfilingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+
+def connect(path, profile=None, **kwargs):
+    """Connect to a database.
+
+    Parameters
+    ----------
+        path : str
+            The path of the database.
+        profile : Profile
+            Record all statements executed with this profile, if given.
+        kwargs : dict
+            Passed on to `sqlite3.connect`.
+    """
+    if profile is None:
+        return sqlite3.connect(path, **kwargs)
+    db = sqlite3.connect(path, factory=ProfilingConnection, **kwargs)
+    db.profile = profile
+    return db
+
+
+Job = util.record('Job', 'fn', 'wait', 'done', 'result', 'failure', default=None)
+
+
+class Writer(threading.Thread):
+
+    """Thread performing all changes to the database.
+
+    Changes are submitted as jobs, which are executed in order.  All jobs
+    waiting when the thread becomes idle are committed in a single
+    transaction.  The thread uses its own connection to the database.
+
+    Parameters
+    ----------
+        path : str
+            The path of the database.
+        rollback : function
+            Called when changes fail to be committed.
+        batchsize : int
+            The maximum number of jobs to commit in one transaction.
+        profile : Profile
+            Record the statements of the thread with this profile.
+    """
+
+    def __init__(self, path, rollback=None, batchsize=100, profile=None):
+        super(Writer, self).__init__(name='lobster-db-writer')
+        self.daemon = True
+        self.db = None
+        self.__path = path
+        self.__profile = profile
+        self.__rollback = rollback
+        self.__batchsize = batchsize
+        self.__queue = Queue.Queue()
+        self.__failure = None
+
+    def submit(self, fn, wait=True):
+        """Execute a function in the writer thread.
+
+        Functions submitted from the writer thread itself are executed
+        directly, as part of the current job.
+
+        Parameters
+        ----------
+            fn : function
+                The function to call.
+            wait : bool
+                Wait for the changes of the function to be committed, and
+                return its result.  Otherwise, return immediately.  If the
+                function fails, the writer refuses all further changes,
+                raising the failure instead.
+        """
+        if threading.current_thread() is self:
+            return fn()
+
+        if self.__failure:
+            raise self.__failure[0], self.__failure[1], self.__failure[2]
+
+        job = Job(fn=fn, wait=wait, done=threading.Event())
+        self.__queue.put(job)
+        if not wait:
+            return
+
+        job.done.wait()
+        if job.failure:
+            raise job.failure[0], job.failure[1], job.failure[2]
+        return job.result
+
+    def flush(self):
+        """Wait for all submitted changes to be committed.
+        """
+        self.submit(lambda: None)
+
+    def stop(self):
+        """Commit all submitted changes and stop the thread.
+        """
+        self.__queue.put(None)
+        self.join()
+
+    @retry(stop_max_attempt_number=10, retry_on_exception=lambda e: isinstance(e, sqlite3.OperationalError))
+    def begin(self):
+        self.db.execute("begin immediate")
+
+    def run(self):
+        self.db = connect(self.__path, self.__profile, timeout=90, isolation_level=None)
+
+        stop = False
+        while not stop:
+            jobs = [self.__queue.get()]
+            while len(jobs) < self.__batchsize:
+                try:
+                    jobs.append(self.__queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in jobs:
+                stop = True
+                jobs = [job for job in jobs if job is not None]
+            if len(jobs) == 0:
+                continue
+
+            try:
+                self.begin()
+                for job in jobs:
+                    if self.__failure:
+                        job.failure = self.__failure
+                        continue
+                    try:
+                        job.result = job.fn()
+                    except Exception:
+                        job.failure = sys.exc_info()
+                        if not job.wait:
+                            logger.error("failed to change the database", exc_info=job.failure)
+                            self.__failure = job.failure
+                self.db.execute("commit")
+            except Exception:
+                failure = sys.exc_info()
+                logger.error("failed to commit changes to the database", exc_info=failure)
+                try:
+                    self.db.execute("rollback")
+                except sqlite3.OperationalError:
+                    pass
+                if self.__rollback:
+                    self.__rollback()
+                for job in jobs:
+                    job.failure = job.failure or failure
+                    if not job.wait and not self.__failure:
+                        self.__failure = failure
+
+            for job in jobs:
+                job.done.set()
+
+        self.db.close()
+
+
+def copy_database(path, target):
+    """Write a consistent copy of a database.
+
+    Uses `vacuum into` where SQLite supports it, i.e., from version 3.27.
+    Otherwise, the schema is copied first, and then the contents of all
+    tables within one read transaction.  Neither blocks writers of a
+    database in WAL mode.
+
+    Parameters
+    ----------
+        path : str
+            The database to copy.
+        target : str
+            The file to write the copy to.  Must not exist.
+    """
+    db = sqlite3.connect(path, timeout=90, isolation_level=None)
+    try:
+        if sqlite3.sqlite_version_info >= (3, 27, 0):
+            db.execute("vacuum into ?", (target,))
+            return
+
+        db.execute("attach database ? as snapshot", (target,))
+        db.execute("begin")
+        schema = db.execute("""
+            select type, name, sql from main.sqlite_master
+            where sql is not null and name not like 'sqlite_%'""").fetchall()
+
+        copy = sqlite3.connect(target, isolation_level=None)
+        try:
+            for (kind, name, sql) in schema:
+                if kind == 'table':
+                    copy.execute(sql)
+            for (kind, name, sql) in schema:
+                if kind == 'table':
+                    db.execute("insert into snapshot.{0} select * from main.{0}".format(name))
+            db.execute("commit")
+            # filling indexed tables is slower, create the indices last
+            for (kind, name, sql) in schema:
+                if kind != 'table':
+                    copy.execute(sql)
+        finally:
+            copy.close()
+    finally:
+        db.close()
+
+
+def profiled(fn):
+    """Account the SQL statements of the decorated method of `UnitStore`
+    to a section of the same name, when profiling.
+    """
+    SECTIONS.append(fn.__name__)
+
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if self.profile is None:
+            return fn(self, *args, **kwargs)
+        with self.profile.section(fn.__name__):
+            return fn(self, *args, **kwargs)
+    return wrapper
+
+
+def serialized(fn):
+    """Perform the decorated method of `UnitStore` in the writer thread.
+
+    Used for all methods changing the database, and for queries that need
+    to see all changes submitted before.  The method waits for its
+    changes to be committed, unless called with `wait=False`.
+    """
+    fn = profiled(fn)
+
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        wait = kwargs.pop('wait', True)
+        return self.writer.submit(lambda: fn(self, *args, **kwargs), wait)
+    return wrapper
+
+
 class UnitStore:
 
-    def __init__(self, config):
+    # Time in seconds after which a snapshot of the database is considered
+    # abandoned, a few times the interval it is written in
+    snapshot_expiry = 1800
+
+    def __init__(self, config, snapshot=False):
         self.uuid = str(uuid.uuid4()).replace('-', '')
         self.db_path = os.path.join(config.workdir, "lobster.db")
-        self.db = sqlite3.connect(self.db_path, timeout=90)
+        self.snapshot_path = os.path.join(config.workdir, "lobster_snapshot.db")
+        self.profile = Profile() if config.advanced.profile_sql and not snapshot else None
+        self.__profile_dumped = 0
+        self.__snapshot = None
+        self.__snapshot_taken = 0
+        self.__writer = None
 
         self.config = config
-
+        self.__pending = {}
+        self.__ranges = {}
+
+        # Analytics read the snapshot published by a running master, if
+        # present, to never hold locks on the live database.  A snapshot
+        # not updated for several intervals was left behind by a master
+        # that did not shut down cleanly.
+        self.readonly = snapshot and os.path.exists(self.snapshot_path)
+        if self.readonly and self.age() > self.snapshot_expiry:
+            logger.warning("ignoring database snapshot written {0:.0f} s ago, "
+                           "lobster may have crashed; reading the live database instead".format(self.age()))
+            self.readonly = False
+        if self.readonly:
+            self.__db = sqlite3.connect(self.snapshot_path, timeout=90)
+            return
+
+        self.__db = connect(self.db_path, self.profile, timeout=90)
+
+        # Let readers access a consistent snapshot of the database while
+        # the writer thread is committing changes
+        self.db.execute("pragma journal_mode=WAL")
         self.db.execute("""create table if not exists workflows(
             cfg text,
             dataset text,
@@ -100,6 +661,13 @@ class UnitStore:
             units_available int default 0,
             units_paused int default 0,
             units_running int default 0,
+            units_failed int default 0,
+            units_skipped int default 0,
+            units_merged int default 0,
+            events_read int default 0,
+            events_written int default 0,
+            merge_tasks int default 0,
+            unit_ranges int default 0,
             taskruntime int default null,
             tasksize int,
             label text,
@@ -112,6 +680,21 @@ class UnitStore:
             uuid text,
             transfers text default '{}',
             stop_on_file_boundary)""")
+        # Summary columns are missing in existing projects, and are
+        # filled by a recount once the database is set up
+        added = self.add_columns('workflows', [
+            ('units_failed', 'int default 0'),
+            ('units_skipped', 'int default 0'),
+            ('units_merged', 'int default 0'),
+            ('events_read', 'int default 0'),
+            ('events_written', 'int default 0'),
+            ('merge_tasks', 'int default 0')
+        ])
+        # Units of existing projects are never stored as ranges
+        self.add_columns('workflows', [('unit_ranges', 'int default 0')])
+        # The location of files in existing projects is unknown
+        for (table,) in self.db.execute("select name from sqlite_master where type='table' and name like 'files_%'").fetchall():
+            self.add_columns(table, [('location', 'text')])
         self.db.execute("""create table if not exists tasks(
             bytes_bare_output int default 0 not null,
             bytes_output int default 0 not null,
@@ -166,24 +749,426 @@ class UnitStore:
             workdir_num_files int default 0 not null,
             foreign key(workflow) references workflows(id))""")
 
+        # Journal of the tasks in flight, to be reset on restart.  Filled
+        # from the tasks when missing in existing projects.
+        journal = self.db.execute("select count(*) from sqlite_master where type='table' and name='inflight'").fetchone()[0]
+        self.db.execute("""create table if not exists inflight(
+            task integer primary key,
+            workflow text,
+            foreign key(task) references tasks(id))""")
+        if not journal:
+            self.db.execute("""
+                insert into inflight(task, workflow)
+                select tasks.id, workflows.label
+                from tasks, workflows
+                where tasks.status=1 and tasks.workflow=workflows.id""")
+
+        # Transfer outcomes per protocol, binned in time.  Totals of
+        # existing projects are imported into the time bin 0.
+        history = self.db.execute("select count(*) from sqlite_master where type='table' and name='transfers'").fetchone()[0]
+        self.db.execute("""create table if not exists transfers(
+            workflow int not null,
+            protocol text not null,
+            outcome text not null,
+            time_bin int not null,
+            count int default 0 not null,
+            primary key(workflow, protocol, outcome, time_bin),
+            foreign key(workflow) references workflows(id))""")
+        if not history:
+            imported = []
+            for (id, data) in self.db.execute("select id, transfers from workflows").fetchall():
+                for protocol, counts in json.loads(data).items():
+                    imported += [(id, protocol, outcome, 0, count) for (outcome, count) in counts.items()]
+            self.db.executemany("insert into transfers values (?, ?, ?, ?, ?)", imported)
+
         self.db.execute("create index if not exists index_w_label on workflows(label)")
         self.db.execute("create index if not exists index_t_workflow on tasks(workflow, status)")
         self.db.execute("create index if not exists index_t_workflowplus on tasks(workflow, status, type)")
+        self.db.execute("create index if not exists index_t_task on tasks(task)")
+        self.db.execute("create index if not exists index_t_retrieved on tasks(time_retrieved)")
 
         self.db.commit()
 
+        if self.profile is not None:
+            self.profile.add_labels([label for (label,) in self.db.execute("select label from workflows")])
+
+        if len(added) > 0:
+            logger.info("recounting units after adding columns {0} to the workflows".format(', '.join(added)))
+            self.verify_counters(fix=True)
+
+    def add_columns(self, table, columns):
+        """Add columns missing from a table of an existing project.
+
+        Parameters
+        ----------
+            table : str
+                The table to add columns to.
+            columns : list
+                A list of tuples with the name and type of each column.
+
+        Returns
+        -------
+            added : list
+                The names of the columns that were missing.
+        """
+        present = set(row[1] for row in self.db.execute("pragma table_info({0})".format(table)))
+        added = []
+        for name, kind in columns:
+            if name not in present:
+                self.db.execute("alter table {0} add column {1} {2}".format(table, name, kind))
+                added.append(name)
+        return added
+
+    @property
+    def db(self):
+        """The database connection of the current thread.
+        """
+        if self.__writer is not None and threading.current_thread() is self.__writer:
+            return self.__writer.db
+        return self.__db
+
+    @property
+    def writer(self):
+        """The thread performing all changes to the database.
+
+        Started when first used, and stopped when calling `disconnect` or
+        when exiting the interpreter.  Not available when reading a
+        snapshot of the database.
+        """
+        if self.readonly:
+            raise IOError("can't change a snapshot of the database")
+        if self.__writer is None:
+            self.__writer = Writer(self.db_path, rollback=self.__pending.clear, profile=self.profile)
+            self.__writer.start()
+            atexit.register(self.disconnect)
+        return self.__writer
+
+    def flush(self):
+        """Wait for all submitted changes to be committed.
+        """
+        if self.__writer is not None:
+            self.__writer.flush()
+
     def disconnect(self):
-        self.db.close()
+        if self.__snapshot is not None:
+            self.__snapshot.join()
+        if self.__writer is not None and self.__writer.is_alive():
+            self.__writer.stop()
+            self.dump_profile(force=True)
+        self.__db.close()
+        if self.__snapshot_taken and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+    def age(self):
+        """The time in seconds since the database in use was last written.
+        """
+        path = self.snapshot_path if self.readonly else self.db_path
+        return time.time() - os.path.getmtime(path)
+
+    def snapshot(self, force=False, interval=300, wait=False):
+        """Publish a consistent copy of the database for reading.
+
+        The copy is written by a background thread with its own read
+        transaction, which blocks neither the writer thread nor the
+        caller, and replaces the previous snapshot atomically.  Readers
+        opening the store with `snapshot=True` use it in favor of the live
+        database.  The snapshot is removed again when disconnecting.
+
+        Parameters
+        ----------
+            force : bool
+                Write the snapshot even if it was written recently.
+            interval : int
+                The minimum time between snapshots, in seconds.
+            wait : bool
+                Wait for the snapshot to be written.
+        """
+        if self.readonly:
+            return
+        if self.__snapshot is not None and self.__snapshot.is_alive():
+            if not wait:
+                return
+            self.__snapshot.join()
+        if not force and time.time() - self.__snapshot_taken < interval:
+            return
+
+        self.__snapshot_taken = time.time()
+        self.__snapshot = threading.Thread(target=self.__write_snapshot, name='snapshot')
+        self.__snapshot.daemon = True
+        self.__snapshot.start()
+        if wait:
+            self.__snapshot.join()
+
+    def __write_snapshot(self):
+        start = time.time()
+        tmp = self.snapshot_path + '.tmp'
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            copy_database(self.db_path, tmp)
+            os.rename(tmp, self.snapshot_path)
+        except (sqlite3.Error, IOError, OSError) as e:
+            logger.warning("failed to write database snapshot: {0}".format(e))
+            return
+        logger.debug("wrote database snapshot in {0:.1f} s".format(time.time() - start))
+
+    def dump_profile(self, force=False, interval=300):
+        """Write the SQL profile to `sql_profile.json` in the working
+        directory, when profiling.
+
+        Parameters
+        ----------
+            force : bool
+                Write the profile even if it was written recently.
+            interval : int
+                The minimum time between writes of the profile, in
+                seconds.
+        """
+        if self.profile is None:
+            return
+        if not force and time.time() - self.__profile_dumped < interval:
+            return
+        self.__profile_dumped = time.time()
+        self.profile.dump(os.path.join(self.config.workdir, 'sql_profile.json'))
+
+    @contextmanager
+    def transaction(self):
+        """Group changes to the database.
+
+        Has to be used within the writer thread, which commits the
+        changes.  On failure, changes are rolled back, and the in-memory
+        indices of pending units discarded, to be reloaded from the
+        database.
+        """
+        self.db.execute("savepoint changes")
+        try:
+            yield
+        except Exception:
+            self.db.execute("rollback to changes")
+            self.db.execute("release changes")
+            self.__pending.clear()
+            raise
+        self.db.execute("release changes")
+
+    def pending(self, label):
+        """Get the index of units available for processing.
+
+        The index is loaded from the database when first used, and
+        subsequently kept up to date with every change in unit status.
+
+        Parameters
+        ----------
+            label : str
+                The workflow to get the index for.
+
+        Returns
+        -------
+            pending : PendingUnits
+                The index of available units.
+        """
+        if label not in self.__pending:
+            pending = PendingUnits(self.config.advanced.locality)
+            for row in self.db.execute("select id, filename, skipped, location, units_running from files_{0}".format(label)):
+                pending.add_file(*row)
+            count = 0
+            for row in self.db.execute("""
+                    select units_{0}.id, file, run, lumi, {1}, arg, failed
+                    from units_{0}, files_{0}
+                    where
+                        units_{0}.file == files_{0}.id and
+                        units_{0}.status in (0, 3, 4) and
+                        units_{0}.failed <= ? and
+                        files_{0}.skipped < ?""".format(label, self.last_lumi(label)),
+                                       (self.config.advanced.threshold_for_failure,
+                                        self.config.advanced.threshold_for_skipping)):
+                pending.add(*row)
+                count += 1
+            logger.debug("loaded {0} units available for processing of {1}".format(count, label))
+            self.__pending[label] = pending
+        return self.__pending[label]
+
+    def restore_units(self, label, tasks):
+        """Add units of tasks to the pending index, if available again.
+
+        Parameters
+        ----------
+            label : str
+                The workflow the tasks belong to.
+            tasks : list
+                The ids of the tasks whose units changed status.
+        """
+        if label not in self.__pending:
+            return
+        pending = self.__pending[label]
+        for i in range(0, len(tasks), 900):
+            chunk = tasks[i:i + 900]
+            for row in self.db.execute("""
+                    select units_{0}.id, file, run, lumi, {2}, arg, failed
+                    from units_{0}, files_{0}
+                    where
+                        units_{0}.file == files_{0}.id and
+                        units_{0}.task in ({1}) and
+                        units_{0}.status in (0, 3, 4) and
+                        units_{0}.failed <= ? and
+                        files_{0}.skipped < ?""".format(label, ', '.join('?' for _ in chunk), self.last_lumi(label)),
+                                       tuple(chunk) + (self.config.advanced.threshold_for_failure,
+                                                       self.config.advanced.threshold_for_skipping)):
+                pending.add(*row)
+
+    def ranged(self, label):
+        """Check if the units of a workflow are stored as lumi ranges.
+
+        See the `unit_ranges` option of
+        :class:`~lobster.core.config.AdvancedOptions`.
+        """
+        if label not in self.__ranges:
+            row = self.db.execute("select unit_ranges from workflows where label=?", (label,)).fetchone()
+            if row is None:
+                return False
+            self.__ranges[label] = bool(row[0])
+        return self.__ranges[label]
+
+    def last_lumi(self, label):
+        """SQL expression for the last lumi of a unit of a workflow.
+        """
+        if self.ranged(label):
+            return "units_{0}.last_lumi".format(label)
+        return "units_{0}.lumi".format(label)
+
+    def width(self, label):
+        """SQL expression for the number of lumis in a unit of a workflow.
+        """
+        if self.ranged(label):
+            return "(units_{0}.last_lumi - units_{0}.lumi + 1)".format(label)
+        return "1"
+
+    def split_unit(self, label, id, at):
+        """Split a unit range in two.
+
+        The lumis before `at` are moved into a new unit, which inherits
+        the task, status, and failure count of the original unit.
+
+        Parameters
+        ----------
+            label : str
+                The workflow the unit belongs to.
+            id : int
+                The id of the unit to split.
+            at : int
+                The first lumi to remain in the original unit.
+
+        Returns
+        -------
+            id : int
+                The id of the new unit.
+        """
+        cur = self.db.cursor()
+        cur.execute("""
+            insert into units_{0}(task, run, lumi, last_lumi, file, status, failed, arg)
+            select task, run, lumi, ?, file, status, failed, arg
+            from units_{0}
+            where id=?""".format(label), (at - 1, id))
+        self.db.execute("update units_{0} set lumi=? where id=?".format(label), (at, id))
+        return cur.lastrowid
+
+    def split_updates(self, label, updates):
+        """Convert updates of single lumis to updates of units.
+
+        Unit ranges containing lumis with different new states are split,
+        so that every unit can be updated as a whole.
+
+        Parameters
+        ----------
+            label : str
+                The workflow the units belong to.
+            updates : list
+                A list of tuples of new status, unit id, and lumi.
+
+        Returns
+        -------
+            updates : list
+                A list of tuples of new status and unit id.
+        """
+        if not self.ranged(label):
+            return list(set((status, id) for (status, id, _) in updates))
+
+        lumis = defaultdict(dict)
+        for (status, id, lumi) in updates:
+            lumis[id][lumi] = status
+
+        res = []
+        ids = lumis.keys()
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            rows = self.db.execute("select id, lumi, last_lumi from units_{0} where id in ({1})".format(
+                label, ', '.join('?' for _ in chunk)), chunk).fetchall()
+            for id, first, last in rows:
+                changes = lumis[id]
+                for l in range(first + 1, last + 1):
+                    if changes.get(l) != changes.get(l - 1):
+                        new = self.split_unit(label, id, l)
+                        if first in changes:
+                            res.append((changes[first], new))
+                        first = l
+                if first in changes:
+                    res.append((changes[first], id))
+        return res
+
+    def skip_files(self, label, file_updates):
+        """Update the skip counters of files in the pending index.
+
+        Parameters
+        ----------
+            label : str
+                The workflow the files belong to.
+            file_updates : list
+                A list of tuples with events read, the increase of the
+                skip counter, and the file id.
+        """
+        if label not in self.__pending:
+            return
+        pending = self.__pending[label]
+        for (_, skipped, id) in file_updates:
+            if skipped == 0:
+                continue
+            skipped += pending.skipped(id)
+            pending.skip(id, skipped)
+            if skipped >= self.config.advanced.threshold_for_skipping:
+                pending.discard(id)
 
     def max_taskid(self):
         maxid = self.db.execute(
             'select ifnull(max(id), 0) from tasks').fetchone()[0]
         return maxid
 
+    @serialized
     def register_dataset(self, wflow, dataset_info, taskruntime=None):
         label = wflow.label
         unique_args = wflow.unique_arguments
 
+        with self.transaction():
+            self.create_dataset(wflow, dataset_info, taskruntime)
+            self.register_files(dataset_info.files, label, unique_args)
+            # Datasets reading their files lazily know how many units they
+            # contain only once all files have been registered
+            self.db.execute("""update workflows set
+                units=?,
+                units_masked=?,
+                units_left=?,
+                stop_on_file_boundary=?
+                where label=?""", (
+                dataset_info.total_units * len(unique_args),
+                dataset_info.masked_units * len(unique_args),
+                (dataset_info.total_units - dataset_info.masked_units) * len(unique_args),
+                getattr(dataset_info, 'stop_on_file_boundary', False),
+                label))
+            self.create_indices(label)
+
+    def create_dataset(self, wflow, dataset_info, taskruntime):
+        label = wflow.label
+        unique_args = wflow.unique_arguments
+        ranged = self.config.advanced.unit_ranges and not dataset_info.file_based
+
         cur = self.db.cursor()
         cur.execute("""insert into workflows
                        (dataset,
@@ -201,9 +1186,10 @@ class UnitStore:
                        units_masked,
                        units_left,
                        events,
-                       stop_on_file_boundary
+                       stop_on_file_boundary,
+                       unit_ranges
                        )
-                       values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
+                       values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
             wflow.label,
             label,
             wflow.label,
@@ -216,10 +1202,14 @@ class UnitStore:
             dataset_info.tasksize,
             taskruntime,
             dataset_info.total_units * len(unique_args),
-            dataset_info.masked_units,
-            dataset_info.total_units * len(unique_args),
+            dataset_info.masked_units * len(unique_args),
+            (dataset_info.total_units - dataset_info.masked_units) * len(unique_args),
             dataset_info.total_events,
-            getattr(dataset_info, 'stop_on_file_boundary', False)))
+            getattr(dataset_info, 'stop_on_file_boundary', False),
+            ranged))
+        self.__ranges[label] = ranged
+        if self.profile is not None:
+            self.profile.add_labels([label])
 
         self.db.execute("""create table if not exists files_{0}(
             id integer primary key autoincrement,
@@ -230,65 +1220,131 @@ class UnitStore:
             units_running int default 0,
             events int,
             events_read int default 0,
-            bytes int default 0)""".format(label))
+            bytes int default 0,
+            location text)""".format(label))
 
         cur.execute("""create table if not exists units_{0}(
             id integer primary key autoincrement,
             task integer,
             run integer,
-            lumi integer,
+            lumi integer,{1}
             file integer,
             status integer default 0,
             failed integer default 0,
             arg text,
             foreign key(task) references tasks(id),
-            foreign key(file) references files_{0}(id))""".format(label))
+            foreign key(file) references files_{0}(id))""".format(label, "\n            last_lumi integer," if ranged else ""))
+
+    def create_indices(self, label):
+        """Create the indices of the file and unit tables of a workflow.
 
+        Done after the initial bulk load of the workflow, as filling an
+        indexed table is considerably slower.
+        """
         self.db.execute("create index if not exists index_f_filename_{0} on files_{0}(filename)".format(label))
         self.db.execute("create index if not exists index_u_events_{0} on units_{0}(run, lumi)".format(label))
         self.db.execute("create index if not exists index_u_files_{0} on units_{0}(file, status)".format(label))
         self.db.execute("create index if not exists index_u_task_{0} on units_{0}(task)".format(label))
-        self.db.commit()
-
-        self.register_files(dataset_info.files, label, unique_args)
 
+    @serialized
     def register_dependency(self, label, parent, total_units):
-        with self.db as db:
-            db.execute("""
+        with self.transaction():
+            self.db.execute("""
                         update workflows
                         set
                             parent=(select id from workflows where label=?),
+                            units_left=(units_left + ? - units),
                             units=?
-                        where label=?""", (parent, total_units, label)
-                       )
+                        where label=?""", (parent, total_units, total_units, label)
+                            )
+
+    @serialized
+    def register_files(self, infos, label, unique_args=None, batchsize=50000):
+        """Register files and their units with a workflow.
+
+        Files are consumed one at a time and their units are written to
+        the database in batches, so that the memory needed does not grow
+        with the size of the dataset.
 
-    def register_files(self, infos, label, unique_args=None):
-        with self.db as db:
+        Parameters
+        ----------
+            infos : dict or iterable
+                Either a dictionary mapping filenames to `FileInfo`
+                objects, or an iterable yielding `(filename, FileInfo)`
+                tuples.
+            label : str
+                The workflow to register the files with.
+            unique_args : list
+                The arguments to create units with.  Every lumi of a file
+                results in one unit per argument.
+            batchsize : int
+                How many units to collect before writing them to the
+                database.
+        """
+        with self.transaction():
+            db = self.db
             cur = db.cursor()
+            first = db.execute("select ifnull(max(id), 0) from units_{0}".format(label)).fetchone()[0]
 
             if unique_args is None:
                 unique_args = [None]
 
-            update = []
-            # Sort for reproducable unit tests.
-            if len(infos) < 25:
-                items = [(fn, infos[fn]) for fn in sorted(infos.keys())]
+            ranged = self.ranged(label)
+            if ranged:
+                insert = "insert into units_{0}(file, run, lumi, last_lumi, arg) values (?, ?, ?, ?, ?)".format(label)
             else:
-                items = infos.items()
-            for fn, info in items:
+                insert = "insert into units_{0}(file, run, lumi, arg) values (?, ?, ?, ?)".format(label)
+
+            if isinstance(infos, dict):
+                # Sort for reproducable unit tests.
+                if len(infos) < 25:
+                    infos = [(fn, infos[fn]) for fn in sorted(infos.keys())]
+                else:
+                    infos = infos.iteritems()
+
+            start = time.time()
+            files = 0
+            units = 0
+            update = []
+            for fn, info in infos:
+                # Datasets may know where their files are stored, otherwise
+                # use the server of files given as URL
+                location = getattr(info, 'location', None) or urlparse.urlparse(fn).netloc or None
                 cur.execute(
-                    """insert into files_{0}(units, events, filename, bytes) values (?, ?, ?, ?)""".format(
+                    """insert into files_{0}(units, events, filename, bytes, location) values (?, ?, ?, ?, ?)""".format(
                         label),
-                    (len(info.lumis) * len(unique_args), info.events, fn, info.size))
+                    (len(info.lumis) * len(unique_args), info.events, fn, info.size, location))
                 fid = cur.lastrowid
+                files += 1
+                if label in self.__pending:
+                    self.__pending[label].add_file(fid, fn, location=location)
 
                 for arg in unique_args:
-                    update += [(fid, run, lumi, arg)
-                               for (run, lumi) in info.lumis]
-            self.db.executemany(
-                "insert into units_{0}(file, run, lumi, arg) values (?, ?, ?, ?)".format(label), update)
+                    if ranged:
+                        update += [(fid, run, lumi, last, arg)
+                                   for (run, lumi, last) in ranges(info.lumis)]
+                    else:
+                        update += [(fid, run, lumi, arg)
+                                   for (run, lumi) in info.lumis]
+                units += len(info.lumis) * len(unique_args)
+                if len(update) >= batchsize:
+                    db.executemany(insert, update)
+                    update = []
+                    logger.info("registered {0} units in {1} files for {2} ({3:.0f} units/s)".format(
+                        units, files, label, units / max(time.time() - start, 1e-6)))
+            db.executemany(insert, update)
+            logger.debug("registered {0} units in {1} files for {2} in {3:.1f} s".format(
+                units, files, label, time.time() - start))
+
+            self.update_counters(label, available=units)
             self.update_workflow_stats(label)
 
+            if label in self.__pending:
+                for row in self.db.execute(
+                        "select id, file, run, lumi, {1}, arg, failed from units_{0} where id > ?".format(
+                            label, self.last_lumi(label)), (first,)):
+                    self.__pending[label].add(*row)
+
     def work_left(self, label):
         """
         Get information about what is left to do for a workflow.
@@ -314,7 +1370,36 @@ class UnitStore:
             (label,)).fetchone()
         return complete, units_left, tasks_left
 
-    @retry(stop_max_attempt_number=10)
+    def throughput(self, since):
+        """Get the recent throughput of processing tasks per workflow.
+
+        Parameters
+        ----------
+            since : int
+                The earliest retrieval time of tasks to consider, in
+                seconds since the epoch.
+
+        Returns
+        -------
+            throughput : dict
+                A dictionary with workflow labels as keys, and tuples
+                containing the number of processing tasks retrieved, and
+                the mean time on the worker of successful tasks, scaled
+                to the default task size, as values.  The latter is `None`
+                if no task succeeded.
+        """
+        rows = self.db.execute("""
+            select
+                workflows.label,
+                count(*),
+                avg(case when tasks.status in (2, 6, 7, 8) and tasks.units > 0
+                    then tasks.time_on_worker * workflows.tasksize * 1. / tasks.units end)
+            from tasks, workflows
+            where tasks.workflow=workflows.id and tasks.type=0 and tasks.time_retrieved>=?
+            group by workflows.label""", (since,))
+        return dict((label, (count, runtime)) for (label, count, runtime) in rows)
+
+    @serialized
     def pop_units(self, workflow, num, taper=1.):
         """Create tasks from a workflow.
 
@@ -327,7 +1412,7 @@ class UnitStore:
             taper : int
                 Factor to apply to the tasksize.
         """
-        with self.db:
+        with self.transaction():
             workflow_id, tasksize, stop_on_file_boundary = self.db.execute(
                 "select id, tasksize, stop_on_file_boundary from workflows where label=?",
                 (workflow,)).fetchone()
@@ -346,31 +1431,11 @@ class UnitStore:
             )
             )
 
-            fileinfo = list(self.db.execute("""select id, filename
-                        from files_{0}
-                        where
-                            (units_done + units_running < units) and
-                            (skipped < ?)
-                        order by skipped asc""".format(workflow), (self.config.advanced.threshold_for_skipping,)))
-            files = [x for (x, y) in fileinfo]
-            fileinfo = dict(fileinfo)
-
+            pending = self.pending(workflow)
             tasksize = int(math.ceil(tasksize * taper))
 
             logger.debug("creating tasks with adjusted size {}".format(tasksize))
 
-            rows = []
-            for i in range(0, len(files), 40):
-                chunk = files[i:i + 40]
-                rows.extend(self.db.execute("""
-                    select id, file, run, lumi, arg, failed
-                    from units_{0}
-                    where file in ({1}) and status not in (1, 2, 6, 7, 8)
-                    order by file
-                    """.format(workflow, ', '.join('?' for _ in chunk)), chunk))
-
-            logger.debug("creating tasks from {} files, {} units".format(len(files), len(rows)))
-
             # files and lumis for individual tasks
             files = set()
             units = []
@@ -380,19 +1445,24 @@ class UnitStore:
             current_size = 0
 
             def insert_task(files, units, arg):
+                if self.config.advanced.locality:
+                    for file, count in Counter(file for (_, file, _, _) in units).items():
+                        pending.running(file, count)
+
                 cur = self.db.cursor()
                 cur.execute("insert into tasks(workflow, status, type) values (?, 1, 0)", (workflow_id,))
                 task_id = cur.lastrowid
+                cur.execute("insert into inflight(task, workflow) values (?, ?)", (task_id, workflow))
 
                 tasks.append((
                     str(task_id),
                     workflow,
-                    [(id, fileinfo[id]) for id in files],
+                    [(id, pending.filename(id)) for id in files],
                     units,
                     arg,
                     False))
 
-            for id, file, run, lumi, arg, failed in rows:
+            for id, file, run, lumi, last, arg, failed in pending.take():
                 if failed > self.config.advanced.threshold_for_failure:
                     logger.debug("skipping run {}, "
                                  "lumi {} "
@@ -404,6 +1474,9 @@ class UnitStore:
                 if failed == self.config.advanced.threshold_for_failure:
                     logger.debug("creating isolation task for run {}, lumi {} with failure count {}".format(
                         run, lumi, failed))
+                    if last > lumi:
+                        pending.add(id, file, run, lumi + 1, last, arg, failed)
+                        id = self.split_unit(workflow, id, lumi + 1)
                     insert_task([file], [(id, file, run, lumi)], arg)
                     continue
 
@@ -420,12 +1493,20 @@ class UnitStore:
                 # add the current unit to a new task, but have already
                 # created enough tasks.
                 if current_size == 0 and num <= 0:
+                    pending.add(id, file, run, lumi, last, arg, failed)
                     break
 
-                units.append((id, file, run, lumi))
+                # Split unit ranges that do not fit into the task
+                if current_size + last - lumi + 1 > tasksize:
+                    at = lumi + tasksize - current_size
+                    pending.add(id, file, run, at, last, arg, failed)
+                    id = self.split_unit(workflow, id, at)
+                    last = at - 1
+
+                units.extend((id, file, run, l) for l in range(lumi, last + 1))
                 files.add(file)
 
-                current_size += 1
+                current_size += last - lumi + 1
 
                 if current_size == tasksize:
                     insert_task(files, units, arg)
@@ -439,54 +1520,73 @@ class UnitStore:
             if current_size > 0:
                 insert_task(files, units, arg)
 
-            workflow_update = []
-            file_update = defaultdict(int)
-            task_update = defaultdict(int)
-            unit_update = []
+            file_update = Counter()
+            task_update = []
+            unit_update = set()
 
             for (task, label, files, units, arg, merge) in tasks:
-                workflow_update += units
-                task_update[task] = len(units)
-                unit_update += [(task, id) for (id, file, run, lumi) in units]
-                for (id, filename) in files:
-                    file_update[
-                        id] += len(filter(lambda tpl: tpl[1] == id, units))
+                task_update.append((len(units), task))
+                for (id, file, run, lumi) in units:
+                    file_update[file] += 1
+                    unit_update.add((task, id))
 
-            self.db.execute(
-                "update workflows set units_running=(units_running + ?) where id=?",
-                (len(workflow_update), workflow_id))
+            count = sum(file_update.values())
+            self.update_counters(workflow, running=count, available=-count)
 
             self.db.executemany("update files_{0} set units_running=(units_running + ?) where id=?".format(workflow),
                                 [(v, k) for (k, v) in file_update.items()])
-            self.db.executemany("update tasks set units=? where id=?",
-                                [(v, k) for (k, v) in task_update.items()])
+            self.db.executemany("update tasks set units=? where id=?", task_update)
             self.db.executemany("update units_{0} set status=1, task=? where id=?".format(workflow),
                                 unit_update)
 
-            return tasks if len(unit_update) > 0 else []
+            return tasks if count > 0 else []
 
+    @serialized
     def reset_units(self):
-        with self.db as db:
-            ids = [id for (id,) in db.execute(
-                "select id from tasks where status=1")]
-            db.execute("update workflows set units_running=0, merged=0")
-            db.execute("update tasks set status=4 where status=1")
-            db.execute("update tasks set status=2 where status=7")
-            for (label, dset_id) in db.execute("select label, id from workflows"):
-                db.execute(
-                    "update files_{0} set units_running=0".format(label))
-                db.execute(
-                    "update units_{0} set status=4 where status=1".format(label))
-                db.execute(
-                    "update units_{0} set status=2 where status=7".format(label))
+        """Abort all tasks in flight, after a restart.
+
+        Only the tasks recorded in the journal of tasks in flight, and
+        the workflows they belong to, are touched.
+
+        Returns
+        -------
+            tasks : list
+                A list of tuples with the id and workflow label of every
+                task aborted.
+        """
+        with self.transaction():
+            db = self.db
+            tasks = db.execute("select task, workflow from inflight").fetchall()
+            workflows = defaultdict(list)
+            for id, label in tasks:
+                workflows[label].append(id)
+
+            db.execute("update workflows set merged=0")
+            for label, ids in workflows.items():
+                before = self.count_units(label, ids)
+                for i in range(0, len(ids), 999):
+                    chunk = ids[i:i + 999]
+                    db.execute(
+                        "update units_{0} set status=4 where status=1 and task in ({1})".format(
+                            label, ', '.join('?' for _ in chunk)), chunk)
+                    db.execute("update tasks set status=4 where status=1 and id in ({0})".format(
+                        ', '.join('?' for _ in chunk)), chunk)
+                    db.execute("update tasks set status=2 where status=7 and task in ({0})".format(
+                        ', '.join('?' for _ in chunk)), chunk)
+                self.apply_counts(label, before, self.count_units(label, ids))
+                self.restore_units(label, ids)
                 self.update_workflow_stats(label)
-        return ids
+            db.execute("delete from inflight")
+        return tasks
 
-    @retry(stop_max_attempt_number=10)
-    def update_units(self, taskinfos):
+    @serialized
+    def update_units(self, taskinfos, transfers=None):
         task_updates = []
 
-        with self.db:
+        with self.transaction():
+            tasks = [task_update.id for updates in taskinfos.values() for (task_update, _, _) in updates]
+            before_tasks = self.count_tasks(tasks)
+
             for ((dset, unit_source), updates) in taskinfos.items():
                 file_updates = []
                 unit_updates = []
@@ -510,6 +1610,16 @@ class UnitStore:
                     unit_updates += unit_update
                     unit_generic_updates.append((unit_status, task_update.id))
 
+                # units of processing tasks change their state, count
+                # them to update the workflow accounting
+                if unit_source != 'tasks':
+                    unit_updates = self.split_updates(dset, unit_updates)
+                    tasks = [id for (_, id) in unit_generic_updates]
+                    before = self.count_units(dset, tasks)
+                    skipped = self.count_newly_skipped(dset, file_updates)
+                else:
+                    unit_updates = [(status, id) for (status, id, _) in unit_updates]
+
                 # update all units of the tasks
                 self.db.executemany("""update {0} set
                     status=?
@@ -532,44 +1642,404 @@ class UnitStore:
                 # update files in the workflow
                 if len(file_updates) > 0:
                     self.db.executemany("""update files_{0} set
-                        units_running=(select count(*) from units_{0} where file=files_{0}.id and status==1),
-                        units_done=(select count(*) from units_{0} where file=files_{0}.id and status==2),
                         events_read=(events_read + ?),
                         skipped=(skipped + ?)
                         where id=?""".format(dset),
                                         file_updates)
 
+                if unit_source != 'tasks':
+                    self.apply_counts(dset, before, self.count_units(dset, tasks), skipped)
+                    self.skip_files(dset, file_updates)
+                    self.restore_units(dset, tasks)
+
             query = "update tasks set {0} where id=?".format(
                 TaskUpdate.sql_fragment(stop=-1))
             self.db.executemany(query, task_updates)
+            self.db.executemany("delete from inflight where task=?", [(t.id,) for t in task_updates])
+
+            tasks = [task_update.id for task_update in task_updates]
+            self.apply_task_counts(before_tasks, self.count_tasks(tasks))
 
             for label, _ in taskinfos.keys():
                 self.update_workflow_stats(label)
 
+            if transfers:
+                self.update_transfers(transfers)
+
+    @serialized
     def update_workflow_stats_paused(self, roots=None):
         """Update workflow statistics after increasing thresholds.
 
         Happens only where needed, recursively traversing all dependency
         trees between workflows, issuing blanket updates if a parent
-        workflow is changed.
+        workflow is changed.  Changed thresholds alter which units are
+        paused, so the unit counters of the affected workflows are
+        recounted.
         """
         if roots is None:
             roots = [w for w in self.config.workflows if not w.parent]
-        with self.db:
+        with self.transaction():
+            for r in roots:
+                self.recount(r.label)
             for m in sum([list(r.family()) for r in roots], []):
+                self.__pending.pop(m.label, None)
                 self.db.execute("update workflows set merged=0 where label=?", (m.label,))
                 self.update_workflow_stats(m.label)
 
+    @serialized
     def update_workflow_runtime(self, updates):
         """Update workflow runtimes in the database.
 
         To synchronize runtimes present in the configuration with the ones
         in the database used for task size calculations.
         """
-        with self.db:
+        with self.transaction():
             self.db.executemany(
                 "update workflows set taskruntime=? where label=?", updates)
 
+    def count_units(self, label, tasks):
+        """Count the units of tasks by accounting state.
+
+        Parameters
+        ----------
+            label : str
+                The workflow the tasks belong to.
+            tasks : list
+                The ids of the tasks to count units for.
+
+        Returns
+        -------
+            counts : dict
+                A dictionary with file ids as keys and a `Counter` as
+                values, which contains the number of units that are
+                `running`, `done`, `paused`, or `available`.  Paused
+                units are further counted as `failed` and `skipped`,
+                which may overlap.
+        """
+        counts = defaultdict(Counter)
+        thresholds = (self.config.advanced.threshold_for_failure, self.config.advanced.threshold_for_skipping)
+        for i in range(0, len(tasks), 900):
+            chunk = tasks[i:i + 900]
+            rows = self.db.execute("""
+                select
+                    units_{0}.file,
+                    sum((units_{0}.status == 1) * {2}),
+                    sum((units_{0}.status in (2, 6, 7, 8)) * {2}),
+                    sum((units_{0}.status in (0, 3, 4) and (units_{0}.failed > ? or files_{0}.skipped >= ?)) * {2}),
+                    sum((units_{0}.status in (0, 3, 4) and not (units_{0}.failed > ? or files_{0}.skipped >= ?)) * {2}),
+                    sum((units_{0}.status in (0, 3, 4) and units_{0}.failed > ?) * {2}),
+                    sum((units_{0}.status in (0, 3, 4) and files_{0}.skipped >= ?) * {2})
+                from units_{0}, files_{0}
+                where units_{0}.file == files_{0}.id and units_{0}.task in ({1})
+                group by units_{0}.file""".format(label, ', '.join('?' for _ in chunk), self.width(label)),
+                                   thresholds * 3 + tuple(chunk))
+            for file, running, done, paused, available, failed, skipped in rows:
+                counts[file].update(running=running, done=done, paused=paused, available=available,
+                                    failed=failed, skipped=skipped)
+        return counts
+
+    def count_newly_skipped(self, label, file_updates):
+        """Count the units paused by files crossing the skipping threshold.
+
+        Has to be called before the file and unit updates are applied to
+        the database.  Units of returning tasks are still running at this
+        point and thus not included in the count.
+
+        Parameters
+        ----------
+            label : str
+                The workflow to look at.
+            file_updates : list
+                A list of tuples with events read, the increase of the
+                skip counter, and the file id.
+
+        Returns
+        -------
+            changes : Counter
+                The changes to the workflow counters: units that were
+                available and are now `paused`, and all newly `skipped`
+                units.
+        """
+        skips = Counter()
+        for (_, skipped, id) in file_updates:
+            skips[id] += skipped
+
+        changes = Counter()
+        threshold = self.config.advanced.threshold_for_skipping
+        for id, increment in skips.items():
+            if increment == 0:
+                continue
+            paused, skipped = self.db.execute("""
+                select ifnull(sum((failed <= ?) * {1}), 0), ifnull(sum({1}), 0)
+                from units_{0}
+                where
+                    file=? and status in (0, 3, 4) and
+                    (select skipped from files_{0} where id=?) between ? and ?""".format(label, self.width(label)),
+                                              (self.config.advanced.threshold_for_failure, id, id,
+                                               threshold - increment, threshold - 1)).fetchone()
+            changes.update(paused=paused, available=-paused, skipped=skipped)
+        return changes
+
+    def apply_counts(self, label, before, after, skipped=None):
+        """Update file and workflow counters with a change in unit states.
+
+        Parameters
+        ----------
+            label : str
+                The workflow to update.
+            before : dict
+                Counts of units per file, as returned by `count_units`,
+                before any change to the units.
+            after : dict
+                Counts of units per file after the change.
+            skipped : Counter
+                Changes to units not part of the change, due to newly
+                skipped files, as returned by `count_newly_skipped`.
+        """
+        total = Counter(skipped)
+        file_updates = []
+        for file in set(before.keys()) | set(after.keys()):
+            delta = Counter(after.get(file, {}))
+            delta.subtract(before.get(file, {}))
+            total.update(delta)
+            if delta['running'] != 0 or delta['done'] != 0:
+                file_updates.append((delta['running'], delta['done'], file))
+                if label in self.__pending:
+                    self.__pending[label].running(file, delta['running'])
+        self.db.executemany("""
+            update files_{0} set
+                units_running=(units_running + ?),
+                units_done=(units_done + ?)
+            where id=?""".format(label), file_updates)
+        self.update_counters(label, **total)
+
+    def update_counters(self, label, running=0, done=0, paused=0, available=0, failed=0, skipped=0):
+        """Shift the unit counters of a workflow.
+
+        A change in paused units is propagated to all dependent workflows,
+        which include the paused units of their parents in their own count.
+
+        Parameters
+        ----------
+            label : str
+                The workflow to update.
+            running : int
+                The change in running units.
+            done : int
+                The change in finished units.
+            paused : int
+                The change in paused units.
+            available : int
+                The change in units available for processing.
+            failed : int
+                The change in paused units that failed too often.
+            skipped : int
+                The change in paused units of files skipped too often.
+        """
+        if running == done == paused == available == failed == skipped == 0:
+            return
+
+        self.db.execute("""
+            update workflows set
+                units_running=(units_running + ?),
+                units_done=(units_done + ?),
+                units_paused=(units_paused + ?),
+                units_available=(units_available + ?),
+                units_failed=(units_failed + ?),
+                units_skipped=(units_skipped + ?),
+                units_left=(units_left - ?)
+            where label=?""", (running, done, paused, available, failed, skipped, running + done + paused, label))
+
+        if paused != 0:
+            parents = [label]
+            while len(parents) > 0:
+                children = [child for (child,) in self.db.execute("""
+                    select label
+                    from workflows
+                    where parent in (select id from workflows where label in ({0}))""".format(
+                    ', '.join('?' for _ in parents)), parents)]
+                self.db.executemany("""
+                    update workflows set
+                        units_paused=(units_paused + ?),
+                        units_left=(units_left - ?)
+                    where label=?""", [(paused, paused, child) for child in children])
+                parents = children
+
+    def count_tasks(self, tasks):
+        """Sum up processing tasks for the workflow summary.
+
+        Parameters
+        ----------
+            tasks : list
+                The ids of the tasks to sum up.  Processing tasks merged
+                by any of these tasks are included.
+
+        Returns
+        -------
+            counts : dict
+                A dictionary with workflow labels as keys and a `Counter`
+                as values, which contains the `events_read` and
+                `events_written` by successful processing tasks, and the
+                units of merged processing tasks, `units_merged`.
+        """
+        counts = defaultdict(Counter)
+        for i in range(0, len(tasks), 450):
+            chunk = tuple(tasks[i:i + 450])
+            rows = self.db.execute("""
+                select
+                    workflows.label,
+                    sum(tasks.events_read),
+                    sum(tasks.events_written),
+                    sum(case when tasks.status == 8 then tasks.units_processed else 0 end)
+                from tasks, workflows
+                where
+                    tasks.workflow == workflows.id and
+                    tasks.type == 0 and
+                    tasks.status in (2, 6, 7, 8) and
+                    (tasks.id in ({0}) or tasks.task in ({0}))
+                group by workflows.label""".format(', '.join('?' for _ in chunk)), chunk * 2)
+            for label, read, written, merged in rows:
+                counts[label].update(events_read=read, events_written=written, units_merged=merged)
+        return counts
+
+    def apply_task_counts(self, before, after):
+        """Update the workflow summary with a change in task states.
+
+        Parameters
+        ----------
+            before : dict
+                Task sums per workflow, as returned by `count_tasks`,
+                before any change to the tasks.
+            after : dict
+                Task sums per workflow after the change.
+        """
+        updates = []
+        for label in set(before.keys()) | set(after.keys()):
+            delta = Counter(after.get(label, {}))
+            delta.subtract(before.get(label, {}))
+            if any(delta.values()):
+                updates.append((delta['events_read'], delta['events_written'], delta['units_merged'], label))
+        self.db.executemany("""
+            update workflows set
+                events_read=(events_read + ?),
+                events_written=(events_written + ?),
+                units_merged=(units_merged + ?)
+            where label=?""", updates)
+
+    def recount(self, label, fix=True):
+        """Verify the unit counters and summary of a workflow.
+
+        Recounts all units of the workflow and its files, and sums up its
+        tasks, which is expensive and should only be done to check the
+        consistency of the counters.  Dependent workflows are recounted,
+        too, as they contain the paused units of their parent in their own
+        count.
+
+        Parameters
+        ----------
+            label : str
+                The workflow to verify.
+            fix : bool
+                Overwrite wrong counters with the recounted values.
+
+        Returns
+        -------
+            mismatches : list
+                A list of tuples containing the workflow label, the name
+                of the counter, and the stored and actual value.
+        """
+        mismatches = []
+        columns = ['units_running', 'units_done', 'units_paused', 'units_available', 'units_left',
+                   'units_failed', 'units_skipped', 'events_read', 'events_written', 'units_merged', 'merge_tasks']
+
+        id, parent, total, masked = self.db.execute(
+            "select id, parent, units, units_masked from workflows where label=?", (label,)).fetchone()
+        parent_paused = 0
+        if parent is not None:
+            parent_paused = self.db.execute("select units_paused from workflows where id=?", (parent,)).fetchone()[0]
+
+        thresholds = (self.config.advanced.threshold_for_failure, self.config.advanced.threshold_for_skipping)
+        running, done, paused, available, failed, skipped = self.db.execute("""
+            select
+                ifnull(sum((units_{0}.status == 1) * {1}), 0),
+                ifnull(sum((units_{0}.status in (2, 6, 7, 8)) * {1}), 0),
+                ifnull(sum((units_{0}.status in (0, 3, 4) and (units_{0}.failed > ? or files_{0}.skipped >= ?)) * {1}), 0),
+                ifnull(sum((units_{0}.status in (0, 3, 4) and not (units_{0}.failed > ? or files_{0}.skipped >= ?)) * {1}), 0),
+                ifnull(sum((units_{0}.status in (0, 3, 4) and units_{0}.failed > ?) * {1}), 0),
+                ifnull(sum((units_{0}.status in (0, 3, 4) and files_{0}.skipped >= ?) * {1}), 0)
+            from units_{0}, files_{0}
+            where units_{0}.file == files_{0}.id""".format(label, self.width(label)), thresholds * 3).fetchone()
+        paused += parent_paused
+
+        read, written, merged, merges = self.db.execute("""
+            select
+                ifnull(sum(case when type == 0 and status in (2, 6, 7, 8) then events_read else 0 end), 0),
+                ifnull(sum(case when type == 0 and status in (2, 6, 7, 8) then events_written else 0 end), 0),
+                ifnull(sum(case when type == 0 and status == 8 then units_processed else 0 end), 0),
+                ifnull(sum(type == 1), 0)
+            from tasks
+            where workflow=?""", (id,)).fetchone()
+
+        actual = (running, done, paused, available, total - (masked + running + done + paused),
+                  failed, skipped, read, written, merged, merges)
+
+        stored = self.db.execute(
+            "select {0} from workflows where label=?".format(', '.join(columns)), (label,)).fetchone()
+        for column, have, want in zip(columns, stored, actual):
+            if have != want:
+                mismatches.append((label, column, have, want))
+        if fix and actual != stored:
+            self.db.execute("update workflows set {0} where label=?".format(
+                ', '.join(c + '=?' for c in columns)), actual + (label,))
+
+        # as for the workflow, units of files are done when successful,
+        # published, or merged
+        files = self.db.execute("""
+            select
+                files_{0}.id,
+                files_{0}.units_running,
+                files_{0}.units_done,
+                ifnull(sum((units_{0}.status == 1) * {1}), 0),
+                ifnull(sum((units_{0}.status in (2, 6, 7, 8)) * {1}), 0)
+            from files_{0} left join units_{0} on units_{0}.file == files_{0}.id
+            group by files_{0}.id""".format(label, self.width(label))).fetchall()
+        for file, stored_running, stored_done, running, done in files:
+            if (stored_running, stored_done) != (running, done):
+                mismatches.append((label, 'file {0}'.format(file), (stored_running, stored_done), (running, done)))
+                if fix:
+                    self.db.execute(
+                        "update files_{0} set units_running=?, units_done=? where id=?".format(label),
+                        (running, done, file))
+
+        for (child,) in self.db.execute("select label from workflows where parent=?", (id,)).fetchall():
+            mismatches += self.recount(child, fix)
+
+        return mismatches
+
+    @serialized
+    def verify_counters(self, fix=True):
+        """Verify the unit counters of all workflows.
+
+        See `recount` for details.
+
+        Parameters
+        ----------
+            fix : bool
+                Overwrite wrong counters with the recounted values.
+
+        Returns
+        -------
+            mismatches : list
+                A list of tuples containing the workflow label, the name
+                of the counter, and the stored and actual value.
+        """
+        mismatches = []
+        with self.transaction():
+            for (label,) in self.db.execute("select label from workflows where parent is null").fetchall():
+                mismatches += self.recount(label, fix)
+        return mismatches
+
+    @profiled
     def update_workflow_stats(self, label):
         id, size, targettime = self.db.execute(
             "select id, tasksize, taskruntime from workflows where label=?", (label,)).fetchone()
@@ -596,44 +2066,6 @@ class UnitStore:
                     self.db.execute(
                         "update workflows set tasksize=? where id=?", (bettersize, id))
 
-        parent_paused = self.db.execute("""
-            select
-                ifnull((
-                    case when parent is not null
-                    then
-                        (select units_paused from workflows where workflows.id == wf.parent)
-                    else 0
-                    end
-                ), 0)
-            from workflows as wf where id == ?
-            """, (id,)).fetchone()[0]
-
-        self.db.execute("""
-            update workflows set
-                units_running=ifnull((select count(*) from units_{0} where status == 1), 0),
-                units_done=ifnull((select count(*) from units_{0} where status in (2, 6, 7, 8)), 0),
-                units_paused=ifnull((
-                        select count(*)
-                        from units_{0}
-                        where
-                            (file in (select id from files_{0} where skipped >= ?) and status in (0, 3, 4)) or
-                            (failed > ? and status in (0, 3, 4))
-                    ), 0) + ?
-            where label=?""".format(label),
-                        (self.config.advanced.threshold_for_failure,
-                         self.config.advanced.threshold_for_skipping, parent_paused, label,)
-                        )
-
-        self.db.execute("""
-            update workflows set
-                units_available=ifnull((select count(*) from units_{0}), 0) - (units_running + units_done + (units_paused - ?)),
-                units_left=units - (units_masked + units_running + units_done + units_paused)
-            where label=?""".format(label), (parent_paused, label))
-
-        if self.db.execute("select units_paused from workflows where label=?", (label,)).fetchone()[0] > 0:
-            for (child,) in self.db.execute("select label from workflows where parent=?", (id,)):
-                self.update_workflow_stats(child)
-
         if logger.getEffectiveLevel() <= logging.DEBUG:
             size, total, running, done, paused, available, left = self.db.execute("""
                 select tasksize, units, units_running, units_done, units_paused, units_available, units_left
@@ -696,23 +2128,22 @@ class UnitStore:
             select
                 label,
                 events,
-                ifnull((select sum(events_read) from tasks where workflow=workflows.id and status in (2, 6, 7, 8) and type=0), 0),
-                ifnull((select sum(events_written) from tasks where workflow=workflows.id and status in (2, 6, 7, 8) and type=0), 0),
+                events_read,
+                events_written,
                 units,
                 units - units_masked,
                 units_done,
-                ifnull((select sum(units_processed) from tasks where workflow=workflows.id and status=8 and type=0), 0),
+                units_merged,
                 units_paused,
+                units_failed,
+                units_skipped,
                 '' || round(
                         units_done * 100.0 / (units - units_masked),
                     1) || ' %',
                 '' || ifnull(round(
-                        ifnull((
-                            select sum(units_processed)
-                            from tasks
-                            where workflow=workflows.id and status=8 and type=0
-                        ), 0) * 100.0 / (units - units_masked),
-                    1), 0.0) || ' %'
+                        units_merged * 100.0 / (units - units_masked),
+                    1), 0.0) || ' %',
+                not (merge_tasks == 0 and merged)
             from workflows""")
 
         yield "Label Events read written Units unmasked written merged paused failed skipped Progress Merged".split()
@@ -720,22 +2151,7 @@ class UnitStore:
         total = None
         total_mergeable = 0
         for row in cursor:
-            failed, skipped, mergeable = self.db.execute("""
-                select
-                    ifnull((
-                        select count(*)
-                        from units_{0}
-                        where failed > ? and status in (0, 3, 4)
-                    ), 0),
-                    ifnull((
-                        select count(*)
-                        from units_{0}
-                        where file in (select id from files_{0} where skipped >= ?) and status in (0, 3, 4)
-                    ), 0),
-                    not ((select count(id) from tasks where workflow=workflows.id and type=1) == 0 and merged)
-                from workflows where label=?
-                """.format(row[0]), (self.config.advanced.threshold_for_failure, self.config.advanced.threshold_for_skipping, row[0])).fetchone()
-            row = row[:-2] + (failed, skipped) + row[-2:]
+            row, mergeable = row[:-1], row[-1]
             if total is None:
                 total = list(row[1:-2])
             else:
@@ -749,7 +2165,7 @@ class UnitStore:
             '{} %'.format(round(total[-4] * 100. / total_mergeable, 1) if total_mergeable > 0 else 0.)
         ]
 
-    @retry(stop_max_attempt_number=10)
+    @serialized
     def pop_unmerged_tasks(self, workflow, bytes, num):
         """Method to get merge tasks.
 
@@ -770,7 +2186,7 @@ class UnitStore:
             return []
         elif bytes <= 0:
             logger.debug("fully merged {0}".format(workflow))
-            with self.db:
+            with self.transaction():
                 self.db.execute(
                     """update workflows set merged=1 where id=?""", (dset_id,))
             return []
@@ -816,7 +2232,7 @@ class UnitStore:
             def left(self):
                 return self.maxsize - self.size
 
-        with self.db:
+        with self.transaction():
             # Select the finished processing tasks from the task
             rows = self.db.execute("""
                 select id, units, bytes_bare_output
@@ -828,22 +2244,27 @@ class UnitStore:
             # merge, set this up so that the loop below is not evaluted and we
             # skip to the check if the merge for this workflow is complete for
             # the given maximum size.
-            if len(rows) < 2 or rows[-2][1] + rows[-1][1] > bytes:
+            if len(rows) < 2 or rows[-2][2] + rows[-1][2] > bytes:
                 rows = []
             else:
-                minsize = rows[-1][1]
+                minsize = rows[-1][2]
 
+            # Best fit decreasing: add each task to the merge with the
+            # least size left that can still hold it.  Merges are kept
+            # sorted by size left, as tuples with their index.
             candidates = []
+            space = []
             for task, units, size in rows:
-                # Try to add the current task to a merge, in increasing order of
-                # size left
-                for merge in reversed(sorted(candidates)):
-                    if merge.add(task, units, size):
-                        break
-                else:
-                    # If we're too large to merge, we're skipped
-                    if size + minsize <= bytes:
-                        candidates.append(Merge(task, units, size, bytes))
+                i = bisect_left(space, (size,))
+                if i < len(space):
+                    _, n = space.pop(i)
+                    merge = candidates[n]
+                    merge.add(task, units, size)
+                    insort(space, (merge.left(), n))
+                # If we're too large to merge, we're skipped
+                elif size + minsize <= bytes:
+                    candidates.append(Merge(task, units, size, bytes))
+                    insort(space, (bytes - size, len(candidates) - 1))
 
             merges = []
             for merge in reversed(sorted(candidates)):
@@ -874,6 +2295,7 @@ class UnitStore:
                     insert into
                     tasks(workflow, units, status, type)
                     values (?, ?, ?, ?)""", (dset_id, merge.units, ASSIGNED, MERGE)).lastrowid
+                self.db.execute("insert into inflight(task, workflow) values (?, ?)", (merge_id, workflow))
                 logger.debug("inserted merge task {0} with tasks {1}".format(
                     merge_id, ", ".join(map(str, merge.tasks))))
                 res += [(str(merge_id), workflow, [], [(id, None, -1, -1)
@@ -882,14 +2304,17 @@ class UnitStore:
 
             if len(res) > 0:
                 self.db.executemany(
-                    "update tasks set status=7, task=? where id=?", merge_update)
+                    "update tasks set status=7, task=? where id=?", sorted(merge_update, key=lambda (_, id): id))
+                self.db.execute(
+                    "update workflows set merge_tasks=(merge_tasks + ?) where id=?", (len(res), dset_id))
                 self.update_workflow_stats(workflow)
 
             return res
 
+    @serialized
     def update_published(self, label, tasks, block):
         update = [(block, t) for t in tasks]
-        with self.db:
+        with self.transaction():
             self.db.executemany("""
                 update tasks
                 set status=6, published_file_block=?
@@ -947,28 +2372,42 @@ class UnitStore:
             label), (self.config.advanced.threshold_for_skipping,))
         return [xs[0] for xs in files]
 
+    @serialized
     def update_pset_hash(self, pset_hash, workflow):
-        with self.db as conn:
-            conn.execute(
+        with self.transaction():
+            self.db.execute(
                 "update workflows set pset_hash=? where label=?", (pset_hash, workflow))
 
-    @retry(stop_max_attempt_number=10)
+    @serialized
     def update_missing(self, tasks):
-        with self.db:
+        with self.transaction():
+            before_tasks = self.count_tasks(tasks)
+
+            missing = defaultdict(list)
             for task, workflow in self.db.execute("""
                     select tasks.id, workflows.label
                     from tasks, workflows
                     where tasks.id in ({0}) and tasks.workflow=workflows.id""".format(", ".join(map(str, tasks)))):
-                self.db.execute(
-                    "update units_{0} set status=3 where task=?".format(workflow), (task,))
+                missing[workflow].append(task)
+
+            for workflow, ids in missing.items():
+                before = self.count_units(workflow, ids)
+                self.db.executemany(
+                    "update units_{0} set status=3 where task=?".format(workflow), [(id,) for id in ids])
+                self.apply_counts(workflow, before, self.count_units(workflow, ids))
+                self.restore_units(workflow, ids)
 
             # update tasks to be failed
             self.db.executemany("update tasks set status=3 where id=?", [
                                 (task,) for task in tasks])
+            self.db.executemany("delete from inflight where task=?", [(task,) for task in tasks])
             # reset merged tasks from merging
             self.db.executemany("update tasks set status=2 where task=?", [
                                 (task,) for task in tasks])
 
+            self.apply_task_counts(before_tasks, self.count_tasks(tasks))
+
+    @serialized
     def finished_files(self, infos):
         res = []
         for label, files in infos.items():
@@ -984,14 +2423,80 @@ class UnitStore:
 
         return (x[0] for x in res)
 
-    def update_transfers(self, transfers):
-        for dataset in transfers:
-            data = json.loads(self.db.execute(
-                "select transfers from workflows where dataset=?", (dataset,)).fetchone()[0])
+    @profiled
+    def update_transfers(self, transfers, now=None):
+        """Add transfer outcomes to the current time bin.
+
+        Parameters
+        ----------
+            transfers : dict
+                A dictionary with workflow labels as keys, containing
+                dictionaries with protocols as keys and a `Counter` of
+                outcomes as values.
+            now : int
+                The time to account the transfers to, defaults to the
+                current time.
+        """
+        if now is None:
+            now = time.time()
+        time_bin = int(now) // TRANSFER_BIN * TRANSFER_BIN
+
+        updates = []
+        for label, protocols in transfers.items():
+            (workflow,) = self.db.execute("select id from workflows where label=?", (label,)).fetchone()
+            for protocol, outcomes in protocols.items():
+                updates += [(workflow, protocol, outcome, time_bin, count) for (outcome, count) in outcomes.items() if count > 0]
+
+        # upsert that works with SQLite versions lacking `on conflict`
+        self.db.executemany("""
+            insert or ignore into transfers(workflow, protocol, outcome, time_bin)
+            values (?, ?, ?, ?)""", [u[:-1] for u in updates])
+        self.db.executemany("""
+            update transfers set
+                count=(count + ?)
+            where workflow=? and protocol=? and outcome=? and time_bin=?""", [u[-1:] + u[:-1] for u in updates])
+
+    def transfer_history(self, start=None, end=None):
+        """Return transfer outcomes per time bin.
+
+        Parameters
+        ----------
+            start : int
+                The earliest time to return, in seconds since the epoch.
+            end : int
+                The latest time to return.
 
-            for protocol in transfers[dataset]:
-                if protocol in data:
-                    transfers[dataset][protocol] += Counter(data[protocol])
+        Returns
+        -------
+            history : list
+                A list of tuples with the workflow label, protocol,
+                outcome, start of the time bin, and count.  Totals
+                imported from older projects are not included.
+        """
+        return self.db.execute("""
+            select workflows.label, transfers.protocol, transfers.outcome, transfers.time_bin, transfers.count
+            from transfers, workflows
+            where transfers.workflow == workflows.id
+                and transfers.time_bin > 0
+                and transfers.time_bin + ? >= ifnull(?, 0)
+                and transfers.time_bin <= ifnull(?, transfers.time_bin)
+            order by transfers.time_bin""", (TRANSFER_BIN, start, end)).fetchall()
+
+    def transfer_totals(self):
+        """Return the total transfer outcomes per workflow.
 
-            self.db.execute("update workflows set transfers=? where dataset=?", (json.dumps(
-                transfers[dataset]), dataset))
+        Returns
+        -------
+            totals : dict
+                A dictionary with workflow labels as keys, containing
+                dictionaries with protocols as keys and a `Counter` of
+                outcomes as values.
+        """
+        totals = defaultdict(lambda: defaultdict(Counter))
+        for label, protocol, outcome, count in self.db.execute("""
+                select workflows.label, transfers.protocol, transfers.outcome, sum(transfers.count)
+                from transfers, workflows
+                where transfers.workflow == workflows.id
+                group by transfers.workflow, transfers.protocol, transfers.outcome"""):
+            totals[label][protocol][outcome] = count
+        return totals
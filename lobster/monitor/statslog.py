@@ -0,0 +1,218 @@
+import os
+import struct
+
+# Statistics are written as fixed-width records of little-endian doubles,
+# preceded by a header naming the columns.  Logs can be appended to
+# cheaply, and mapped into memory to be read, e.g., with `numpy.memmap`
+# and the results of `layout`.  Older versions of Lobster wrote
+# whitespace separated text, with a header line starting with `#` written
+# at every start.  These logs can still be read with `read`, and are
+# converted with `convert`.
+
+MAGIC = 'LOBSTATS'
+VERSION = 1
+DTYPE = '<f8'
+
+# magic, version, number of columns, offset of the first record
+HEADER = struct.Struct('<8sIII')
+
+
+def write_header(f, columns):
+    """Write the header of a binary statistics log.
+
+    Parameters
+    ----------
+        f : file
+            The file to write to, positioned at its start.
+        columns : list
+            The names of the columns.
+    """
+    names = '\0'.join(columns)
+    offset = HEADER.size + len(names)
+    # align records to their size
+    padding = -offset % struct.calcsize('<d')
+    f.write(HEADER.pack(MAGIC, VERSION, len(columns), offset + padding) + names + '\0' * padding)
+
+
+def read_header(f):
+    """Read the header of a binary statistics log.
+
+    Parameters
+    ----------
+        f : file
+            The file to read from, positioned at its start.
+
+    Returns
+    -------
+        columns : list
+            The names of the columns.
+        offset : int
+            The position of the first record in the file.
+    """
+    magic, version, count, offset = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("not a binary statistics log: {0}".format(f.name))
+    if version != VERSION:
+        raise ValueError("unsupported version {0} of statistics log: {1}".format(version, f.name))
+    columns = f.read(offset - HEADER.size).rstrip('\0').split('\0')
+    if len(columns) != count:
+        raise ValueError("corrupt header of statistics log: {0}".format(f.name))
+    return columns, offset
+
+
+def is_binary(filename):
+    """Check if a statistics log is in the binary format.
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def layout(filename):
+    """Determine where the records of a binary statistics log are.
+
+    Returns
+    -------
+        columns : list
+            The names of the columns.
+        offset : int
+            The position of the first record in the file.
+        count : int
+            The number of complete records.
+    """
+    with open(filename, 'rb') as f:
+        columns, offset = read_header(f)
+    size = struct.calcsize('<d') * len(columns)
+    return columns, offset, (os.path.getsize(filename) - offset) // size
+
+
+def read(filename):
+    """Read a statistics log, in either the binary or text format.
+
+    When the columns of a text log change after a restart, all columns
+    are returned, with missing values and values that are not numbers
+    set to NaN.
+
+    Returns
+    -------
+        columns : list
+            The names of the columns.
+        records : iterator
+            The records as tuples of floats.
+    """
+    if is_binary(filename):
+        columns, offset, count = layout(filename)
+        record = struct.Struct('<{0}d'.format(len(columns)))
+
+        def binary():
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                for start in range(0, count, 4096):
+                    data = f.read(record.size * min(4096, count - start))
+                    for n in range(0, len(data), record.size):
+                        yield record.unpack_from(data, n)
+        return columns, binary()
+
+    columns = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('#'):
+                columns.extend(c for c in line[1:].split() if c not in columns)
+
+    def text():
+        index = None
+        with open(filename) as f:
+            for line in f:
+                fields = line.split()
+                if line.startswith('#'):
+                    index = [columns.index(c) for c in line[1:].split()]
+                    continue
+                elif index is None or len(fields) == 0:
+                    continue
+                values = [float('nan')] * len(columns)
+                for i, value in zip(index, fields):
+                    try:
+                        values[i] = float(value)
+                    except ValueError:
+                        pass
+                yield tuple(values)
+    return columns, text()
+
+
+def convert(source, target, columns=None):
+    """Copy a statistics log to a new binary one.
+
+    Parameters
+    ----------
+        source : str
+            The statistics log to read, in either format.
+        target : str
+            The binary statistics log to write.  Must not exist yet.
+        columns : list
+            The columns to write, defaults to the ones of `source`.
+            Columns not present in `source` are filled with NaN.
+    """
+    names, records = read(source)
+    if columns is None:
+        columns = names
+    index = [names.index(c) if c in names else None for c in columns]
+
+    log = StatsLog(target, columns)
+    for record in records:
+        log.write([float('nan') if i is None else record[i] for i in index])
+    log.close()
+
+
+class StatsLog(object):
+
+    """A binary statistics log to append records to.
+
+    Records are buffered until the log is flushed.  An existing log with
+    different columns, e.g., written by another version of Lobster, is
+    rewritten with the new columns, dropping the ones no longer present.
+
+    Parameters
+    ----------
+        filename : str
+            The path to the log.
+        columns : list
+            The names of the columns.
+    """
+
+    def __init__(self, filename, columns):
+        self.filename = filename
+        self.columns = list(columns)
+        self.__record = struct.Struct('<{0}d'.format(len(self.columns)))
+
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as f:
+                write_header(f, self.columns)
+        else:
+            existing, offset, count = layout(filename)
+            if existing != self.columns:
+                tmpname = filename + '.tmp'
+                if os.path.exists(tmpname):
+                    os.unlink(tmpname)
+                convert(filename, tmpname, self.columns)
+                os.rename(tmpname, filename)
+            else:
+                # drop an incomplete record of an interrupted write
+                with open(filename, 'r+b') as f:
+                    f.truncate(offset + count * self.__record.size)
+
+        self.__file = open(filename, 'ab', 1 << 16)
+
+    def write(self, values):
+        """Append a record.
+
+        Parameters
+        ----------
+            values : list
+                The values of the record, in the order of the columns.
+        """
+        self.__file.write(self.__record.pack(*map(float, values)))
+
+    def flush(self):
+        self.__file.flush()
+
+    def close(self):
+        self.__file.close()
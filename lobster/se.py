@@ -646,8 +646,8 @@ class StorageConfiguration(Configurable):
         if self.shuffle_outputs or (self.shuffle_inputs and merge):
             random.shuffle(self.output)
 
-        parameters['input'] = self.input if not merge else self.output
-        parameters['output'] = self.output
+        parameters['input'] = list(self.input if not merge else self.output)
+        parameters['output'] = list(self.output)
         parameters['disable streaming'] = self.disable_input_streaming
         if not self.disable_stage_in_acceleration:
             parameters['accelerate stage-in'] = 3
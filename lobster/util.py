@@ -9,14 +9,15 @@
 # scope.
 
 import collections
+import errno
 import inspect
 import json
 import logging
 import os
 import shlex
-import shutil
 import smtplib
 import subprocess
+import threading
 import time
 
 from contextlib import contextmanager
@@ -286,11 +287,13 @@ def record(cls, *fields, **defaults):
 class Timing(object):
 
     """
-    Baseclass to simplify keeping track of the timing of things.
+    Baseclass to simplify keeping track of the timing of things.  Times
+    measured in several threads are added up.
     """
 
     def __init__(self, *keys):
         self._times = {k: 0 for k in keys}
+        self._times_lock = threading.Lock()
 
     @property
     def times(self):
@@ -300,7 +303,8 @@ class Timing(object):
     def measure(self, what):
         t = time.time()
         yield
-        self._times[what] += int((time.time() - t) * 1e6)
+        with self._times_lock:
+            self._times[what] += int((time.time() - t) * 1e6)
 
 
 def id2dir(id):
@@ -468,10 +472,39 @@ def get_lock(workdir, force=False):
     return pidfile
 
 
-def taskdir(workdir, taskid, status='running'):
-    tdir = os.path.normpath(os.path.join(workdir, status, id2dir(taskid)))
-    if not os.path.isdir(tdir):
-        os.makedirs(tdir)
+def makedirs(path):
+    """Create a directory and its parents, if not present yet.
+
+    Safe to call from several threads creating the same directories, or
+    removing empty ones, as `move` does.
+    """
+    while True:
+        try:
+            os.makedirs(path)
+            return
+        except OSError as e:
+            if os.path.isdir(path):
+                return
+            # retry if a parent was removed as empty in the meantime
+            if e.errno not in (errno.EEXIST, errno.ENOENT) or os.path.isfile(path):
+                raise
+
+
+def taskpath(workdir, taskid, status='running', moved=True):
+    """Returns the parameter/log directory of a task.
+
+    Task directories are kept in a sub-directory per status when `moved`
+    is set.  Otherwise, they stay in the sub-directory `tasks` whatever the
+    status, which is only recorded in the database.
+    """
+    if not moved:
+        status = 'tasks'
+    return os.path.normpath(os.path.join(workdir, status, id2dir(taskid)))
+
+
+def taskdir(workdir, taskid, status='running', moved=True):
+    tdir = taskpath(workdir, taskid, status, moved)
+    makedirs(tdir)
     return tdir
 
 
@@ -482,13 +515,22 @@ def move(workdir, taskid, status, oldstatus='running'):
     Returns the new directory.
     """
     # See above for task id splitting.  Moves directories and removes
-    # old empty directories.
+    # old empty directories.  Called from several threads at once, which
+    # may create and remove the same parent directories concurrently.
     old = os.path.normpath(os.path.join(workdir, oldstatus, id2dir(taskid)))
     new = os.path.normpath(os.path.join(workdir, status, id2dir(taskid)))
-    parent = os.path.dirname(new)
-    if not os.path.isdir(parent):
-        os.makedirs(parent)
-    shutil.move(old, parent)
-    if len(os.listdir(os.path.dirname(old))) == 0:
+    while True:
+        makedirs(os.path.dirname(new))
+        try:
+            os.rename(old, new)
+            break
+        except OSError as e:
+            # retry if the new parent was removed as empty in the meantime
+            if e.errno != errno.ENOENT or not os.path.exists(old):
+                raise
+    try:
         os.removedirs(os.path.dirname(old))
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOENT, errno.ENOTEMPTY):
+            raise
     return new
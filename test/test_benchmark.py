@@ -0,0 +1,346 @@
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+from lobster import se
+from lobster.cmssw.dataset import DatasetInfo
+from lobster.core.task import MergeTaskHandler, TaskHandler
+from lobster.core.unit import TaskUpdate, UnitStore
+from lobster.core.config import Config, AdvancedOptions
+from lobster.core.workflow import Workflow
+
+# Benchmarks take a while to set up and are only run when requested.  The
+# size of the workflow can be adjusted with `LOBSTER_BENCHMARK_UNITS`, and
+# units stored as lumi ranges with `LOBSTER_BENCHMARK_RANGES`.  The project
+# lifecycle benchmark uses a synthetic dataset shaped by
+# `LOBSTER_BENCHMARK_LUMIS`, `LOBSTER_BENCHMARK_FILES`, and
+# `LOBSTER_BENCHMARK_ARGS`, the number of unique arguments.
+
+
+def synthesize(lumis, files, split=.1, seed=1):
+    """Create a dataset with lumis spread evenly over files.
+
+    A fraction `split` of the files shares its last lumi with the next
+    file, as happens for lumis split across files.
+    """
+    rnd = random.Random(seed)
+    info = DatasetInfo()
+    info.path = ''
+    per_file = max(lumis // files, 1)
+    for i in range(files):
+        first = i * per_file + 1
+        last = lumis if i == files - 1 else first + per_file - 1
+        if i < files - 1 and rnd.random() < split:
+            last += 1
+        f = '/test/{0}.root'.format(i)
+        info.files[f].lumis = [(1 + l // 10000, l) for l in range(first, last + 1)]
+        info.files[f].events = len(info.files[f].lumis) * 100
+        info.files[f].size = len(info.files[f].lumis) * 1000000
+    info.total_units = sum(len(i.lumis) for i in info.files.values())
+    info.total_events = info.total_units * 100
+    return info
+
+
+def rss():
+    """Peak resident memory of the process, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+if 'LOBSTER_BENCHMARK' in os.environ:
+    class TestReleaseBenchmark(object):
+
+        units = int(os.environ.get('LOBSTER_BENCHMARK_UNITS', 5000000))
+        ranges = 'LOBSTER_BENCHMARK_RANGES' in os.environ
+        units_per_file = 100
+        tasksize = 100
+        tasks = 1000
+        batch = 100
+
+        @classmethod
+        def setup_class(cls):
+            os.environ['LOCALRT'] = ''
+            cls.workdir = tempfile.mkdtemp()
+            cls.store = UnitStore(
+                Config(
+                    label='benchmark',
+                    workdir=cls.workdir,
+                    storage=se.StorageConfiguration(output=['file://' + cls.workdir]),
+                    workflows=[],
+                    advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3", unit_ranges=cls.ranges)
+                )
+            )
+
+            info = DatasetInfo()
+            info.tasksize = cls.tasksize
+            info.path = ''
+            for i in range(cls.units // cls.units_per_file):
+                f = '/test/{0}.root'.format(i)
+                info.files[f].events = cls.units_per_file * 100
+                info.files[f].lumis = [(i + 1, l + 1) for l in range(cls.units_per_file)]
+            info.total_units = cls.units
+            info.total_events = cls.units * 100
+
+            start = time.time()
+            cls.store.register_dataset(Workflow('benchmark', None), info)
+            print "registered {0} units in {1:.1f} s".format(cls.units, time.time() - start)
+            size = sum(os.path.getsize(fn) for fn in (cls.store.db_path, cls.store.db_path + '-wal') if os.path.exists(fn))
+            print "database size {0:.1f} MB".format(size / 1e6)
+
+        @classmethod
+        def teardown_class(cls):
+            cls.store.disconnect()
+            shutil.rmtree(cls.workdir)
+
+        def test_release(self):
+            rnd = random.Random(1)
+            durations = []
+            for n in range(self.tasks // self.batch):
+                updates = []
+                for (id, label, files, lumis, arg, _) in self.store.pop_units('benchmark', self.batch):
+                    handler = TaskHandler(id, label, files, lumis, None, True)
+                    task_update = TaskUpdate(host='benchmark', id=id)
+                    outcome = rnd.random()
+                    if outcome < .1:
+                        file_update, unit_update = handler.get_unit_info(True, task_update, {}, [], 0)
+                    else:
+                        # drop some lumis, or skip files, for some tasks
+                        files_info = {}
+                        files_skipped = []
+                        for (fid, fn) in files:
+                            processed = [(r, l) for (_, f, r, l) in lumis if f == fid]
+                            if outcome < .2:
+                                files_skipped.append(fn)
+                                continue
+                            elif outcome < .3:
+                                processed = processed[:-1]
+                            files_info[fn] = (len(processed) * 100, processed)
+                        file_update, unit_update = handler.get_unit_info(
+                            False, task_update, files_info, files_skipped, 0)
+                    updates.append((task_update, file_update, unit_update))
+
+                start = time.time()
+                self.store.update_units({('benchmark', 'units_benchmark'): updates})
+                durations.append(time.time() - start)
+
+            durations.sort()
+            print "released {0} tasks in batches of {1}: total {2:.2f} s, median {3:.3f} s, max {4:.3f} s".format(
+                self.tasks, self.batch, sum(durations), durations[len(durations) // 2], durations[-1])
+
+            assert self.store.verify_counters(fix=False) == []
+
+    class TestTaskBenchmark(object):
+
+        files = 5000
+
+        @classmethod
+        def setup_class(cls):
+            os.environ['LOCALRT'] = ''
+            cls.workdir = tempfile.mkdtemp()
+            cls.store = UnitStore(
+                Config(
+                    label='benchmark',
+                    workdir=cls.workdir,
+                    storage=se.StorageConfiguration(output=['file://' + cls.workdir]),
+                    workflows=[],
+                    advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3")
+                )
+            )
+
+        @classmethod
+        def teardown_class(cls):
+            cls.store.disconnect()
+            shutil.rmtree(cls.workdir)
+
+        def test_obtain_many_files(self):
+            info = DatasetInfo()
+            info.file_based = True
+            info.tasksize = self.files
+            info.path = ''
+            for i in range(self.files):
+                info.files['/test/{0}.root'.format(i)].lumis = [(-1, -1)]
+            info.total_units = self.files
+            self.store.register_dataset(Workflow('many', None), info)
+
+            start = time.time()
+            (_, _, files, _, _, _) = self.store.pop_units('many', 1)[0]
+            print "created a task of {0} files in {1:.3f} s".format(len(files), time.time() - start)
+
+        def test_release_many_files(self):
+            files = [(i, '/test/{0}.root'.format(i)) for i in range(2000)]
+            lumis = [(i * 5 + j, i, 1, i * 5 + j) for i in range(2000) for j in range(5)]
+            random.Random(1).shuffle(lumis)
+
+            files_info = dict((fn, (500, [(1, i * 5 + j) for j in range(4)])) for i, fn in files[:1000])
+            files_skipped = [fn for _, fn in files[1000:1500]]
+
+            start = time.time()
+            handler = TaskHandler(1, "test", files, lumis, [], None)
+            handler.get_unit_info(False, TaskUpdate(), files_info, files_skipped, 0)
+            print "processed the report of a task with {0} files in {1:.3f} s".format(len(files), time.time() - start)
+
+    class TestMergeBenchmark(object):
+
+        tasks = 100000
+        merge_size = 3500000000
+
+        @classmethod
+        def setup_class(cls):
+            os.environ['LOCALRT'] = ''
+            cls.workdir = tempfile.mkdtemp()
+            cls.store = UnitStore(
+                Config(
+                    label='benchmark',
+                    workdir=cls.workdir,
+                    storage=se.StorageConfiguration(output=['file://' + cls.workdir]),
+                    workflows=[],
+                    advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3")
+                )
+            )
+
+            info = DatasetInfo()
+            info.tasksize = 1
+            info.path = ''
+            info.files['/test/0.root'].lumis = [(1, 1)]
+            info.total_units = cls.tasks
+            cls.store.register_dataset(Workflow('merge', None), info)
+
+            # Output sizes roughly follow a log-normal distribution around
+            # 50 MB, with a tail of tasks too large to be merged at all.
+            rnd = random.Random(1)
+            workflow = cls.store.db.execute("select id from workflows where label='merge'").fetchone()[0]
+            with cls.store.db:
+                cls.store.db.executemany(
+                    "insert into tasks(workflow, status, type, units, bytes_bare_output) values (?, 2, 0, 1, ?)",
+                    [(workflow, int(rnd.lognormvariate(math.log(50e6), 1.))) for _ in range(cls.tasks)])
+
+        @classmethod
+        def teardown_class(cls):
+            cls.store.disconnect()
+            shutil.rmtree(cls.workdir)
+
+        def test_merge(self):
+            start = time.time()
+            merges = self.store.pop_unmerged_tasks('merge', self.merge_size, 10)
+            duration = time.time() - start
+
+            sizes = dict(self.store.db.execute("select id, bytes_bare_output from tasks where type=0"))
+            filled = [sum(sizes[id] for (id, _, _, _) in merged) for (_, _, _, merged, _, _) in merges]
+            print "packed {0} tasks into {1} merges in {2:.2f} s, mean fill {3:.3f}".format(
+                sum(len(merged) for (_, _, _, merged, _, _) in merges), len(merges), duration,
+                sum(filled) / float(len(filled) * self.merge_size))
+
+            assert all(self.merge_size * .9 <= size <= self.merge_size for size in filled)
+
+    class TestLifecycleBenchmark(object):
+
+        lumis = int(os.environ.get('LOBSTER_BENCHMARK_LUMIS', 100000))
+        files = int(os.environ.get('LOBSTER_BENCHMARK_FILES', 1000))
+        args = int(os.environ.get('LOBSTER_BENCHMARK_ARGS', 1))
+        ranges = 'LOBSTER_BENCHMARK_RANGES' in os.environ
+        tasksize = 50
+        batch = 500
+        merge_size = 2000000000
+
+        @classmethod
+        def setup_class(cls):
+            os.environ['LOCALRT'] = ''
+            cls.workdir = tempfile.mkdtemp()
+            cls.store = UnitStore(
+                Config(
+                    label='benchmark',
+                    workdir=cls.workdir,
+                    storage=se.StorageConfiguration(output=['file://' + cls.workdir]),
+                    workflows=[],
+                    advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3", unit_ranges=cls.ranges)
+                )
+            )
+            cls.info = synthesize(cls.lumis, cls.files)
+            cls.info.tasksize = cls.tasksize
+
+        @classmethod
+        def teardown_class(cls):
+            cls.store.disconnect()
+            shutil.rmtree(cls.workdir)
+
+        def report(self, phase, start, detail=''):
+            self.store.flush()
+            size = sum(os.path.getsize(fn) for fn in (self.store.db_path, self.store.db_path + '-wal') if os.path.exists(fn))
+            print "{0:>10}: {1:8.2f} s, peak RSS {2:7.1f} MB, database {3:7.1f} MB{4}".format(
+                phase, time.time() - start, rss(), size / 1e6, detail)
+
+        def release(self, rnd, label, tasks):
+            updates = []
+            for (id, label, files, lumis, arg, _) in tasks:
+                handler = TaskHandler(id, label, files, lumis, None, True)
+                task_update = TaskUpdate(host='benchmark', id=id)
+                outcome = rnd.random()
+                if outcome < .05:
+                    file_update, unit_update = handler.get_unit_info(True, task_update, {}, [], 0)
+                else:
+                    files_info = {}
+                    for (fid, fn) in files:
+                        processed = [(r, l) for (_, f, r, l) in lumis if f == fid]
+                        if outcome < .1:
+                            processed = processed[:-1]
+                        files_info[fn] = (len(processed) * 100, processed)
+                    task_update.bytes_bare_output = int(rnd.lognormvariate(math.log(50e6), 1.))
+                    file_update, unit_update = handler.get_unit_info(False, task_update, files_info, [], 0)
+                updates.append((task_update, file_update, unit_update))
+            self.store.update_units({(label, 'units_' + label): updates})
+
+        def test_lifecycle(self):
+            rnd = random.Random(1)
+            label = 'lifecycle'
+            workflow = Workflow(label, None, merge_size=self.merge_size,
+                                unique_arguments=['arg{0}'.format(i) for i in range(self.args)] if self.args > 1 else None)
+
+            print "{0} lumis in {1} files, {2} unique arguments".format(self.lumis, self.files, self.args)
+
+            start = time.time()
+            self.store.register_dataset(workflow, self.info)
+            self.report('register', start, ', {0} units'.format(self.info.total_units * self.args))
+
+            start = time.time()
+            popped = 0
+            released = 0
+            durations = []
+            while True:
+                pop = time.time()
+                tasks = self.store.pop_units(label, self.batch)
+                popped += time.time() - pop
+                if len(tasks) == 0:
+                    break
+                release = time.time()
+                self.release(rnd, label, tasks)
+                durations.append(time.time() - release)
+                released += len(tasks)
+            self.report('process', start, ', {0} tasks, popping {1:.2f} s, releasing {2:.2f} s'.format(
+                released, popped, sum(durations)))
+
+            start = time.time()
+            merges = 0
+            while True:
+                tasks = self.store.pop_unmerged_tasks(label, self.merge_size, 100)
+                if len(tasks) == 0:
+                    break
+                updates = []
+                for (id, label, _, merged, _, _) in tasks:
+                    handler = MergeTaskHandler(id, label, [], merged, None, True)
+                    task_update = TaskUpdate(host='benchmark', id=id)
+                    _, unit_update = handler.get_unit_info(False, task_update, {}, [], 0)
+                    updates.append((task_update, [], unit_update))
+                self.store.update_units({(label, 'tasks'): updates})
+                merges += len(tasks)
+            self.report('merge', start, ', {0} merge tasks'.format(merges))
+
+            start = time.time()
+            for _ in range(100):
+                list(self.store.workflow_status())
+            self.report('status', start, ', 100 summaries')
+
+            assert self.store.verify_counters(fix=False) == []
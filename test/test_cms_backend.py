@@ -1,19 +1,24 @@
 # vim: foldmethod=marker
+import json
 import os
+import pickle
 import shutil
+import sqlite3
 import tempfile
+import time
+from collections import Counter
 
-from lobster import cmssw, se
+from lobster import cmssw, se, util
 from lobster.cmssw.dataset import DatasetInfo
-from lobster.core.task import TaskHandler
-from lobster.core.unit import TaskUpdate, UnitStore
+from lobster.core.task import MergeTaskHandler, TaskHandler
+from lobster.core.unit import TaskUpdate, UnitStore, copy_database
 from lobster.core.config import Config, AdvancedOptions
 from lobster.core.workflow import Workflow
 
 
 class DummyInterface(object):
 
-    def update_units(self, data):
+    def update_units(self, data, transfers=None):
         self.data = data
 
 
@@ -31,6 +36,7 @@ class TestSQLBackend(object):
     def setup(self):
         with self.interface.db as db:
             db.execute("delete from workflows")
+            db.execute("delete from inflight")
 
     @classmethod
     def setup_class(cls):
@@ -482,7 +488,7 @@ class TestSQLBackend(object):
             {
                 '/test/2.root': (300, [(1, 7), (1, 8), (1, 9)]),
                 '/test/3.root': (300, [(1, 10), (1, 11), (1, 12)]),
-                '/test/4.root': (100, [(1, 13)]),
+                '/test/4.root': (100, [(1, 13), (1, 14)]),
             },
             [],
             100
@@ -653,6 +659,591 @@ class TestSQLBackend(object):
         assert ew == 100
         # }}}
 
+    def test_file_obtain_many(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_file_dataset(
+                'test_file_obtain_many', 5000, 5000))
+
+        (id, label, files, lumis, arg, _) = self.interface.pop_units('test_file_obtain_many', 1)[0]
+
+        assert len(files) == 5000
+        assert len(lumis) == 5000
+
+        (jr, fr, fmax) = self.interface.db.execute("""
+            select
+                units_running,
+                (select sum(units_running) from files_test_file_obtain_many),
+                (select max(units_running) from files_test_file_obtain_many)
+            from workflows where label=?""", (label,)).fetchone()
+
+        assert jr == 5000
+        assert fr == 5000
+        assert fmax == 1
+        # }}}
+
+    def test_register_files_batched(self):
+        # {{{
+        wflow, info = self.create_dbs_dataset(
+            'test_register_files_batched', lumis=20, filesize=2.2, tasksize=3)
+        files = info.files
+        info.files = {}
+        self.interface.register_dataset(wflow, info)
+
+        indices = [name for (name,) in self.interface.db.execute(
+            "select name from sqlite_master where type='index' and tbl_name like '%_test_register_files_batched'")]
+        assert len(indices) == 4
+
+        # Load the pending units to check that they are kept in sync
+        self.interface.pending('test_register_files_batched')
+        self.interface.register_files(
+            ((fn, files[fn]) for fn in sorted(files.keys())), 'test_register_files_batched', batchsize=4)
+
+        (units, available, fcount) = self.interface.db.execute("""
+            select
+                (select count(*) from units_test_register_files_batched),
+                units_available,
+                (select count(*) from files_test_register_files_batched)
+            from workflows where label=?""", ('test_register_files_batched',)).fetchone()
+
+        assert units == info.total_units
+        assert available == info.total_units
+        assert fcount == len(files)
+        assert self.interface.verify_counters(fix=False) == []
+
+        tasks = self.interface.pop_units('test_register_files_batched', 100)
+        assert sum(len(lumis) for (_, _, _, lumis, _, _) in tasks) == info.total_units
+        # }}}
+
+    def test_workflow_status(self):
+        # {{{
+        def recompute(label):
+            return self.interface.db.execute("""
+                select
+                    (select sum(events_read) from tasks where workflow=workflows.id and status in (2, 6, 7, 8) and type=0),
+                    (select sum(events_written) from tasks where workflow=workflows.id and status in (2, 6, 7, 8) and type=0),
+                    ifnull((select sum(units_processed) from tasks where workflow=workflows.id and status=8 and type=0), 0),
+                    (select count(*) from units_{0} where failed > 0 and status in (0, 3, 4)),
+                    (select count(*) from units_{0} where file in (select id from files_{0} where skipped >= 2) and status in (0, 3, 4))
+                from workflows where label=?""".format(label), (label,)).fetchone()
+
+        def status(label):
+            for row in self.interface.workflow_status():
+                if row[0] == label:
+                    return (row[2], row[3], row[7], row[9], row[10])
+
+        with util.PartiallyMutable.unlock():
+            self.interface.config.advanced.threshold_for_failure = 0
+            self.interface.config.advanced.threshold_for_skipping = 2
+
+        try:
+            self.interface.register_dataset(
+                *self.create_dbs_dataset(
+                    'test_status', lumis=20, filesize=2.2, tasksize=3))
+
+            updates = []
+            tasks = self.interface.pop_units('test_status', 6)
+            for n, (id, label, files, lumis, arg, _) in enumerate(tasks):
+                task_update = TaskUpdate(host='hostname', id=id, bytes_bare_output=100)
+                handler = TaskHandler(id, label, files, lumis, None, True)
+                if n < 3:
+                    files_info = dict((f, (200, [(r, l) for (_, u, r, l) in lumis if u == i])) for (i, f) in files)
+                    file_update, unit_update = handler.get_unit_info(False, task_update, files_info, [], 50 * n)
+                elif n < 4:
+                    file_update, unit_update = handler.get_unit_info(False, task_update, {}, [files[0][1]], 0)
+                else:
+                    file_update, unit_update = handler.get_unit_info(True, task_update, {}, [], 0)
+                updates.append((task_update, file_update, unit_update))
+            self.interface.update_units({(label, "units_" + label): updates})
+
+            assert status(label) == recompute(label)
+            assert status(label)[3] > 0
+            assert status(label)[4] > 0
+
+            (merge_id, _, _, merged, _, _) = self.interface.pop_unmerged_tasks(label, 200, 10)[0]
+            task_update = TaskUpdate(host='hostname', id=merge_id)
+            handler = MergeTaskHandler(merge_id, label, [], merged, None, True)
+            _, unit_update = handler.get_unit_info(False, task_update, {}, [], 0)
+            self.interface.update_units({(label, "tasks"): [(task_update, [], unit_update)]})
+
+            assert status(label) == recompute(label)
+            assert status(label)[2] > 0
+
+            self.interface.update_missing([merge_id])
+
+            assert status(label) == recompute(label)
+            assert self.interface.verify_counters(fix=False) == []
+        finally:
+            with util.PartiallyMutable.unlock():
+                self.interface.config.advanced.threshold_for_failure = 30
+                self.interface.config.advanced.threshold_for_skipping = 30
+        # }}}
+
+    def test_merge_packing(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_merge_packing', lumis=6, filesize=1, tasksize=1))
+
+        updates = []
+        sizes = {}
+        for size, (id, label, files, lumis, arg, _) in zip(
+                [60, 50, 40, 30, 20, 10], self.interface.pop_units('test_merge_packing', 6)):
+            task_update = TaskUpdate(host='hostname', id=id, bytes_bare_output=size)
+            handler = TaskHandler(id, label, files, lumis, None, True)
+            files_info = dict((f, (100, [(r, l) for (_, u, r, l) in lumis if u == i])) for (i, f) in files)
+            file_update, unit_update = handler.get_unit_info(False, task_update, files_info, [], 100)
+            updates.append((task_update, file_update, unit_update))
+            sizes[int(id)] = size
+        self.interface.update_units({(label, "units_" + label): updates})
+
+        merges = self.interface.pop_unmerged_tasks(label, 100, 10)
+
+        assert sorted(sorted(sizes[id] for (id, _, _, _) in merged) for (_, _, _, merged, _, _) in merges) == \
+            [[20, 30, 50], [40, 60]]
+        # }}}
+
+    def test_writer(self):
+        # {{{
+        assert self.interface.db.execute("pragma journal_mode").fetchone()[0] == 'wal'
+
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_writer', lumis=20, filesize=2.2, tasksize=3))
+        (id, label, files, lumis, arg, _) = self.interface.pop_units('test_writer', 1)[0]
+
+        # readers see a consistent snapshot and do not block the writer
+        reader = sqlite3.connect(self.interface.db_path, timeout=1)
+        reader.execute("begin")
+        query = "select units_running from workflows where label=?"
+        assert reader.execute(query, (label,)).fetchone()[0] == 3
+
+        task_update = TaskUpdate(host='hostname', id=id, submissions=1)
+        handler = TaskHandler(id, label, files, lumis, None, True)
+        file_update, unit_update = handler.get_unit_info(True, task_update, {}, [], 0)
+
+        self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]}, wait=False)
+        self.interface.flush()
+
+        assert reader.execute(query, (label,)).fetchone()[0] == 3
+        reader.rollback()
+        assert reader.execute(query, (label,)).fetchone()[0] == 0
+        reader.close()
+
+        # failed changes not waited for stop all further changes
+        store = UnitStore(self.interface.config)
+        store.update_units({('test_nonexistent', 'units_test_nonexistent'): [
+            (task_update, file_update, unit_update)]}, wait=False)
+        for i in range(2):
+            try:
+                store.pop_units('test_writer', 1)
+                assert False
+            except sqlite3.OperationalError:
+                pass
+        store.disconnect()
+        # }}}
+
+    def test_reset_units(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_reset_units', lumis=20, filesize=2.2, tasksize=3))
+
+        tasks = self.interface.pop_units('test_reset_units', 3)
+        (id, label, files, lumis, arg, _) = tasks[0]
+        task_update = TaskUpdate(host='hostname', id=id)
+        handler = TaskHandler(id, label, files, lumis, None, True)
+        file_update, unit_update = handler.get_unit_info(
+            False, task_update, dict((f, (200, [(r, l) for (_, u, r, l) in lumis if u == i])) for (i, f) in files), [], 0)
+        self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+
+        aborted = self.interface.reset_units()
+
+        assert sorted(aborted) == sorted((int(t[0]), label) for t in tasks[1:])
+        assert self.interface.db.execute(
+            "select count(*) from tasks where status=1 and workflow=(select id from workflows where label=?)",
+            (label,)).fetchone()[0] == 0
+        assert self.interface.verify_counters(fix=False) == []
+        assert self.interface.reset_units() == []
+        # }}}
+
+    def test_unit_ranges(self):
+        # {{{
+        with util.PartiallyMutable.unlock():
+            self.interface.config.advanced.unit_ranges = True
+
+        try:
+            self.interface.register_dataset(
+                *self.create_dbs_dataset(
+                    'test_unit_ranges', lumis=20, filesize=10, tasksize=3))
+
+            assert self.interface.db.execute(
+                "select lumi, last_lumi from units_test_unit_ranges").fetchall() == [(1, 10), (11, 20)]
+
+            tasks = self.interface.pop_units('test_unit_ranges', 2)
+            (id, label, files, lumis, arg, _) = tasks[0]
+
+            assert [(r, l) for (_, _, r, l) in lumis] == [(1, 1), (1, 2), (1, 3)]
+            assert [(r, l) for (_, _, r, l) in tasks[1][3]] == [(1, 4), (1, 5), (1, 6)]
+
+            task_update = TaskUpdate(host='hostname', id=id)
+            handler = TaskHandler(id, label, files, lumis, None, True)
+            file_update, unit_update = handler.get_unit_info(
+                False, task_update, {'/test/0.root': (200, [(1, 1), (1, 3)])}, [], 0)
+            self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+
+            assert self.interface.db.execute(
+                "select lumi, last_lumi, status from units_test_unit_ranges where task=? order by lumi",
+                (id,)).fetchall() == [(1, 1, 2), (2, 2, 3), (3, 3, 2)]
+            assert self.interface.verify_counters(fix=False) == []
+
+            (units, rows) = self.interface.db.execute("""
+                select units_available, (select count(*) from units_test_unit_ranges)
+                from workflows where label=?""", (label,)).fetchone()
+
+            assert units == 15
+            assert rows == 6
+
+            tasks = self.interface.pop_units('test_unit_ranges', 10)
+            assert sorted(l for (_, _, _, lumis, _, _) in tasks for (_, _, _, l) in lumis) == [2] + range(7, 21)
+            assert self.interface.verify_counters(fix=False) == []
+        finally:
+            with util.PartiallyMutable.unlock():
+                self.interface.config.advanced.unit_ranges = False
+        # }}}
+
+    def test_migrate(self):
+        # {{{
+        workdir = tempfile.mkdtemp()
+        config = Config(
+            label='test',
+            workdir=workdir,
+            storage=se.StorageConfiguration(output=['file://' + workdir]),
+            workflows=[],
+            advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3")
+        )
+        try:
+            store = UnitStore(config)
+            store.register_dataset(
+                *self.create_dbs_dataset(
+                    'test_migrate', lumis=20, filesize=2.2, tasksize=3))
+
+            (id, label, files, lumis, arg, _) = store.pop_units('test_migrate', 1)[0]
+            task_update = TaskUpdate(host='hostname', id=id, events_read=300, events_written=200)
+            handler = TaskHandler(id, label, files, lumis, None, True)
+            processed = dict((f, (100, [(r, l) for (_, u, r, l) in lumis if u == k])) for (k, f) in files)
+            file_update, unit_update = handler.get_unit_info(False, task_update, processed, [], 0)
+            store.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+            store.pop_units('test_migrate', 1)
+
+            summary = "select units_done, units_running, events_read, events_written from workflows"
+            expected = store.db.execute(summary).fetchall()
+            store.disconnect()
+
+            # remove the columns introduced since the last release
+            db = sqlite3.connect(os.path.join(workdir, 'lobster.db'))
+            added = ['units_failed', 'units_skipped', 'units_merged', 'events_read', 'events_written', 'merge_tasks',
+                     'unit_ranges']
+            for table in ['workflows', 'files_test_migrate']:
+                columns = [c for (_, c, _, _, _, _) in db.execute("pragma table_info({0})".format(table))
+                           if c not in added + ['location']]
+                db.execute("create table previous as select {0} from {1}".format(', '.join(columns), table))
+                db.execute("drop table {0}".format(table))
+                db.execute("alter table previous rename to {0}".format(table))
+            db.commit()
+            db.close()
+
+            # the configuration pickled with the project lacks newer options, too
+            advanced = pickle.loads(pickle.dumps(config.advanced))
+            for option in ['eta_target', 'forecast', 'locality', 'move_taskdirs', 'profile_sql', 'release_depth',
+                           'task_threads', 'unit_ranges']:
+                del advanced.__dict__[option]
+            advanced = pickle.loads(pickle.dumps(advanced))
+            assert advanced.task_threads == 4 and not advanced.unit_ranges and not advanced.profile_sql
+            config = Config(
+                label='test',
+                workdir=workdir,
+                storage=se.StorageConfiguration(output=['file://' + workdir]),
+                workflows=[],
+                advanced=advanced
+            )
+
+            store = UnitStore(config)
+            assert store.db.execute(summary).fetchall() == expected
+            assert store.verify_counters(fix=False) == []
+            assert len(store.pop_units('test_migrate', 1)) == 1
+            store.disconnect()
+        finally:
+            shutil.rmtree(workdir)
+        # }}}
+
+    def test_locality(self):
+        # {{{
+        with util.PartiallyMutable.unlock():
+            self.interface.config.advanced.locality = True
+
+        try:
+            workflow, info = self.create_dbs_dataset('test_locality', lumis=12, filesize=3, tasksize=1)
+            for n in range(4):
+                info.files['/test/{0}.root'.format(n)].location = 'site{0}'.format(n % 2)
+            self.interface.register_dataset(workflow, info)
+
+            # tasks alternate between sites, and start on files not read yet
+            tasks = self.interface.pop_units('test_locality', 4)
+            assert [fn for (_, _, files, _, _, _) in tasks for (_, fn) in files] == [
+                '/test/0.root', '/test/1.root', '/test/2.root', '/test/3.root']
+
+            (id, label, files, lumis, arg, _) = tasks[0]
+            task_update = TaskUpdate(host='hostname', id=id)
+            handler = TaskHandler(id, label, files, lumis, None, True)
+            file_update, unit_update = handler.get_unit_info(
+                False, task_update, {'/test/0.root': (100, [(1, 1)])}, [], 0)
+            self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+
+            tasks = self.interface.pop_units('test_locality', 1)
+            assert [fn for (_, fn) in tasks[0][2]] == ['/test/0.root']
+            assert self.interface.verify_counters(fix=False) == []
+
+            # larger tasks read the files of one site
+            workflow, info = self.create_dbs_dataset('test_locality_sites', lumis=12, filesize=3, tasksize=6)
+            for n in range(4):
+                info.files['/test/{0}.root'.format(n)].location = 'site{0}'.format(n % 2)
+            self.interface.register_dataset(workflow, info)
+
+            tasks = self.interface.pop_units('test_locality_sites', 2)
+            assert [sorted(fn for (_, fn) in files) for (_, _, files, _, _, _) in tasks] == [
+                ['/test/0.root', '/test/2.root'], ['/test/1.root', '/test/3.root']]
+            assert self.interface.verify_counters(fix=False) == []
+        finally:
+            with util.PartiallyMutable.unlock():
+                self.interface.config.advanced.locality = False
+        # }}}
+
+    def test_transfers(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_transfers', lumis=20, filesize=2.2, tasksize=3))
+
+        def release(outcomes):
+            (id, label, files, lumis, arg, _) = self.interface.pop_units('test_transfers', 1)[0]
+            task_update = TaskUpdate(host='hostname', id=id)
+            handler = TaskHandler(id, label, files, lumis, None, True)
+            file_update, unit_update = handler.get_unit_info(True, task_update, {}, [], 0)
+            self.interface.update_units(
+                {(label, "units_" + label): [(task_update, file_update, unit_update)]},
+                {label: {'xrdcp': Counter(outcomes)}})
+
+        release({'stage-in success': 2, 'stage-in failure': 1})
+        release({'stage-in success': 1, 'stageout failure': 1})
+
+        totals = self.interface.transfer_totals()['test_transfers']
+        assert totals['xrdcp'] == Counter({'stage-in success': 3, 'stage-in failure': 1, 'stageout failure': 1})
+
+        history = [h for h in self.interface.transfer_history(time.time() - 3600) if h[0] == 'test_transfers']
+        assert sorted((o, c) for (_, _, o, _, c) in history) == [
+            ('stage-in failure', 1), ('stage-in success', 3), ('stageout failure', 1)]
+        assert self.interface.transfer_history(time.time() + 3600) == []
+        # }}}
+
+    def test_throughput(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_throughput', lumis=20, filesize=2.2, tasksize=3))
+
+        now = int(time.time())
+
+        def release(failed, retrieved, runtime):
+            (id, label, files, lumis, arg, _) = self.interface.pop_units('test_throughput', 1)[0]
+            task_update = TaskUpdate(host='hostname', id=id, time_retrieved=retrieved, time_on_worker=runtime)
+            handler = TaskHandler(id, label, files, lumis, None, True)
+            processed = dict((f, (10, [(r, l) for (_, u, r, l) in lumis if u == k])) for (k, f) in files)
+            file_update, unit_update = handler.get_unit_info(failed, task_update, {} if failed else processed, [], 0)
+            self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+
+        release(False, now - 7200, 1000)
+        release(False, now - 60, 100)
+        release(True, now - 30, 500)
+
+        assert self.interface.throughput(now - 3600) == {'test_throughput': (2, 100.)}
+        assert self.interface.throughput(now) == {}
+        # }}}
+
+    def test_snapshot(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_snapshot', lumis=20, filesize=2.2, tasksize=3))
+        self.interface.pop_units('test_snapshot', 2)
+
+        assert not UnitStore(self.interface.config, snapshot=True).readonly
+
+        self.interface.snapshot(force=True, wait=True)
+        try:
+            snapshot = UnitStore(self.interface.config, snapshot=True)
+            assert snapshot.readonly
+            assert list(snapshot.workflow_status()) == list(self.interface.workflow_status())
+
+            # changes to the live database do not show up in the snapshot
+            query = "select units_running from workflows where label='test_snapshot'"
+            self.interface.pop_units('test_snapshot', 2)
+            assert snapshot.db.execute(query).fetchone()[0] == 6
+            assert self.interface.db.execute(query).fetchone()[0] == 12
+
+            try:
+                snapshot.writer
+                assert False
+            except IOError:
+                pass
+
+            # a snapshot left behind by a crashed master is not used
+            stale = time.time() - UnitStore.snapshot_expiry - 60
+            os.utime(self.interface.snapshot_path, (stale, stale))
+            assert not UnitStore(self.interface.config, snapshot=True).readonly
+        finally:
+            os.remove(self.interface.snapshot_path)
+        # }}}
+
+    def test_copy_database(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_copy_database', lumis=20, filesize=2.2, tasksize=3))
+        self.interface.pop_units('test_copy_database', 2)
+
+        target = os.path.join(tempfile.mkdtemp(), 'copy.db')
+        version = sqlite3.sqlite_version_info
+        try:
+            # copy without `vacuum into`, as for SQLite before 3.27
+            sqlite3.sqlite_version_info = (3, 26, 0)
+            copy_database(self.interface.db_path, target)
+        finally:
+            sqlite3.sqlite_version_info = version
+
+        db = sqlite3.connect(target)
+        query = "select * from {0} order by rowid"
+        for (table,) in self.interface.db.execute("select name from sqlite_master where type='table' and name not like 'sqlite_%'"):
+            assert db.execute(query.format(table)).fetchall() == self.interface.db.execute(query.format(table)).fetchall()
+        indices = "select name from sqlite_master where type='index' order by name"
+        assert db.execute(indices).fetchall() == self.interface.db.execute(indices).fetchall()
+        db.close()
+        shutil.rmtree(os.path.dirname(target))
+        # }}}
+
+    def test_profile_sql(self):
+        # {{{
+        workdir = tempfile.mkdtemp()
+        try:
+            store = UnitStore(
+                Config(
+                    label='test',
+                    workdir=workdir,
+                    storage=se.StorageConfiguration(output=['file://' + workdir]),
+                    workflows=[],
+                    advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3", profile_sql=True)
+                )
+            )
+            store.register_dataset(
+                *self.create_dbs_dataset(
+                    'test_profile_sql', lumis=20, filesize=2.2, tasksize=3))
+            store.pop_units('test_profile_sql', 2)
+
+            assert store.profile.times['pop_units'] > 0
+
+            store.disconnect()
+            with open(os.path.join(workdir, 'sql_profile.json')) as f:
+                stats = json.load(f)
+            statements = [s['statement'] for s in stats]
+            assert any('units_{label}' in s for s in statements)
+            assert not any('test_profile_sql' in s for s in statements)
+            assert all(s['calls'] > 0 for s in stats)
+        finally:
+            shutil.rmtree(workdir)
+        # }}}
+
+    def test_counters(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset(
+                'test_counters', lumis=20, filesize=2.2, tasksize=3))
+
+        (id, label, files, lumis, arg, _) = self.interface.pop_units('test_counters', 1)[0]
+        task_update = TaskUpdate(host='hostname', id=id)
+        handler = TaskHandler(id, label, files, lumis, None, True)
+        file_update, unit_update = handler.get_unit_info(False, task_update, {}, ['/test/0.root'], 0)
+        self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+
+        (id, label, files, lumis, arg, _) = self.interface.pop_units('test_counters', 1)[0]
+        task_update = TaskUpdate(host='hostname', id=id)
+        handler = TaskHandler(id, label, files, lumis, None, True)
+        file_update, unit_update = handler.get_unit_info(True, task_update, {}, [], 0)
+        self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+
+        (id, label, files, lumis, arg, _) = self.interface.pop_units('test_counters', 1)[0]
+        task_update = TaskUpdate(host='hostname', id=id)
+        handler = TaskHandler(id, label, files, lumis, None, True)
+        file_update, unit_update = handler.get_unit_info(
+            False, task_update, dict((f, (200, [(r, l) for (_, u, r, l) in lumis if u == i])) for (i, f) in files), [], 0)
+        self.interface.update_units({(label, "units_" + label): [(task_update, file_update, unit_update)]})
+        self.interface.update_missing([int(id)])
+
+        self.interface.pop_units('test_counters', 2)
+
+        assert self.interface.verify_counters(fix=False) == []
+
+        (jr, ja, jl) = self.interface.db.execute(
+            "select units_running, units_available, units_left from workflows where label=?", (label,)).fetchone()
+
+        assert jr == 6
+        assert ja == 23
+        assert jl == 23
+
+        self.interface.reset_units()
+
+        assert self.interface.verify_counters(fix=False) == []
+
+        # masked units are neither left nor available
+        workflow, info = self.create_dbs_dataset('test_counters_masked', lumis=20, filesize=2.2, tasksize=3)
+        info.masked_units = 5
+        info.total_units += info.masked_units
+        self.interface.register_dataset(workflow, info)
+
+        assert self.interface.verify_counters(fix=False) == []
+        (complete, left, _) = self.interface.work_left('test_counters_masked')
+        assert complete and left == 29
+
+        while self.interface.pop_units('test_counters_masked', 10):
+            pass
+        (complete, left, _) = self.interface.work_left('test_counters_masked')
+        assert complete and left == 0
+        assert self.interface.verify_counters(fix=False) == []
+        # }}}
+
+    def test_lazy_files(self):
+        # {{{
+        workflow, info = self.create_dbs_dataset('test_lazy_files', lumis=20, filesize=2.2, tasksize=3)
+        files = info.files
+        total_units = info.total_units
+
+        # the unit counts are only known after all files have been read
+        def lazy():
+            for fn in sorted(files):
+                yield fn, files[fn]
+            info.masked_units = 5
+            info.total_units = total_units + info.masked_units
+            info.stop_on_file_boundary = True
+        info.files = lazy()
+        info.total_units = 0
+        self.interface.register_dataset(workflow, info)
+
+        (units, masked, left, available, stop) = self.interface.db.execute("""
+            select units, units_masked, units_left, units_available, stop_on_file_boundary
+            from workflows where label='test_lazy_files'""").fetchone()
+        assert (units, masked, left, available, stop) == (total_units + 5, 5, total_units, total_units, 1)
+        assert self.interface.verify_counters(fix=False) == []
+        # }}}
+
 
 class TestCMSSWProvider(object):
 
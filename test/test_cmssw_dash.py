@@ -0,0 +1,29 @@
+import pickle
+import unittest
+
+from lobster.cmssw.dash import Dashboard, Sender
+
+
+class TestDashboard(unittest.TestCase):
+
+    def test_unpickle_previous(self):
+        # the state of a dashboard pickled before the rate limit existed
+        dashboard = Dashboard.__new__(Dashboard)
+        dashboard.__dict__.update({
+            'interval': 300,
+            'username': 'user',
+            'commonname': 'User Name',
+            '_ce': 'host',
+            '_constructed': True,
+            '_Dashboard__previous': 0,
+            '_Dashboard__states': {},
+            '_Dashboard__cmssw_version': 'Unknown',
+            '_Dashboard__executable': 'Unknown',
+            '_Dashboard__sender': Sender(100, 50000)
+        })
+
+        dashboard = pickle.loads(pickle.dumps(dashboard))
+        assert dashboard.rate == 100
+        assert dashboard.backlog == 50000
+        assert dashboard.interval == 300
+        assert dashboard.counters == {'sent': 0, 'dropped': 0, 'coalesced': 0}
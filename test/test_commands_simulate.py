@@ -0,0 +1,121 @@
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+
+from lobster import se, util
+from lobster.cmssw.dataset import DatasetInfo
+from lobster.commands.simulate import Model, Pool, Simulation
+from lobster.core.config import Config, AdvancedOptions
+from lobster.core.task import TaskHandler
+from lobster.core.unit import TaskUpdate, UnitStore
+from lobster.core.workflow import Category, Workflow
+
+
+class TestSimulation(object):
+
+    @classmethod
+    def setup_class(cls):
+        os.environ['LOCALRT'] = ''
+        cls.workdir = tempfile.mkdtemp()
+        cls.config = Config(
+            label='test',
+            workdir=cls.workdir,
+            storage=se.StorageConfiguration(output=['file://' + cls.workdir]),
+            workflows=[Workflow('test', None, category=Category(name='test', cores=2), merge_size=-1)],
+            advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3")
+        )
+        with util.PartiallyMutable.unlock():
+            cls.config.workflows.test.outputs = []
+
+        info = DatasetInfo()
+        info.path = ''
+        info.tasksize = 20
+        for i in range(40):
+            f = '/test/{0}.root'.format(i)
+            info.files[f].lumis = [(1, l) for l in range(i * 50 + 1, i * 50 + 51)]
+            info.files[f].events = 5000
+            info.files[f].size = 50000000
+        info.total_units = 2000
+        info.total_events = 200000
+
+        # process the dataset once, with a few failures to retry
+        store = UnitStore(cls.config)
+        store.register_dataset(cls.config.workflows.test, info)
+        rnd = random.Random(1)
+        while True:
+            tasks = store.pop_units('test', 20)
+            if len(tasks) == 0:
+                break
+            updates = []
+            for (id, label, files, lumis, arg, _) in tasks:
+                handler = TaskHandler(id, label, files, lumis, None, True)
+                task_update = TaskUpdate(
+                    host='test', id=id, time_retrieved=1000000,
+                    time_on_worker=int(len(lumis) * rnd.lognormvariate(math.log(20), .5)),
+                    bytes_bare_output=len(lumis) * 1000000)
+                failed = rnd.random() < .05
+                files_info = {}
+                if not failed:
+                    for (fid, fn) in files:
+                        files_info[fn] = (1, [(r, l) for (_, f, r, l) in lumis if f == fid])
+                file_update, unit_update = handler.get_unit_info(failed, task_update, files_info, [], 0)
+                updates.append((task_update, file_update, unit_update))
+            store.update_units({('test', 'units_test'): updates})
+        store.disconnect()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.workdir)
+
+    def simulate(self, cores):
+        db = sqlite3.connect(os.path.join(self.workdir, 'lobster.db'))
+        scratch = tempfile.mkdtemp()
+        with util.PartiallyMutable.unlock():
+            self.config.workdir = scratch
+        try:
+            simulation = Simulation(self.config, Model(db), Pool(self.workdir, cores), 60)
+            simulation.register('test', db)
+            makespan, complete = simulation.run(30 * 24 * 3600)
+            assert simulation.store.unfinished_units() == 0
+            simulation.store.disconnect()
+            return simulation, makespan, complete
+        finally:
+            with util.PartiallyMutable.unlock():
+                self.config.workdir = self.workdir
+            shutil.rmtree(scratch)
+            db.close()
+
+    def test_replay(self):
+        # {{{
+        simulation, makespan, complete = self.simulate(40)
+        assert complete
+        assert simulation.created >= 100
+        assert simulation.evicted == 0
+        # all processing time fits into the makespan, without idling much
+        assert makespan >= simulation.busy_time / 40.
+        assert simulation.busy_time / float(simulation.core_time) > .5
+
+        # more cores finish sooner
+        _, shorter, complete = self.simulate(80)
+        assert complete
+        assert shorter < makespan
+        # }}}
+
+    def test_previous_version(self):
+        # {{{
+        # projects of older versions have no `unit_ranges` column
+        db = sqlite3.connect(os.path.join(self.workdir, 'lobster.db'))
+        columns = [row[1] for row in db.execute("pragma table_info(workflows)") if row[1] != 'unit_ranges']
+        db.execute("create table previous as select {0} from workflows".format(", ".join(columns)))
+        db.execute("drop table workflows")
+        db.execute("alter table previous rename to workflows")
+        db.commit()
+        db.close()
+
+        _, makespan, complete = self.simulate(40)
+        assert complete
+        assert makespan > 0
+        # }}}
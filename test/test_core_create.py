@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+from lobster import se
+from lobster.core.config import Config, AdvancedOptions
+from lobster.core.create import Algo
+from lobster.core.workflow import Category, Workflow
+
+
+class TestAlgo(object):
+
+    @classmethod
+    def setup_class(cls):
+        os.environ['LOCALRT'] = ''
+        cls.workdir = tempfile.mkdtemp()
+        cls.config = Config(
+            label='test',
+            workdir=cls.workdir,
+            storage=se.StorageConfiguration(output=['file://' + cls.workdir]),
+            workflows=[Workflow('test', None, category=Category(name='test', cores=2))],
+            advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3", eta_target=1800)
+        )
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.workdir)
+
+    def queued(self, running):
+        return {'test': {'running': running, 'queued': 0}}
+
+    def test_forecast_idle(self):
+        # 20 tasks of 2 cores running, nothing finishing or joining
+        assert Algo(self.config).forecast(100, self.queued(20), {}, now=1000.) == 60
+        assert Algo(self.config).forecast(30, self.queued(20), {}, now=1000.) == 0
+
+    def test_forecast_throughput(self):
+        # 90 tasks within the window of 900 s finish at 0.1 tasks/s, or 6
+        # tasks of 2 cores in the 60 s assumed for the first cycle
+        assert Algo(self.config).forecast(100, self.queued(20), {'test': (90, 3600.)}, now=1000.) == 60 + 12
+        # but no more than are running
+        assert Algo(self.config).forecast(100, self.queued(3), {'test': (90, 3600.)}, now=1000.) == 94 + 6
+        # throughput of unknown workflows does not count
+        assert Algo(self.config).forecast(100, self.queued(20), {'other': (90, 3600.)}, now=1000.) == 60
+
+    def test_forecast_growth(self):
+        algo = Algo(self.config)
+        assert algo.forecast(100, self.queued(50), {}, now=1000.) == 0
+        # 60 cores joined in the last 300 s, and are expected to do so again
+        # in a cycle of the same length
+        assert algo.forecast(160, self.queued(50), {}, now=1300.) == 60 + 60
+        # growth over the whole window, and the finish rate, are scaled to
+        # the length of the cycle
+        assert algo.forecast(160, self.queued(80), {'test': (90, 3600.)}, now=1600.) == 30 + 2 * 30
+        # after the window expires, earlier worker counts are forgotten
+        assert algo.forecast(160, self.queued(50), {}, now=3000.) == 60
+        # workers leaving do not reduce the forecast
+        assert algo.forecast(100, self.queued(50), {}, now=3060.) == 0
+
+    def test_taper(self):
+        algo = Algo(self.config)
+        # without a known runtime, spread the work over the needed tasks
+        assert algo.taper(20., 80, None) == .25
+        assert algo.taper(20., 80, 0) == .25
+        assert algo.taper(100., 80, None) == 1.
+        # runtime below the target, keep the default size
+        assert algo.taper(20., 80, 1000.) == 1.
+        # runtime above the target, shrink tasks to meet it
+        assert algo.taper(20., 80, 3600.) == .5
+        # but not below what is needed to spread the work
+        assert algo.taper(20., 80, 36000.) == .25
+        assert algo.taper(100., 80, 3600.) == 1.
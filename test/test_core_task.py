@@ -1,7 +1,9 @@
 from collections import defaultdict, Counter
 import os
+import random
 import unittest
 
+from lobster.core import unit
 from lobster.core.task import TaskHandler
 from lobster.core.source import ReleaseSummary
 
@@ -36,3 +38,22 @@ class TestTask(unittest.TestCase):
                                  (1, 276), (1, 277), (1, 278), (1, 279), (1, 280)]
         assert outinfo.events == 4000
         assert outinfo.size == 15037503
+
+    def test_many_files(self):
+        files = [(i, '/test/{0}.root'.format(i)) for i in range(2000)]
+        lumis = [(i * 5 + j, i, 1, i * 5 + j) for i in range(2000) for j in range(5)]
+        random.Random(1).shuffle(lumis)
+
+        files_info = dict((fn, (500, [(1, i * 5 + j) for j in range(4)])) for i, fn in files[:1000])
+        files_skipped = [fn for _, fn in files[1000:1500]]
+
+        handler = TaskHandler(1, "test", files, lumis, [], None)
+        file_update, unit_update = handler.get_unit_info(
+            False, unit.TaskUpdate(), files_info, files_skipped, 0)
+
+        assert len(file_update) == 2000
+        assert sum(read for (read, _, _) in file_update) == 500 * 1000
+        assert sum(skipped for (_, skipped, _) in file_update) == 1000
+        assert len(unit_update) == 1000 + 1000 * 5
+        assert set(id for (_, id, _) in unit_update) == set(
+            [i * 5 + 4 for i in range(1000)] + range(5000, 10000))
@@ -0,0 +1,76 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from lobster.monitor import statslog
+
+
+class TestStatsLog(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_append(self):
+        fn = os.path.join(self.workdir, 'stats.dat')
+        log = statslog.StatsLog(fn, ['timestamp', 'tasks_running'])
+        log.write([1478000000000000, 10])
+        log.close()
+
+        # an interrupted write leaves an incomplete record
+        with open(fn, 'ab') as f:
+            f.write('\0' * 3)
+
+        log = statslog.StatsLog(fn, ['timestamp', 'tasks_running'])
+        log.write([1478000060000000, 12])
+        log.close()
+
+        columns, offset, count = statslog.layout(fn)
+        assert columns == ['timestamp', 'tasks_running']
+        assert offset % 8 == 0
+        assert count == 2
+        assert os.path.getsize(fn) == offset + count * 16
+
+        columns, records = statslog.read(fn)
+        assert list(records) == [(1478000000000000., 10.), (1478000060000000., 12.)]
+
+    def test_columns_changed(self):
+        fn = os.path.join(self.workdir, 'stats.dat')
+        log = statslog.StatsLog(fn, ['timestamp', 'tasks_running', 'workers_busy'])
+        log.write([1, 2, 3])
+        log.close()
+
+        log = statslog.StatsLog(fn, ['timestamp', 'units_left', 'tasks_running'])
+        log.write([4, 5, 6])
+        log.close()
+
+        columns, records = statslog.read(fn)
+        records = list(records)
+        assert columns == ['timestamp', 'units_left', 'tasks_running']
+        assert records[0][0] == 1 and math.isnan(records[0][1]) and records[0][2] == 2
+        assert records[1] == (4, 5, 6)
+
+    def test_convert(self):
+        text = os.path.join(self.workdir, 'stats.log')
+        with open(text, 'w') as f:
+            f.write('#timestamp tasks_running\n')
+            f.write('1000000 10\n')
+            f.write('2000000 11\n')
+            f.write('#timestamp units_left tasks_running\n')
+            f.write('3000000 100 12\n')
+
+        fn = os.path.join(self.workdir, 'stats.dat')
+        statslog.convert(text, fn)
+
+        assert statslog.is_binary(fn)
+        assert not statslog.is_binary(text)
+
+        columns, records = statslog.read(fn)
+        records = list(records)
+        assert columns == ['timestamp', 'tasks_running', 'units_left']
+        assert [r[:2] for r in records] == [(1e6, 10), (2e6, 11), (3e6, 12)]
+        assert math.isnan(records[0][2]) and records[2][2] == 100